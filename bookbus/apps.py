@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class BookbusConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'bookbus'
+
+    def ready(self):
+        import bookbus.signals
@@ -0,0 +1,17 @@
+from django.utils.functional import SimpleLazyObject
+
+
+def group_names(user):
+    """The names of the user's groups, read once and kept on the user for the rest of the request"""
+    if not user.is_authenticated:
+        return frozenset()
+    try:
+        return user._group_names
+    except AttributeError:
+        user._group_names = frozenset(user.groups.values_list('name', flat=True))
+        return user._group_names
+
+
+def user_groups(request):
+    """`user_groups` for templates, so every group check on a page shares one query"""
+    return {'user_groups': SimpleLazyObject(lambda: group_names(request.user))}
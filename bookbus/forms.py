@@ -4,6 +4,36 @@ from .models import Bus, Booking, BusStop, Seat, Stop
 from django.db.models import Q, F
 import datetime
 from django_countries import countries
+from django.urls import reverse_lazy
+
+
+class StopSearchSelect(forms.Select):
+    """
+    Renders only the selected stop as an option; stop_search.js fetches the
+    rest from the stop-search endpoint as the user types
+    """
+    placeholder = '-- Any Stop --'
+
+    def __init__(self, attrs=None, placeholder=None):
+        super().__init__({'class': 'form-select', 'data-stop-search': reverse_lazy('stop-search'), **(attrs or {})})
+        if placeholder is not None:
+            self.placeholder = placeholder
+
+    def optgroups(self, name, value, attrs=None):
+        selected = [pk for pk in value if str(pk).isdigit()]
+        choices = [('', self.placeholder)] if not self.allow_multiple_selected else []
+        if selected:
+            field = self.choices.field
+            choices += [(stop.pk, field.label_from_instance(stop)) for stop in field.queryset.filter(pk__in=selected)]
+
+        return [
+            (None, [self.create_option(name, pk, label, str(pk) in value, index, attrs=attrs)], index)
+            for index, (pk, label) in enumerate(choices)
+        ]
+
+
+class StopSearchSelectMultiple(StopSearchSelect, forms.SelectMultiple):
+    pass
 
 class SeatSelectionForm(forms.Form):
     travel_date = forms.DateField(
@@ -157,19 +187,10 @@ class BusForm(forms.ModelForm):
             self.initial['operating_days'] = [str(day) for day in self.instance.operating_days]
         
         if self.instance.pk:
-            seats = self.instance.seats.all()
-            self.initial.update({
-                'general_count': seats.filter(seat_class="General").count(),
-                'sleeper_count': seats.filter(seat_class="Sleeper").count(),
-                'luxury_count': seats.filter(seat_class="Luxury").count(),
-            })
-            
-            if seats.exists():
-                self.initial.update({
-                    'general_fare': seats.filter(seat_class="General").first().fare if seats.filter(seat_class="General").exists() else 0,
-                    'sleeper_fare': seats.filter(seat_class="Sleeper").first().fare if seats.filter(seat_class="Sleeper").exists() else 0,
-                    'luxury_fare': seats.filter(seat_class="Luxury").first().fare if seats.filter(seat_class="Luxury").exists() else 0,
-                })
+            # Free when the bus was loaded with Bus.objects.with_seat_summary()
+            for seat_class, (count, fare) in self.instance.seat_summary().items():
+                self.initial[f'{seat_class.lower()}_count'] = count
+                self.initial[f'{seat_class.lower()}_fare'] = fare
 
 
     def clean_operating_days(self):
@@ -190,7 +211,7 @@ class BusStopForm(forms.Form):
     stops = forms.ModelMultipleChoiceField(
         queryset=Stop.objects.all(),
         required=False,
-        widget=forms.SelectMultiple(attrs={'class': 'form-control'})
+        widget=StopSearchSelectMultiple(attrs={'class': 'form-control'})
     )
     stop_order = forms.CharField(widget=forms.HiddenInput())
     stop_times = forms.CharField(widget=forms.HiddenInput())
@@ -227,13 +248,13 @@ class FilterForm(forms.Form):
         queryset=Stop.objects.all(),
         required=False,
         label="Starting Stop",
-        widget=forms.Select(attrs={'class': 'form-control'})
+        widget=StopSearchSelect()
     )
     journey_end = forms.ModelChoiceField(
         queryset=Stop.objects.all(),
         required=False,
         label="Destination Stop",
-        widget=forms.Select(attrs={'class': 'form-control'})
+        widget=StopSearchSelect()
     )
 
 
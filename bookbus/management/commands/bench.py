@@ -0,0 +1,179 @@
+import datetime
+import json
+import random
+import statistics
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.models import F
+from django.test import Client
+from django.urls import reverse
+from django.utils import timezone
+from bookbus.models import Booking, Bus, BusStop
+from bookbus.utils.export_utils import export_bookings_file
+from bookbus.utils.metrics import track_request
+from bookbus.utils.synthetic_network import clear_network, seed_network
+from bookbus.utils.transaction_utils import create_transaction
+from users.models import Profile
+from .bench_connections import percentile
+
+TAG = 'bench'
+
+
+def client_host():
+    """A host name the site accepts, so requests pass ALLOWED_HOSTS"""
+    for host in settings.ALLOWED_HOSTS:
+        if host != '*':
+            return host.lstrip('.')
+    return 'localhost'
+
+
+class Command(BaseCommand):
+    help = (
+        'Seeds synthetic networks of several sizes (see seed_network) and times the core paths on each: '
+        'home search, bus_book GET (fresh and revalidated) and POST, cancel, export and create_transaction. '
+        'Prints JSON with --json so runs before and after a change can be compared.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000], help='Bus counts to run at')
+        parser.add_argument('--stops-per-bus', type=int, default=4)
+        parser.add_argument('--bookings-per-bus', type=int, default=40)
+        parser.add_argument('--iterations', type=int, default=20, help='Timed runs of each path per size')
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--keep', action='store_true', help='Keep the last network afterwards')
+        parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+
+    def handle(self, *args, **options):
+        results = {'vendor': connection.vendor, 'seed': options['seed'], 'sizes': []}
+        for size in options['sizes']:
+            clear_network(TAG)
+            started = time.perf_counter()
+            counts = seed_network(
+                size * options['stops_per_bus'], size, size * options['bookings_per_bus'],
+                seed=options['seed'], tag=TAG
+            )
+            seed_seconds = time.perf_counter() - started
+            paths = self.run_paths(random.Random(options['seed']), options['iterations'])
+            results['sizes'].append(dict(counts, seed_seconds=round(seed_seconds, 2), paths=paths))
+            if not options['json']:
+                self.write_size(results['sizes'][-1])
+
+        if not options['keep']:
+            clear_network(TAG)
+        if options['json']:
+            self.stdout.write(json.dumps(results))
+
+    def run_paths(self, rng, iterations):
+        today = timezone.localdate()
+        operator_name = f'{TAG}-operator-1'
+        customer_name = f'{TAG}-customer-1'
+        buses = list(Bus.objects.filter(travels__username=operator_name).select_related('travels'))
+        customer = Profile.objects.select_related('user').get(user__username=customer_name).user
+        # Enough coins for every booking the run makes
+        Profile.objects.filter(user=customer).update(coins=F('coins') + 10 ** 9)
+        client = Client(HTTP_HOST=client_host())
+        client.force_login(customer)
+
+        def trip(bus):
+            """A travel date in the next week the bus runs on, and its BusStop ids in order"""
+            dates = [today + datetime.timedelta(days=day) for day in range(1, 8)]
+            dates = [day for day in dates if bus.runs_on_date(day)]
+            stops = list(BusStop.objects.filter(bus=bus).order_by('stop_order').values_list('pk', 'stop_id'))
+            return (rng.choice(dates) if dates else None), stops
+
+        timings = {}
+
+        def timed(name, call):
+            with track_request() as stats:
+                call()
+            timing = timings.setdefault(name, {'ms': [], 'db_ms': [], 'queries': []})
+            timing['ms'].append(stats.wall_seconds * 1000)
+            timing['db_ms'].append(stats.db_seconds * 1000)
+            timing['queries'].append(stats.queries)
+
+        booked = []
+        for _ in range(iterations):
+            bus = rng.choice(buses)
+            travel_date, stops = trip(bus)
+            if travel_date is None:
+                continue
+            first = rng.randrange(len(stops) - 1)
+            last = rng.randrange(first + 1, len(stops))
+            book_url = reverse('bus-book', kwargs={'pk': bus.pk})
+
+            timed('home_search', lambda: client.get(reverse('bookbus-home'), {
+                'journey_start': stops[first][1], 'journey_end': stops[last][1], 'travel_date': travel_date,
+            }))
+
+            client.post(book_url, {'update_date': '1', 'travel_date': travel_date.isoformat()})
+            client.post(book_url, {
+                'update_segment': '1', 'segment_start': stops[first][0], 'segment_end': stops[last][0],
+            })
+            timed('bus_book_get', lambda: client.get(book_url))
+            # A checkout page polling a seat map that has not changed
+            etag = client.get(book_url).headers.get('ETag')
+            timed('bus_book_revalidate', lambda: client.get(book_url, HTTP_IF_NONE_MATCH=etag))
+
+            seat_ids = list(bus.seats.values_list('pk', flat=True))
+            group = rng.sample(seat_ids, min(rng.randint(1, 4), len(seat_ids)))
+            timed('bus_book_select', lambda: client.post(book_url, {'select_seats': '1', 'seats': group}))
+
+            # The OTP step, done: every passenger's email is already verified
+            session = client.session
+            booking_data = session.get('booking_data', {})
+            selected = booking_data.get('selected_seats', [])
+            if not selected:
+                continue
+            passengers = {}
+            booking_data['verified_emails'] = {}
+            for index, seat_id in enumerate(selected):
+                email = f'{TAG}-passenger-{seat_id}@example.invalid'
+                booking_data['verified_emails'][email] = seat_id
+                passengers.update({
+                    f'passenger_name_{index}': f'Passenger {index + 1}',
+                    f'passenger_email_{index}': email,
+                    f'start_stop_{index}': stops[first][0],
+                    f'end_stop_{index}': stops[last][0],
+                })
+            session['booking_data'] = booking_data
+            session.save()
+            timed('bus_book_confirm', lambda: client.post(book_url, dict(passengers, confirm_booking='1')))
+            booked.extend(Booking.objects.filter(
+                customer=customer, bus=bus, travel_date=travel_date, seat_id__in=selected, status='Confirmed'
+            ).values_list('pk', flat=True))
+
+        for booking_id in booked[:iterations]:
+            timed('cancel', lambda: client.post(reverse('cancel-booking', kwargs={'pk': booking_id})))
+
+        operator = buses[0].travels
+        for _ in range(iterations):
+            timed('create_transaction', lambda: create_transaction(customer, operator, 100, 'BOOKING'))
+        for _ in range(max(1, iterations // 5)):
+            timed('export', lambda: export_bookings_file(operator).close())
+
+        return {
+            name: {
+                'runs': len(timing['ms']),
+                'mean_ms': round(statistics.mean(timing['ms']), 2),
+                'p50_ms': round(percentile(timing['ms'], 0.50), 2),
+                'p95_ms': round(percentile(timing['ms'], 0.95), 2),
+                'db_p50_ms': round(percentile(timing['db_ms'], 0.50), 2),
+                'queries_p50': percentile(timing['queries'], 0.50),
+                'queries_max': max(timing['queries']),
+            }
+            for name, timing in timings.items()
+        }
+
+    def write_size(self, size):
+        self.stdout.write(self.style.SUCCESS(
+            f'{size["buses"]} buses, {size["stops"]} stops, {size["bookings"]} bookings '
+            f'(seeded in {size["seed_seconds"]}s)'
+        ))
+        for name, timing in size['paths'].items():
+            self.stdout.write(
+                f'{name:>20}: p50 {timing["p50_ms"]} ms, p95 {timing["p95_ms"]} ms, '
+                f'{timing["queries_p50"]} queries ({timing["db_p50_ms"]} ms in the database), '
+                f'{timing["runs"]} runs'
+            )
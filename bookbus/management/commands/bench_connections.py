@@ -0,0 +1,103 @@
+import datetime
+import json
+import random
+import statistics
+import time
+from django.core.management.base import BaseCommand
+from bookbus.utils.connection_search import Timetable, DEFAULT_MAX_TRANSFERS, DEFAULT_MIN_TRANSFER_MINUTES
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    index = min(int(round(fraction * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+def synthetic_trips(stop_count, bus_count, trips_per_line, seed, travel_date):
+    """
+    Generates a random network: lines of 8-25 stops, each run by several
+    buses a day with the same running times, on a mix of daily and
+    weekly schedules around `travel_date`.
+    """
+    rng = random.Random(seed)
+    stops = list(range(1, stop_count + 1))
+    first_day = travel_date - datetime.timedelta(days=60)
+    last_day = travel_date + datetime.timedelta(days=60)
+
+    trips = []
+    bus_id = 0
+    while bus_id < bus_count:
+        line = rng.sample(stops, rng.randint(8, 25))
+        hops = [rng.randint(5, 30) for _ in line[1:]]
+        for _ in range(min(trips_per_line, bus_count - bus_id)):
+            bus_id += 1
+            minute = rng.randint(5 * 60, 22 * 60)
+            times = [minute]
+            for hop in hops:
+                minute += hop
+                times.append(minute)
+            operating_days = [] if rng.random() < 0.7 else sorted(rng.sample(range(7), rng.randint(1, 6)))
+            trips.append((bus_id, first_day, last_day, operating_days, line, times))
+    return trips
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks the connection search on a synthetic network (no database needed)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--stops', type=int, default=5000)
+        parser.add_argument('--buses', type=int, default=20000)
+        parser.add_argument('--trips-per-line', type=int, default=20)
+        parser.add_argument('--queries', type=int, default=500)
+        parser.add_argument('--max-transfers', type=int, default=DEFAULT_MAX_TRANSFERS)
+        parser.add_argument('--min-transfer', type=int, default=DEFAULT_MIN_TRANSFER_MINUTES)
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+
+    def handle(self, *args, **options):
+        travel_date = datetime.date(2025, 1, 15)
+        trips = synthetic_trips(
+            options['stops'], options['buses'], options['trips_per_line'], options['seed'], travel_date
+        )
+
+        started = time.perf_counter()
+        timetable = Timetable(trips)
+        build_seconds = time.perf_counter() - started
+
+        rng = random.Random(options['seed'] + 1)
+        served = list(timetable.stop_routes)
+        timings = []
+        found = 0
+        for _ in range(options['queries']):
+            origin, destination = rng.sample(served, 2)
+            departure = rng.randint(6 * 60, 12 * 60)
+            started = time.perf_counter()
+            journeys = timetable.search(
+                origin, destination, travel_date,
+                departure=departure,
+                max_transfers=options['max_transfers'],
+                min_transfer=options['min_transfer']
+            )
+            timings.append((time.perf_counter() - started) * 1000)
+            found += bool(journeys)
+
+        results = {
+            'stops': options['stops'],
+            'buses': options['buses'],
+            'routes': len(timetable.routes),
+            'queries': options['queries'],
+            'answered': found,
+            'build_ms': round(build_seconds * 1000, 1),
+            'mean_ms': round(statistics.mean(timings), 2),
+            'p50_ms': round(percentile(timings, 0.50), 2),
+            'p95_ms': round(percentile(timings, 0.95), 2),
+            'p99_ms': round(percentile(timings, 0.99), 2),
+            'max_ms': round(max(timings), 2),
+        }
+
+        if options['json']:
+            self.stdout.write(json.dumps(results))
+            return
+
+        for key, value in results.items():
+            self.stdout.write(f'{key:>10}: {value}')
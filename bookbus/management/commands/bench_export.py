@@ -0,0 +1,88 @@
+import datetime
+import json
+import tempfile
+import time
+import tracemalloc
+from django.core.management.base import BaseCommand
+from openpyxl import Workbook
+from bookbus.utils.export_utils import HEADERS, write_bookings_workbook
+
+BUS_COUNT = 10
+
+
+def synthetic_rows(count):
+    """Booking rows shaped like export_rows(), spread over BUS_COUNT buses"""
+    per_bus = -(-count // BUS_COUNT)
+    booked_at = datetime.datetime(2025, 1, 1, 9, 30)
+    for index in range(count):
+        yield [
+            index + 1, index // per_bus + 1, 'Confirmed' if index % 7 else 'Cancelled',
+            f'G{index % 40 + 1}', 'General', f'Stop {index % 50}', f'Stop {index % 50 + 1}',
+            '2025-02-01', f'Passenger {index}', f'passenger{index}@example.com', 450,
+            booked_at.strftime("%Y-%m-%d %H:%M"), 'N/A'
+        ]
+
+
+def streaming_workbook(fileobj, rows):
+    buses = [(bus_id, 'Synthetic route', 0) for bus_id in range(1, BUS_COUNT + 1)]
+    write_bookings_workbook(fileobj, buses, rows)
+
+
+def in_memory_workbook(fileobj, rows):
+    """The previous export: every row held in a regular Workbook until save()"""
+    wb = Workbook()
+    wb.remove(wb.active)
+    sheets = {}
+    for row in rows:
+        ws = sheets.get(row[1])
+        if ws is None:
+            ws = sheets[row[1]] = wb.create_sheet(title=f"Bus-{row[1]}")
+            ws.append([header for header, _ in HEADERS])
+        ws.append(row)
+    wb.save(fileobj)
+
+
+class Command(BaseCommand):
+    help = 'Measures peak memory and time of the bookings Excel export against row count (no database needed)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, nargs='+', default=[1000, 10000, 50000])
+        parser.add_argument('--compare', action='store_true', help='Also run the old in-memory workbook')
+        parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+
+    def measure(self, write, count):
+        with tempfile.TemporaryFile() as fileobj:
+            tracemalloc.start()
+            started = time.perf_counter()
+            write(fileobj, synthetic_rows(count))
+            elapsed = time.perf_counter() - started
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            size = fileobj.tell()
+        return {
+            'rows': count,
+            'seconds': round(elapsed, 2),
+            'peak_mb': round(peak / 1024 / 1024, 1),
+            'file_mb': round(size / 1024 / 1024, 1),
+        }
+
+    def handle(self, *args, **options):
+        modes = [('streaming', streaming_workbook)]
+        if options['compare']:
+            modes.append(('in_memory', in_memory_workbook))
+
+        results = []
+        for count in options['rows']:
+            for mode, write in modes:
+                results.append(dict(mode=mode, **self.measure(write, count)))
+
+        if options['json']:
+            self.stdout.write(json.dumps(results))
+            return
+
+        self.stdout.write(f'{"mode":>10} {"rows":>9} {"seconds":>8} {"peak MB":>8} {"file MB":>8}')
+        for result in results:
+            self.stdout.write(
+                f'{result["mode"]:>10} {result["rows"]:>9} {result["seconds"]:>8} '
+                f'{result["peak_mb"]:>8} {result["file_mb"]:>8}'
+            )
@@ -0,0 +1,99 @@
+import json
+import statistics
+import threading
+import time
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connection
+from bookbus.utils import transaction_utils
+from bookbus.management.commands.bench_connections import percentile
+from users.models import Profile
+
+PREFIX = 'bench_ledger_'
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks concurrent bookings that all pay the same operator through the coin ledger'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=8)
+        parser.add_argument('--bookings', type=int, default=2000, help='Total bookings across all threads')
+        parser.add_argument('--seats', type=int, default=1, help='Seats (ledger entries) per booking')
+        parser.add_argument('--shards', type=int, default=transaction_utils.COIN_SHARDS,
+                            help='Coin shards per operator; 1 reproduces a single hot row')
+        parser.add_argument('--fare', type=int, default=100)
+        parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+
+    def handle(self, *args, **options):
+        transaction_utils.COIN_SHARDS = options['shards']
+        transaction_utils._sharded_users.clear()
+        threads = options['threads']
+        per_thread = options['bookings'] // threads
+        fare = options['fare']
+        cost = fare * options['seats']
+
+        User.objects.filter(username__startswith=PREFIX).delete()
+        operator = User.objects.create_user(f'{PREFIX}operator')
+        customers = [User.objects.create_user(f'{PREFIX}customer{i}') for i in range(threads)]
+        Profile.objects.filter(user__in=customers).update(coins=cost * per_thread)
+
+        timings = [[] for _ in range(threads)]
+        errors = [0] * threads
+
+        def book(index):
+            customer = customers[index]
+            entries = [(operator, fare, 'Benchmark booking')] * options['seats']
+            try:
+                for _ in range(per_thread):
+                    started = time.perf_counter()
+                    try:
+                        transaction_utils.post_transactions(customer, 'BOOKING', entries)
+                    except (OperationalError, ValueError):
+                        errors[index] += 1
+                        continue
+                    timings[index].append((time.perf_counter() - started) * 1000)
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=book, args=(index,)) for index in range(threads)]
+        started = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - started
+
+        all_timings = [timing for thread_timings in timings for timing in thread_timings]
+        posted = len(all_timings)
+        operator_balance = Profile.objects.get(user=operator).balance
+        spent = sum(cost * per_thread - coins for coins in Profile.objects.filter(
+            user__in=customers
+        ).values_list('coins', flat=True))
+
+        results = {
+            'threads': threads,
+            'shards': options['shards'],
+            'bookings': posted,
+            'errors': sum(errors),
+            'seconds': round(elapsed, 2),
+            'bookings_per_second': round(posted / elapsed, 1) if elapsed else 0,
+            'mean_ms': round(statistics.mean(all_timings), 2) if all_timings else 0,
+            'p95_ms': round(percentile(all_timings, 0.95), 2) if all_timings else 0,
+            'p99_ms': round(percentile(all_timings, 0.99), 2) if all_timings else 0,
+            # Both must equal bookings * seats * fare; anything else is a lost update
+            'expected_coins': posted * cost,
+            'operator_coins': operator_balance,
+            'customer_coins_spent': spent,
+        }
+        User.objects.filter(username__startswith=PREFIX).delete()
+
+        if options['json']:
+            self.stdout.write(json.dumps(results))
+            return
+
+        for key, value in results.items():
+            self.stdout.write(f'{key:>20}: {value}')
+        if operator_balance == spent == posted * cost:
+            self.stdout.write(self.style.SUCCESS('Ledger balanced'))
+        else:
+            self.stdout.write(self.style.ERROR('Ledger out of balance'))
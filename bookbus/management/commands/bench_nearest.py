@@ -0,0 +1,158 @@
+import json
+import time
+import numpy as np
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from bookbus.models import Stop
+from bookbus.utils.geohash import cells_covering, encode_cells, rank_by_distance
+from bookbus.utils.nearby_stops import DEFAULT_K, DEFAULT_RADIUS_M, DUPLICATE_RADIUS_M, nearest_stops
+from bookbus.utils.stop_search import bump_stop_index_version
+from .bench_connections import percentile
+
+TAG = 'bench-nearest'
+BATCH_SIZE = 5000
+
+
+def synthetic_stops(count, cities, seed):
+    """Stops scattered around `cities` random city centres, denser near the centre"""
+    rng = np.random.default_rng(seed)
+    centres = np.column_stack([rng.uniform(-50, 60, cities), rng.uniform(-120, 150, cities)])
+    owner = rng.integers(0, cities, count)
+    spread = rng.exponential(0.05, count)
+    angle = rng.uniform(0, 2 * np.pi, count)
+    latitudes = centres[owner, 0] + spread * np.sin(angle)
+    longitudes = centres[owner, 1] + spread * np.cos(angle)
+    return latitudes, longitudes
+
+
+def seed_stops(latitudes, longitudes):
+    """Bulk-inserts the synthetic stops, grid cells included since bulk_create skips save()"""
+    cells = encode_cells(latitudes, longitudes)
+    with transaction.atomic():
+        for start in range(0, len(cells), BATCH_SIZE):
+            Stop.objects.bulk_create([
+                Stop(
+                    name=f'{TAG} stop {index + 1}', country='IN', city=f'{TAG} city',
+                    latitude=float(latitudes[index]), longitude=float(longitudes[index]), grid_cell=cells[index],
+                )
+                for index in range(start, min(start + BATCH_SIZE, len(cells)))
+            ])
+        transaction.on_commit(bump_stop_index_version)
+
+
+def clear_stops():
+    with transaction.atomic():
+        Stop.objects.filter(name__startswith=f'{TAG} stop ').delete()
+        transaction.on_commit(bump_stop_index_version)
+
+
+class GridIndex:
+    """In-memory stand-in for the (grid_cell, latitude, longitude) index"""
+
+    def __init__(self, latitudes, longitudes):
+        cells = np.array(encode_cells(latitudes, longitudes))
+        self.order = np.argsort(cells, kind='stable')
+        self.latitudes = latitudes[self.order]
+        self.longitudes = longitudes[self.order]
+        unique, starts, counts = np.unique(cells[self.order], return_index=True, return_counts=True)
+        self.cells = {cell: (start, start + count) for cell, start, count in zip(unique, starts, counts)}
+
+    def nearest(self, latitude, longitude, k, radius):
+        spans = [self.cells[cell] for cell in cells_covering(latitude, longitude, radius) if cell in self.cells]
+        if not spans:
+            return []
+        positions = np.concatenate([np.arange(start, end) for start, end in spans])
+        ranked, _ = rank_by_distance(
+            latitude, longitude, self.latitudes[positions], self.longitudes[positions], k, radius
+        )
+        return self.order[positions[ranked]]
+
+
+def brute_force(latitudes, longitudes, latitude, longitude, k, radius):
+    return rank_by_distance(latitude, longitude, latitudes, longitudes, k, radius)[0]
+
+
+class Command(BaseCommand):
+    help = (
+        'Seeds synthetic stops into the database and times nearest_stops() on them, the path the '
+        'duplicate check and the nearby-stops endpoint take. --compare also times the same grid '
+        'lookup in memory and a full haversine scan, to separate database cost from ranking cost.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--stops', type=int, default=200000)
+        parser.add_argument('--cities', type=int, default=500)
+        parser.add_argument('--queries', type=int, default=500)
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--compare', action='store_true', help='Also time in-memory grid and full-scan lookups')
+        parser.add_argument('--keep', action='store_true', help='Keep the seeded stops afterwards')
+        parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+
+    def measure(self, search, points, k, radius):
+        timings = []
+        found = 0
+        for latitude, longitude in points:
+            started = time.perf_counter()
+            hits = search(latitude, longitude, k, radius)
+            timings.append((time.perf_counter() - started) * 1000)
+            found += len(hits) > 0
+        return {
+            'p50_ms': round(percentile(timings, 0.5), 3),
+            'p95_ms': round(percentile(timings, 0.95), 3),
+            'max_ms': round(max(timings), 3),
+            'found': found,
+        }
+
+    def handle(self, *args, **options):
+        latitudes, longitudes = synthetic_stops(options['stops'], options['cities'], options['seed'])
+
+        clear_stops()
+        started = time.perf_counter()
+        seed_stops(latitudes, longitudes)
+        seed_seconds = time.perf_counter() - started
+        try:
+            results, cells = self.run_searches(latitudes, longitudes, options)
+        finally:
+            if not options['keep']:
+                clear_stops()
+
+        if options['json']:
+            self.stdout.write(json.dumps({
+                'vendor': connection.vendor,
+                'stops': options['stops'],
+                'cells': cells,
+                'seed_seconds': round(seed_seconds, 2),
+                'results': results,
+            }))
+            return
+
+        self.stdout.write(
+            f'{options["stops"]} stops in {cells} cells on {connection.vendor}, seeded in {seed_seconds:.2f}s'
+        )
+        self.stdout.write(f'{"query":>10} {"mode":>10} {"p50 ms":>8} {"p95 ms":>8} {"max ms":>8} {"found":>6}')
+        for result in results:
+            self.stdout.write(
+                f'{result["query"]:>10} {result["mode"]:>10} {result["p50_ms"]:>8} '
+                f'{result["p95_ms"]:>8} {result["max_ms"]:>8} {result["found"]:>6}'
+            )
+
+    def run_searches(self, latitudes, longitudes, options):
+        # Query from just beside existing stops, as a duplicate check or a rider at a stop would
+        rng = np.random.default_rng(options['seed'] + 1)
+        picks = rng.integers(0, options['stops'], options['queries'])
+        points = list(zip(latitudes[picks] + rng.normal(0, 0.00003, len(picks)),
+                          longitudes[picks] + rng.normal(0, 0.00003, len(picks))))
+
+        index = GridIndex(latitudes, longitudes)
+        searches = [('database', nearest_stops)]
+        if options['compare']:
+            searches.append(('in_memory', index.nearest))
+            searches.append(('full_scan', lambda lat, lng, k, radius: brute_force(
+                latitudes, longitudes, lat, lng, k, radius
+            )))
+
+        results = []
+        for query, k, radius in [('duplicate', 1, DUPLICATE_RADIUS_M), ('near_me', DEFAULT_K, DEFAULT_RADIUS_M)]:
+            for mode, search in searches:
+                results.append(dict(query=query, mode=mode, **self.measure(search, points, k, radius)))
+        return results, len(index.cells)
@@ -0,0 +1,202 @@
+import asyncio
+import json
+import random
+import threading
+import time
+from django.conf import settings
+from django.core.asgi import get_asgi_application
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.test import override_settings
+from django.urls import reverse
+from django.utils.module_loading import import_string
+from bookbus.models import OutboundEmail, PassengerOTP
+from bookbus.utils.email_utils import deliver_pending, mail_session
+from bookbus.utils.mail_stub import MailStubServer
+from .bench import client_host
+from .bench_connections import percentile
+
+TAG = 'bench-otp'
+# How long to wait after a run for the worker to empty the outbox
+DRAIN_SECONDS = 30
+
+
+async def asgi_request(app, method, path, body=b'', content_type=None):
+    """Sends one request straight to the ASGI application and returns the status code"""
+    headers = [(b'host', client_host().encode())]
+    if content_type:
+        headers.append((b'content-type', content_type.encode()))
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': method,
+        'scheme': 'http', 'path': path, 'raw_path': path.encode(), 'query_string': b'',
+        'headers': headers, 'client': ('127.0.0.1', 0), 'server': ('127.0.0.1', 80),
+    }
+    request_sent = asyncio.Event()
+    status = []
+
+    async def receive():
+        if not request_sent.is_set():
+            request_sent.set()
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+        # Never disconnects; the application returns once the response is sent
+        await asyncio.Future()
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            status.append(message['status'])
+
+    await app(scope, receive, send)
+    return status[0]
+
+
+def sync_only_middleware():
+    """MIDDLEWARE entries that make Django run the whole stack, async views included, in a thread"""
+    return [path for path in settings.MIDDLEWARE if not getattr(import_string(path), 'async_capable', False)]
+
+
+class EmailWorker(threading.Thread):
+    """run_email_worker in a thread, polling often so the delivery delay is the mail API's"""
+
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.stopped = threading.Event()
+
+    def run(self):
+        session = mail_session()
+        try:
+            while not self.stopped.is_set():
+                sent, failed = deliver_pending(session)
+                if not (sent or failed):
+                    self.stopped.wait(0.05)
+        finally:
+            session.close()
+            connection.close()
+
+
+class Command(BaseCommand):
+    help = (
+        'Measures page throughput and OTP delivery while the mail API is slow. For each --latencies value it '
+        'runs the mail stub (see run_mail_stub) with that latency and the email worker against it, then drives '
+        'the ASGI application in-process, as the uvicorn workers run it, with --concurrency clients: most load '
+        'the home page, the rest request OTPs. An OTP is timed twice: the request, which only adds the email '
+        'to the outbox, and the delivery, from the request to the stub accepting the message. The delivery '
+        'follows the latency; page throughput and the OTP request should not.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--latencies', type=float, nargs='+', default=[0.0, 2.0], help='Mail API latencies, in seconds')
+        parser.add_argument('--seconds', type=float, default=10.0, help='How long each run lasts')
+        parser.add_argument('--concurrency', type=int, default=20)
+        parser.add_argument('--otp-share', type=float, default=0.2, help='Fraction of requests that ask for an OTP')
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+
+    def handle(self, *args, **options):
+        blocking = sync_only_middleware()
+        if blocking:
+            raise CommandError(f'Not async-capable, so the OTP views would run in a thread: {", ".join(blocking)}')
+        app = get_asgi_application()
+        results = {'vendor': connection.vendor, 'concurrency': options['concurrency'], 'runs': []}
+        for latency in options['latencies']:
+            self.clean_up()
+            mail_stub = MailStubServer(latency=latency, seed=options['seed'])
+            worker = EmailWorker()
+            with override_settings(MAILJET_API_URL=mail_stub.start()):
+                worker.start()
+                try:
+                    run, requested = asyncio.run(self.drive(app, random.Random(options['seed']), options))
+                    drained = self.wait_for_outbox()
+                finally:
+                    worker.stopped.set()
+                    worker.join()
+                    mail_stub.shutdown()
+                    mail_stub.server_close()
+
+            delays = [
+                accepted - requested[message['To'][0]['Email']]
+                for message, accepted in zip(mail_stub.delivered, mail_stub.delivered_at)
+                if message['To'][0]['Email'] in requested
+            ]
+            run.update(
+                mail_latency=latency,
+                emails_sent=len(delays),
+                outbox_drained=drained,
+                delivery_p50_s=round(percentile(delays, 0.50), 2) if delays else None,
+                delivery_p95_s=round(percentile(delays, 0.95), 2) if delays else None,
+            )
+            results['runs'].append(run)
+            if not options['json']:
+                self.write_run(run)
+        self.clean_up()
+        connections.close_all()
+
+        if options['json']:
+            self.stdout.write(json.dumps(results))
+
+    async def drive(self, app, rng, options):
+        home_url = reverse('bookbus-home')
+        otp_url = reverse('send_passenger_otp')
+        timings = {'page': [], 'otp': []}
+        # OTP email -> time.perf_counter() when it was requested
+        requested = {}
+        errors = [0]
+        sequence = iter(range(10 ** 9))
+        deadline = time.perf_counter() + options['seconds']
+
+        async def client():
+            while time.perf_counter() < deadline:
+                if rng.random() < options['otp_share']:
+                    kind = 'otp'
+                    email = f'{TAG}-{next(sequence)}@example.invalid'
+                    body = json.dumps({'email': email}).encode()
+                    call = asgi_request(app, 'POST', otp_url, body, 'application/json')
+                else:
+                    kind = 'page'
+                    call = asgi_request(app, 'GET', home_url)
+                started = time.perf_counter()
+                if kind == 'otp':
+                    requested[email] = started
+                status = await call
+                timings[kind].append((time.perf_counter() - started) * 1000)
+                errors[0] += status >= 400
+
+        started = time.perf_counter()
+        await asyncio.gather(*(client() for _ in range(options['concurrency'])))
+        elapsed = time.perf_counter() - started
+        return {
+            'seconds': round(elapsed, 2),
+            'pages': len(timings['page']),
+            'pages_per_second': round(len(timings['page']) / elapsed, 1),
+            'page_p50_ms': round(percentile(timings['page'], 0.50), 1) if timings['page'] else None,
+            'page_p95_ms': round(percentile(timings['page'], 0.95), 1) if timings['page'] else None,
+            'otps': len(timings['otp']),
+            'otp_p50_ms': round(percentile(timings['otp'], 0.50), 1) if timings['otp'] else None,
+            'otp_p95_ms': round(percentile(timings['otp'], 0.95), 1) if timings['otp'] else None,
+            'http_errors': errors[0],
+        }, requested
+
+    def wait_for_outbox(self):
+        deadline = time.perf_counter() + DRAIN_SECONDS
+        pending = OutboundEmail.objects.filter(to_email__startswith=f'{TAG}-', status='Pending')
+        while pending.exists():
+            if time.perf_counter() > deadline:
+                return False
+            time.sleep(0.1)
+        return True
+
+    def clean_up(self):
+        OutboundEmail.objects.filter(to_email__startswith=f'{TAG}-').delete()
+        PassengerOTP.objects.filter(email__startswith=f'{TAG}-').delete()
+
+    def write_run(self, run):
+        self.stdout.write(self.style.SUCCESS(f'Mail API latency {run["mail_latency"]}s'))
+        self.stdout.write(
+            f'  pages: {run["pages_per_second"]}/s, p50 {run["page_p50_ms"]} ms, p95 {run["page_p95_ms"]} ms'
+        )
+        self.stdout.write(f'   otps: {run["otps"]}, p50 {run["otp_p50_ms"]} ms, p95 {run["otp_p95_ms"]} ms')
+        self.stdout.write(
+            f' emails: {run["emails_sent"]} sent, requested to accepted p50 {run["delivery_p50_s"]}s, '
+            f'p95 {run["delivery_p95_s"]}s{"" if run["outbox_drained"] else " (outbox not drained)"}'
+        )
+        if run['http_errors']:
+            self.stdout.write(self.style.WARNING(f'  {run["http_errors"]} error responses'))
@@ -0,0 +1,27 @@
+import time
+from django.core.management.base import BaseCommand
+from bookbus.utils.seat_holds import expire_holds
+
+
+class Command(BaseCommand):
+    help = 'Deletes seat holds whose time has run out'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=60.0, help='Seconds between sweeps')
+        parser.add_argument('--once', action='store_true', help='Sweep once and exit')
+
+    def handle(self, *args, **options):
+        total = 0
+        try:
+            while True:
+                expired = expire_holds()
+                total += expired
+                if expired:
+                    self.stdout.write(f'Expired {expired} seat holds')
+                if options['once']:
+                    break
+                time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            pass
+
+        self.stdout.write(self.style.SUCCESS(f'Expired {total} seat holds'))
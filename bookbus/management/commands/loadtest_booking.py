@@ -0,0 +1,299 @@
+import datetime
+import json
+import random
+import threading
+import time
+import uuid
+import requests
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.contrib.auth.models import User
+from django.contrib.sessions.backends.db import SessionStore
+from django.contrib.sessions.models import Session
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand, CommandError
+from django.core.servers.basehttp import ThreadedWSGIServer, WSGIRequestHandler
+from django.core.signals import got_request_exception
+from django.db import IntegrityError, OperationalError, connection, connections
+from django.db.models import F
+from django.urls import reverse
+from django.utils import timezone
+from bookbus.models import Booking, BusStop, OutboundEmail, PassengerOTP, Stop
+from users.models import Profile
+from .bench import client_host
+from .bench_connections import percentile
+from .stress_booking import STOP_COUNT, double_sells, stress_bus
+
+STEPS = ('date', 'select', 'otp', 'confirm')
+
+
+class LoadTestServer(ThreadedWSGIServer):
+    # Every simulated customer may connect at once
+    request_queue_size = 1024
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class ServerErrors:
+    """Counts exceptions raised by views of the in-process server, by kind"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.constraint_violations = 0
+        self.lock_timeouts = 0
+        self.other = 0
+
+    def __call__(self, sender, request=None, **kwargs):
+        exception = kwargs.get('exception')
+        with self.lock:
+            if isinstance(exception, IntegrityError):
+                self.constraint_violations += 1
+            elif isinstance(exception, OperationalError) and 'locked' in str(exception):
+                self.lock_timeouts += 1
+            else:
+                self.other += 1
+
+
+class LockSampler(threading.Thread):
+    """Polls pg_stat_activity for sessions waiting on a lock until stopped"""
+
+    def __init__(self, interval=0.01):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.samples = 0
+        self.waiting_samples = 0
+        self.max_waiting = 0
+
+    def run(self):
+        try:
+            with connection.cursor() as cursor:
+                while not self.stopped.is_set():
+                    cursor.execute(
+                        "SELECT count(*) FROM pg_stat_activity "
+                        "WHERE wait_event_type = 'Lock' AND datname = current_database()"
+                    )
+                    waiting = cursor.fetchone()[0]
+                    self.samples += 1
+                    self.waiting_samples += bool(waiting)
+                    self.max_waiting = max(self.max_waiting, waiting)
+                    self.stopped.wait(self.interval)
+        finally:
+            connection.close()
+
+
+def deadlock_count():
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT deadlocks FROM pg_stat_database WHERE datname = current_database()")
+        return cursor.fetchone()[0]
+
+
+def login_session(user):
+    """A logged-in session for `user`, as Client.force_login() makes, so no password hashing is timed"""
+    session = SessionStore()
+    session[SESSION_KEY] = str(user.pk)
+    session[BACKEND_SESSION_KEY] = 'django.contrib.auth.backends.ModelBackend'
+    session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+    session.create()
+    return session.session_key
+
+
+def latest_otp(email):
+    """The OTP just queued for `email`, read back from the database in place of the mailbox"""
+    return PassengerOTP.objects.filter(email=email, is_verified=False).latest('created_at').otp
+
+
+class Command(BaseCommand):
+    help = (
+        'Runs simulated customers through the whole bus_book flow over HTTP (date, seat selection, OTP, '
+        'confirm) against one throwaway bus, and reports throughput, latency per step, lock waits, '
+        'constraint violations and double-sells. Starts a threaded server in-process unless --url is '
+        'given; OTP emails only reach the outbox and their codes are read from the database, so --url must '
+        'share this database. Use PostgreSQL, or SQLite in WAL mode via SQLITE_PATH.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--customers', type=int, default=20)
+        parser.add_argument('--flows', type=int, default=10, help='Bookings attempted per customer')
+        parser.add_argument('--seats', type=int, default=40, help='Seats on the bus; fewer means more contention')
+        parser.add_argument('--group', type=int, default=3, help='Largest group booked at once')
+        parser.add_argument('--url', help='Base URL of an already running server, e.g. http://127.0.0.1:8000')
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--keep', action='store_true', help='Keep the bus, stops, users and bookings afterwards')
+        parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+
+    def handle(self, *args, **options):
+        if connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                cursor.execute('PRAGMA journal_mode')
+                if cursor.fetchone()[0] != 'wal':
+                    self.stderr.write('SQLite is not in WAL mode; set SQLITE_PATH to use the WAL settings')
+        elif connection.vendor != 'postgresql':
+            raise CommandError(f'Not supported on {connection.vendor}')
+
+        tag, bus = stress_bus(options['seats'])
+        travel_date = timezone.localdate() + datetime.timedelta(days=1)
+        bus_stop_ids = list(BusStop.objects.filter(bus=bus).order_by('stop_order').values_list('id', flat=True))
+        seat_ids = list(bus.seats.values_list('id', flat=True))
+        customers = []
+        for index in range(options['customers']):
+            customer = User.objects.create(username=f'{tag}-customer-{index}')
+            Profile.objects.filter(user=customer).update(coins=F('coins') + 10 ** 6)
+            customers.append(customer)
+        sessions = [login_session(customer) for customer in customers]
+
+        server = errors = None
+        base_url = options['url']
+        if not base_url:
+            server = LoadTestServer(('127.0.0.1', 0), QuietRequestHandler)
+            server.set_app(WSGIHandler())
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            base_url = f'http://127.0.0.1:{server.server_address[1]}'
+            errors = ServerErrors()
+            got_request_exception.connect(errors, dispatch_uid='loadtest_booking')
+        base_url = base_url.rstrip('/')
+        book_url = base_url + reverse('bus-book', kwargs={'pk': bus.pk})
+        otp_url = base_url + reverse('send_passenger_otp')
+
+        sampler = None
+        deadlocks = 0
+        if connection.vendor == 'postgresql':
+            deadlocks = deadlock_count()
+            sampler = LockSampler()
+            sampler.start()
+
+        timings = {step: [] for step in STEPS}
+        counts = {'flows': 0, 'booked': 0, 'refused': 0, 'failed': 0, 'http_errors': 0}
+        lock = threading.Lock()
+        start = threading.Barrier(options['customers'])
+
+        def customer_flows(index):
+            rng = random.Random(options['seed'] + index)
+            http = requests.Session()
+            http.headers['Host'] = client_host()
+            http.cookies.set(settings.SESSION_COOKIE_NAME, sessions[index])
+
+            def step(name, method, url, **kwargs):
+                started = time.perf_counter()
+                response = http.request(method, url, timeout=60, **kwargs)
+                elapsed = (time.perf_counter() - started) * 1000
+                with lock:
+                    timings[name].append(elapsed)
+                    counts['http_errors'] += response.status_code >= 500
+                return response
+
+            # Picks up the CSRF cookie that every POST below has to echo back
+            http.get(book_url, timeout=60)
+            http.headers['X-CSRFToken'] = http.cookies.get(settings.CSRF_COOKIE_NAME, '')
+            start.wait()
+            for flow in range(options['flows']):
+                outcome = 'failed'
+                group = rng.sample(seat_ids, rng.randint(1, min(options['group'], len(seat_ids))))
+                first = rng.randrange(STOP_COUNT - 1)
+                last = rng.randrange(first + 1, STOP_COUNT)
+                try:
+                    step('date', 'POST', book_url, data={'update_date': '1', 'travel_date': travel_date.isoformat()})
+                    page = step('select', 'POST', book_url, data={'select_seats': '1', 'seats': group})
+                    if 'passenger_name_0' not in page.text:
+                        outcome = 'refused'
+                        continue
+
+                    passengers = {'confirm_booking': '1', 'idempotency_key': uuid.uuid4().hex}
+                    for position in range(len(group)):
+                        # Never deliverable, and removed with the rest of the run
+                        email = f'{tag}-{index}-{flow}-{position}@example.invalid'
+                        step('otp', 'POST', otp_url, json={'email': email})
+                        passengers.update({
+                            f'passenger_name_{position}': f'Passenger {index}',
+                            f'passenger_email_{position}': email,
+                            f'passenger_otp_{position}': latest_otp(email),
+                            f'start_stop_{position}': bus_stop_ids[first],
+                            f'end_stop_{position}': bus_stop_ids[last],
+                        })
+                    page = step('confirm', 'POST', book_url, data=passengers)
+                    if page.url.rstrip('/').endswith('/bookings'):
+                        outcome = 'booked'
+                    elif page.status_code < 500:
+                        outcome = 'refused'
+                except (requests.RequestException, PassengerOTP.DoesNotExist):
+                    pass
+                finally:
+                    with lock:
+                        counts['flows'] += 1
+                        counts[outcome] += 1
+            connections.close_all()
+
+        threads = [threading.Thread(target=customer_flows, args=(index,)) for index in range(options['customers'])]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        if sampler:
+            sampler.stopped.set()
+            sampler.join()
+        if server:
+            server.shutdown()
+            server.server_close()
+            got_request_exception.disconnect(dispatch_uid='loadtest_booking')
+
+        seats_booked = Booking.objects.filter(bus=bus, travel_date=travel_date).count()
+        all_timings = [timing for step_timings in timings.values() for timing in step_timings]
+        result = dict(
+            counts,
+            vendor=connection.vendor,
+            customers=options['customers'],
+            seconds=round(elapsed, 2),
+            seats_booked=seats_booked,
+            seats_per_second=round(seats_booked / elapsed, 1) if elapsed else 0,
+            requests_per_second=round(len(all_timings) / elapsed, 1) if elapsed else 0,
+            latency_ms={
+                step: {
+                    'p50': round(percentile(step_timings, 0.50), 1),
+                    'p95': round(percentile(step_timings, 0.95), 1),
+                    'p99': round(percentile(step_timings, 0.99), 1),
+                }
+                for step, step_timings in timings.items() if step_timings
+            },
+            constraint_violations=errors.constraint_violations if errors else None,
+            lock_timeouts=errors.lock_timeouts if errors else None,
+            other_server_errors=errors.other if errors else None,
+            lock_wait_samples=f'{sampler.waiting_samples}/{sampler.samples}' if sampler else None,
+            max_lock_waiters=sampler.max_waiting if sampler else None,
+            deadlocks=deadlock_count() - deadlocks if sampler else None,
+            double_sells=double_sells(bus, travel_date),
+        )
+
+        if not options['keep']:
+            Booking.objects.filter(bus=bus).delete()
+            bus.delete()
+            Stop.objects.filter(city=tag).delete()
+            Session.objects.filter(session_key__in=sessions).delete()
+            User.objects.filter(username__startswith=f'{tag}-').delete()
+            OutboundEmail.objects.filter(to_email__startswith=f'{tag}-').delete()
+            PassengerOTP.objects.filter(email__startswith=f'{tag}-').delete()
+
+        if options['json']:
+            self.stdout.write(json.dumps(result))
+        else:
+            self.stdout.write(
+                f'{result["customers"]} customers on {result["vendor"]}: {result["booked"]} of {result["flows"]} '
+                f'bookings went through ({result["refused"]} refused, {result["failed"]} failed), '
+                f'{seats_booked} seats in {result["seconds"]}s = {result["seats_per_second"]} seats/s, '
+                f'{result["requests_per_second"]} requests/s'
+            )
+            for step, latency in result['latency_ms'].items():
+                self.stdout.write(f'{step:>10}: p50 {latency["p50"]} ms, p95 {latency["p95"]} ms, p99 {latency["p99"]} ms')
+            for key in ('http_errors', 'constraint_violations', 'lock_timeouts', 'other_server_errors',
+                        'lock_wait_samples', 'max_lock_waiters', 'deadlocks'):
+                if result[key] is not None:
+                    self.stdout.write(f'{key:>22}: {result[key]}')
+        if result['double_sells']:
+            raise CommandError(f'{result["double_sells"]} overlapping bookings of the same seat')
+        if not options['json']:
+            self.stdout.write(self.style.SUCCESS('No seat leg was sold twice'))
@@ -0,0 +1,27 @@
+import time
+from django.core.management.base import BaseCommand
+from bookbus.utils.idempotency import IDEMPOTENCY_KEY_TTL_HOURS, purge_keys
+
+
+class Command(BaseCommand):
+    help = f'Deletes idempotency keys older than IDEMPOTENCY_KEY_TTL_HOURS ({IDEMPOTENCY_KEY_TTL_HOURS}h)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=3600.0, help='Seconds between purges')
+        parser.add_argument('--once', action='store_true', help='Purge once and exit')
+
+    def handle(self, *args, **options):
+        total = 0
+        try:
+            while True:
+                purged = purge_keys()
+                total += purged
+                if purged:
+                    self.stdout.write(f'Purged {purged} idempotency keys')
+                if options['once']:
+                    break
+                time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            pass
+
+        self.stdout.write(self.style.SUCCESS(f'Purged {total} idempotency keys'))
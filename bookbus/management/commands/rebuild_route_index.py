@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from bookbus.models import Bus
+from bookbus.utils.route_index import rebuild_route_index
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the stop-pair route index (RouteSegmentIndex) from BusStop rows'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--bus', type=int, nargs='*', help='Only rebuild these bus ids')
+
+    def handle(self, *args, **options):
+        buses = Bus.objects.all()
+        if options['bus']:
+            buses = buses.filter(pk__in=options['bus'])
+
+        total = 0
+        for bus in buses.iterator(chunk_size=500):
+            total += rebuild_route_index(bus)
+
+        self.stdout.write(self.style.SUCCESS(f'Indexed {total} route segments'))
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from bookbus.models import Stop
+from bookbus.utils.geohash import encode_cells
+
+BATCH_SIZE = 5000
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the geohash grid cell of every stop (needed after bulk imports that skip Stop.save)'
+
+    def handle(self, *args, **options):
+        rows = list(Stop.objects.values_list('id', 'latitude', 'longitude', 'grid_cell'))
+        cells = encode_cells([row[1] for row in rows], [row[2] for row in rows]) if rows else []
+        changed = [
+            Stop(pk=pk, grid_cell=cell)
+            for (pk, _, _, current), cell in zip(rows, cells)
+            if cell != current
+        ]
+        Stop.objects.bulk_update(changed, ['grid_cell'], batch_size=BATCH_SIZE)
+        self.stdout.write(self.style.SUCCESS(f'Updated the grid cell of {len(changed)} of {len(rows)} stops'))
@@ -0,0 +1,33 @@
+import time
+from django.core.management.base import BaseCommand
+from bookbus.utils.email_utils import DEFAULT_BATCH_SIZE, deliver_pending, mail_session
+
+
+class Command(BaseCommand):
+    help = 'Sends queued emails from the OutboundEmail outbox through Mailjet'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+        parser.add_argument('--interval', type=float, default=2.0, help='Seconds to sleep when the outbox is empty')
+        parser.add_argument('--once', action='store_true', help='Drain the due emails once and exit')
+
+    def handle(self, *args, **options):
+        session = mail_session()
+        total_sent = total_failed = 0
+        try:
+            while True:
+                sent, failed = deliver_pending(session, options['batch_size'])
+                total_sent += sent
+                total_failed += failed
+                if sent or failed:
+                    self.stdout.write(f'Sent {sent}, failed {failed}')
+                    continue
+                if options['once']:
+                    break
+                time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            pass
+        finally:
+            session.close()
+
+        self.stdout.write(self.style.SUCCESS(f'Sent {total_sent} emails, {total_failed} failed attempts'))
@@ -0,0 +1,48 @@
+import time
+from django.core.management.base import BaseCommand
+from bookbus.utils.export_utils import (
+    EXPORT_CHUNK_SIZE, EXPORT_RETENTION_HOURS, claim_export_job, purge_exports, run_export_job
+)
+
+
+class Command(BaseCommand):
+    help = (
+        'Builds queued booking exports (ExportJob) and stores them under EXPORT_ROOT, deleting exports '
+        f'older than EXPORT_RETENTION_HOURS ({EXPORT_RETENTION_HOURS}h)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=EXPORT_CHUNK_SIZE)
+        parser.add_argument('--interval', type=float, default=1.0, help='Seconds to sleep when no job is queued')
+        parser.add_argument('--purge-interval', type=float, default=3600.0, help='Seconds between purges of old exports')
+        parser.add_argument('--once', action='store_true', help='Run the queued jobs once and exit')
+
+    def handle(self, *args, **options):
+        done = 0
+        next_purge = 0
+        try:
+            while True:
+                if time.monotonic() >= next_purge:
+                    purged = purge_exports()
+                    if purged:
+                        self.stdout.write(f'Purged {purged} old export jobs')
+                    next_purge = time.monotonic() + options['purge_interval']
+
+                job = claim_export_job()
+                if job is None:
+                    if options['once']:
+                        break
+                    time.sleep(options['interval'])
+                    continue
+
+                started = time.perf_counter()
+                run_export_job(job, options['chunk_size'])
+                done += 1
+                self.stdout.write(
+                    f'Export {job.pk}: {job.status} in {time.perf_counter() - started:.2f}s, '
+                    f'{job.rows} rows, {job.sheets_built} sheets built, {job.sheets_reused} reused'
+                )
+        except KeyboardInterrupt:
+            pass
+
+        self.stdout.write(self.style.SUCCESS(f'Ran {done} export jobs'))
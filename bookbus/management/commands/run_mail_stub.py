@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+from bookbus.utils.mail_stub import MailStubServer
+
+
+class Command(BaseCommand):
+    help = 'Runs a local fake of the Mailjet send API for testing the email worker'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8025)
+        parser.add_argument('--latency', type=float, default=0.0, help='Seconds to wait before each response')
+        parser.add_argument('--failure-rate', type=float, default=0.0, help='Fraction of messages to reject')
+        parser.add_argument('--seed', type=int)
+
+    def handle(self, *args, **options):
+        server = MailStubServer(
+            options['host'], options['port'],
+            latency=options['latency'],
+            failure_rate=options['failure_rate'],
+            seed=options['seed'],
+            verbose=True
+        )
+        self.stdout.write(self.style.SUCCESS(f'Mail stub listening on {server.url}'))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            self.stdout.write(f'Handled {server.requests} requests, delivered {len(server.delivered)} messages')
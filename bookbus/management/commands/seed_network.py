@@ -0,0 +1,39 @@
+import json
+import time
+from django.core.management.base import BaseCommand
+from bookbus.utils.synthetic_network import DEFAULT_TAG, clear_network, seed_network
+
+
+class Command(BaseCommand):
+    help = (
+        'Bulk-generates a synthetic network of stops, buses with timetables, seats and past bookings '
+        'from a fixed seed, for benchmarks. Everything it creates is named after --tag.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--stops', type=int, default=2000)
+        parser.add_argument('--buses', type=int, default=500)
+        parser.add_argument('--bookings', type=int, default=20000)
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--tag', default=DEFAULT_TAG, help='Prefix of the generated stop and user names')
+        parser.add_argument('--clear', action='store_true', help='Only delete a network seeded with this tag')
+        parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+
+    def handle(self, *args, **options):
+        removed = clear_network(options['tag'])
+        if options['clear']:
+            self.stdout.write(self.style.SUCCESS(f'Removed {removed} synthetic buses'))
+            return
+
+        started = time.perf_counter()
+        counts = seed_network(
+            options['stops'], options['buses'], options['bookings'], seed=options['seed'], tag=options['tag']
+        )
+        result = dict(counts, seconds=round(time.perf_counter() - started, 2))
+
+        if options['json']:
+            self.stdout.write(json.dumps(result))
+            return
+        for key, value in result.items():
+            self.stdout.write(f'{key:>14}: {value}')
+        self.stdout.write(self.style.SUCCESS(f'Seeded network "{options["tag"]}"'))
@@ -0,0 +1,159 @@
+import datetime
+import json
+import random
+import threading
+import time
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.db.models import F
+from django.utils import timezone
+from bookbus.models import Booking, Bus, BusStop, OutboundEmail, Stop
+from bookbus.utils.booking_service import commit_bookings
+from bookbus.utils.bus_builder import save_bus
+from bookbus.utils.seat_occupancy import INACTIVE_STATUSES, booking_mask, get_route
+from users.models import Profile
+from .bench_connections import percentile
+
+STOP_COUNT = 6
+
+
+def stress_bus(seats):
+    """A throwaway daily bus with its own stops, operator and `seats` general seats"""
+    tag = f'stress-{int(time.time() * 1000)}'
+    operator = User.objects.create(username=f'{tag}-operator')
+    stops = [
+        Stop.objects.create(name=f'{tag} {index}', country='IN', city=tag, latitude=index, longitude=index)
+        for index in range(STOP_COUNT)
+    ]
+    now = timezone.now()
+    bus = Bus(travels=operator, start_time=now, end_time=now + datetime.timedelta(days=30))
+    save_bus(
+        bus,
+        [(stop.pk, datetime.time(8 + index), False) for index, stop in enumerate(stops)],
+        {'General': (seats, 100), 'Sleeper': (0, 0), 'Luxury': (0, 0)}
+    )
+    return tag, bus
+
+
+def double_sells(bus, travel_date):
+    """Pairs of active bookings of the same seat whose legs overlap"""
+    route = get_route(bus.pk)
+    masks = {}
+    overlaps = 0
+    for seat_id, start_stop_id, end_stop_id in Booking.objects.filter(
+        bus=bus, travel_date=travel_date
+    ).exclude(status__in=INACTIVE_STATUSES).values_list('seat_id', 'start_stop_id', 'end_stop_id'):
+        mask = booking_mask(route, start_stop_id, end_stop_id)
+        overlaps += sum(1 for other in masks.get(seat_id, []) if other & mask)
+        masks.setdefault(seat_id, []).append(mask)
+    return overlaps
+
+
+class Command(BaseCommand):
+    help = (
+        'Books overlapping seat groups on one bus from many threads at once and checks that no seat '
+        'leg is sold twice. Creates a throwaway bus and users; run it against PostgreSQL, since SQLite '
+        'has no row locks.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=16)
+        parser.add_argument('--attempts', type=int, default=25, help='Bookings tried per thread')
+        parser.add_argument('--seats', type=int, default=12, help='Seats on the bus; fewer means more contention')
+        parser.add_argument('--group', type=int, default=6, help='Largest group booked at once')
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--keep', action='store_true', help='Keep the bus, stops and users afterwards')
+        parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+
+    def handle(self, *args, **options):
+        if not connection.features.has_select_for_update:
+            self.stderr.write(f'{connection.vendor} has no row locks; results do not reflect production')
+
+        tag, bus = stress_bus(options['seats'])
+        travel_date = timezone.localdate() + datetime.timedelta(days=1)
+        bus_stop_ids = list(BusStop.objects.filter(bus=bus).order_by('stop_order').values_list('id', flat=True))
+        seat_ids = list(bus.seats.values_list('id', flat=True))
+        customers = []
+        for index in range(options['threads']):
+            customer = User.objects.create(username=f'{tag}-customer-{index}')
+            Profile.objects.filter(user=customer).update(coins=F('coins') + 10 ** 6)
+            customers.append(customer)
+
+        timings = []
+        counts = {'booked': 0, 'refused': 0, 'errors': 0}
+        lock = threading.Lock()
+        start = threading.Barrier(options['threads'])
+
+        def worker(index):
+            rng = random.Random(options['seed'] + index)
+            try:
+                start.wait()
+                for _ in range(options['attempts']):
+                    group = rng.sample(seat_ids, rng.randint(1, min(options['group'], len(seat_ids))))
+                    first = rng.randrange(STOP_COUNT - 1)
+                    last = rng.randrange(first + 1, STOP_COUNT)
+                    passengers = [
+                        {
+                            'seat_id': seat_id,
+                            'name': f'Passenger {index}',
+                            # Never deliverable, and removed with the rest of the run
+                            'email': f'{tag}-{index}@example.invalid',
+                            'start_stop': bus_stop_ids[first],
+                            'end_stop': bus_stop_ids[last],
+                        }
+                        for seat_id in group
+                    ]
+                    started = time.perf_counter()
+                    try:
+                        booked = len(commit_bookings(bus, customers[index], travel_date, passengers))
+                        outcome = None
+                    except Exception:
+                        booked, outcome = 0, 'errors'
+                    elapsed = (time.perf_counter() - started) * 1000
+                    with lock:
+                        timings.append(elapsed)
+                        counts['booked'] += booked
+                        counts['refused'] += len(group) - booked if outcome is None else 0
+                        if outcome:
+                            counts[outcome] += 1
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=worker, args=(index,)) for index in range(options['threads'])]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        result = dict(
+            counts,
+            vendor=connection.vendor,
+            threads=options['threads'],
+            seconds=round(elapsed, 2),
+            p50_ms=round(percentile(timings, 0.5), 1),
+            p95_ms=round(percentile(timings, 0.95), 1),
+            double_sells=double_sells(bus, travel_date),
+        )
+
+        if not options['keep']:
+            Booking.objects.filter(bus=bus).delete()
+            bus.delete()
+            Stop.objects.filter(city=tag).delete()
+            User.objects.filter(username__startswith=f'{tag}-').delete()
+            OutboundEmail.objects.filter(to_email__startswith=f'{tag}-').delete()
+
+        if options['json']:
+            self.stdout.write(json.dumps(result))
+        else:
+            self.stdout.write(
+                f'{result["threads"]} threads on {result["vendor"]}: {result["booked"]} seats booked, '
+                f'{result["refused"]} refused, {result["errors"]} failed attempts in {result["seconds"]}s '
+                f'(p50 {result["p50_ms"]} ms, p95 {result["p95_ms"]} ms)'
+            )
+        if result['double_sells']:
+            raise CommandError(f'{result["double_sells"]} overlapping bookings of the same seat')
+        if not options['json']:
+            self.stdout.write(self.style.SUCCESS('No seat leg was sold twice'))
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from bookbus.models import Bus
+from bookbus.utils.trip_utils import sync_trip_occurrences
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the materialized trip dates (TripOccurrence) from each bus schedule'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--bus', type=int, nargs='*', help='Only sync these bus ids')
+
+    def handle(self, *args, **options):
+        buses = Bus.objects.all()
+        if options['bus']:
+            buses = buses.filter(pk__in=options['bus'])
+
+        added = removed = 0
+        for bus in buses.iterator(chunk_size=500):
+            bus_added, bus_removed = sync_trip_occurrences(bus)
+            added += bus_added
+            removed += bus_removed
+
+        self.stdout.write(self.style.SUCCESS(f'Added {added} and removed {removed} trip dates'))
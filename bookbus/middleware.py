@@ -0,0 +1,63 @@
+import logging
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from .utils.metrics import (
+    QUERY_BUDGET_STRICT, UNRESOLVED_ROUTE, QueryBudgetExceeded, count_over_budget, observe, query_budget,
+    track_request
+)
+
+logger = logging.getLogger(__name__)
+
+# Only these fail under QUERY_BUDGET_STRICT; raising after a POST has run would hide work already committed
+STRICT_BUDGET_METHODS = ('GET', 'HEAD')
+BUDGET_HEADER = 'X-Query-Budget-Exceeded'
+
+
+class RequestMetricsMiddleware:
+    """
+    Records query count, DB time, template time and wall time for every
+    request under its URL name (see bookbus/utils/metrics.py), and checks
+    the query count against QUERY_BUDGETS. Goes first in MIDDLEWARE so the
+    session and user lookups are counted too. Over budget, a GET or HEAD
+    fails with QUERY_BUDGET_STRICT; other methods are logged and answered
+    with an X-Query-Budget-Exceeded header, as their work is already done.
+
+    Works in both modes, so under ASGI async views (the seat event stream,
+    the OTP endpoints) run on the event loop instead of in a thread.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        with track_request() as stats:
+            response = self.get_response(request)
+        self.file_stats(request, response, stats)
+        return response
+
+    async def __acall__(self, request):
+        with track_request() as stats:
+            response = await self.get_response(request)
+        self.file_stats(request, response, stats)
+        return response
+
+    def file_stats(self, request, response, stats):
+        match = request.resolver_match
+        route = match.view_name if match else UNRESOLVED_ROUTE
+        observe(route, stats)
+
+        budget = query_budget(route)
+        if budget is not None and stats.queries > budget:
+            count_over_budget(route)
+            logger.warning(
+                '%s %s ran %d SQL queries, over the budget of %d for %s',
+                request.method, request.path, stats.queries, budget, route
+            )
+            if QUERY_BUDGET_STRICT and request.method in STRICT_BUDGET_METHODS:
+                raise QueryBudgetExceeded(f'{route} ran {stats.queries} SQL queries, budget is {budget}')
+            response[BUDGET_HEADER] = f'{stats.queries}/{budget}'
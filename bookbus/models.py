@@ -6,6 +6,7 @@ from django.utils import timezone
 from django.contrib.auth.models import User
 import datetime
 from django_countries.fields import CountryField
+from .utils.geohash import encode_cell
 
 class Stop(models.Model):
     name = models.CharField(max_length=255, unique=True)
@@ -13,12 +14,44 @@ class Stop(models.Model):
     city = models.CharField(max_length=100)
     latitude = models.FloatField(null=False)
     longitude = models.FloatField(null=False)
+    grid_cell = models.CharField(max_length=12, editable=False, default='')
+
+    class Meta:
+        indexes = [
+            # Radius searches read candidates' coordinates straight from the index
+            models.Index(fields=['grid_cell', 'latitude', 'longitude']),
+        ]
 
     def __str__(self):
         return f"{self.name}, {self.city}, {self.country.name}"
+
+    def save(self, *args, **kwargs):
+        self.grid_cell = encode_cell(self.latitude, self.longitude)
+        super().save(*args, **kwargs)
     
     
 
+class BusQuerySet(models.QuerySet):
+    def with_seat_summary(self):
+        """
+        Annotates general_count/general_fare, sleeper_count/sleeper_fare and
+        luxury_count/luxury_fare with conditional aggregates in the same query
+        """
+        annotations = {}
+        for seat_class, _ in Seat.SEAT_CLASSES:
+            in_class = models.Q(seats__seat_class=seat_class)
+            annotations[f'{seat_class.lower()}_count'] = models.Count('seats', filter=in_class, distinct=True)
+            annotations[f'{seat_class.lower()}_fare'] = models.Min('seats__fare', filter=in_class)
+        return self.annotate(**annotations)
+
+    def with_seat_total(self):
+        """Annotates seat_total with a correlated count, so it adds no join or GROUP BY"""
+        seats = Seat.objects.filter(bus=models.OuterRef('pk')).order_by().values('bus').annotate(
+            total=models.Count('id')
+        ).values('total')
+        return self.annotate(seat_total=models.functions.Coalesce(models.Subquery(seats), 0))
+
+
 class Bus(models.Model):
     DAY_CHOICES = [
         (0, 'Monday'),
@@ -56,6 +89,14 @@ class Bus(models.Model):
         related_name='ending_buses'
     )
 
+    objects = BusQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # Keyset pagination of search results walks (start_time, id)
+            models.Index(fields=['start_time', 'id']),
+        ]
+
     def __str__(self):
         return f"Bus by {self.travels} from {self.journey_start} to {self.journey_end}"
 
@@ -63,17 +104,37 @@ class Bus(models.Model):
     def is_recurring(self):
         return bool(self.operating_days)
     
+    def seat_summary(self):
+        """
+        {seat_class: (count, fare)}, read from the with_seat_summary() annotations
+        when present, otherwise with one aggregate query
+        """
+        if not hasattr(self, 'general_count'):
+            summary = Bus.objects.filter(pk=self.pk).with_seat_summary().values(
+                *[f'{seat_class.lower()}_{field}' for seat_class, _ in Seat.SEAT_CLASSES for field in ('count', 'fare')]
+            ).first() or {}
+            for name, value in summary.items():
+                setattr(self, name, value)
+
+        return {
+            seat_class: (
+                getattr(self, f'{seat_class.lower()}_count', 0) or 0,
+                getattr(self, f'{seat_class.lower()}_fare', 0) or 0
+            )
+            for seat_class, _ in Seat.SEAT_CLASSES
+        }
+
     @property
     def general_seats(self):
-        return self.seats.filter(seat_class="General").count()
+        return self.seat_summary()['General'][0]
     
     @property
     def sleeper_seats(self):
-        return self.seats.filter(seat_class="Sleeper").count()
+        return self.seat_summary()['Sleeper'][0]
     
     @property
     def luxury_seats(self):
-        return self.seats.filter(seat_class="Luxury").count()
+        return self.seat_summary()['Luxury'][0]
     
     def runs_on_date(self, date):
         """Check if bus runs on specific date considering both recurring and date range"""
@@ -141,6 +202,38 @@ class BusStop(models.Model):
         return f"{time_str} (+1 day)" if self.is_next_day else time_str
 
 
+class RouteSegmentIndex(models.Model):
+    """A stop pair (from -> to) served by a bus, denormalized from its BusStop rows"""
+    bus = models.ForeignKey(Bus, on_delete=models.CASCADE, related_name="route_segments")
+    from_stop = models.ForeignKey(Stop, on_delete=models.CASCADE, related_name="+")
+    to_stop = models.ForeignKey(Stop, on_delete=models.CASCADE, related_name="+")
+    from_order = models.PositiveIntegerField()
+    to_order = models.PositiveIntegerField()
+    departure_offset = models.PositiveIntegerField(help_text="Minutes from the first stop to from_stop")
+    duration = models.PositiveIntegerField(help_text="Minutes from from_stop to to_stop")
+
+    class Meta:
+        unique_together = [("bus", "from_order", "to_order")]
+        indexes = [models.Index(fields=["from_stop", "to_stop", "bus"])]
+
+    def __str__(self):
+        return f"{self.bus}: {self.from_stop} -> {self.to_stop}"
+
+
+class TripOccurrence(models.Model):
+    """A single date on which a bus runs, materialized from its schedule"""
+    bus = models.ForeignKey(Bus, on_delete=models.CASCADE, related_name="trips")
+    service_date = models.DateField()
+
+    class Meta:
+        unique_together = [("bus", "service_date")]
+        indexes = [models.Index(fields=["service_date", "bus"])]
+        ordering = ["service_date"]
+
+    def __str__(self):
+        return f"{self.bus} on {self.service_date}"
+
+
 class Seat(models.Model):
     SEAT_CLASSES = [
         ("General", "General"),
@@ -189,31 +282,44 @@ class Booking(models.Model):
     
     class Meta:
         ordering = ['-date_booked']
+        # A seat can be sold once per leg of the route. Two active bookings of the
+        # same seat that board (or alight) at the same stop always share a leg, so
+        # these catch double-sells in the database; partial overlaps are prevented
+        # by the leg-mask check made while the seat row is locked.
         constraints = [
             models.UniqueConstraint(
-                fields=['bus', 'seat', 'travel_date'],
+                fields=['bus', 'seat', 'travel_date', 'start_stop'],
                 name='unique_active_booking',
                 condition=models.Q(status__in=['Pending', 'Confirmed', 'Completed'])
+            ),
+            models.UniqueConstraint(
+                fields=['bus', 'seat', 'travel_date', 'end_stop'],
+                name='unique_active_booking_end',
+                condition=models.Q(status__in=['Pending', 'Confirmed', 'Completed'])
             )
         ]
+        # Seat maps, seat counts and page ETags all read one bus's bookings on one date
+        indexes = [
+            models.Index(fields=['bus', 'travel_date']),
+        ]
 
     @classmethod
-    def add_booking(cls, bus, customer, seat, start_stop, end_stop):
-        """Prevents overlapping seat bookings."""
-        overlapping_bookings = cls.objects.filter(
-            bus=bus, 
-            seat=seat
-        ).exclude(
-            status__in=['Cancelled', 'Refunded']
-        ).filter(
-            models.Q(start_stop__stop_order__lt=end_stop.stop_order, 
-                    end_stop__stop_order__gt=start_stop.stop_order)
-        )
+    def add_booking(cls, bus, customer, seat, start_stop, end_stop, travel_date, **fields):
+        """Books a seat between two stops, refusing segments that overlap an existing booking."""
+        from .utils.seat_occupancy import get_route, segment_mask, seat_conflicts
 
-        if overlapping_bookings.exists():
+        route = get_route(bus.pk)
+        wanted = segment_mask(route, start_stop.pk, end_stop.pk)
+        if wanted is None:
+            raise ValueError(f'{start_stop} to {end_stop} is not a segment of this route!')
+
+        if seat_conflicts(bus.pk, travel_date, {seat.pk: wanted}, route):
             raise ValueError(f'Seat {seat} is already booked for this route segment!')
 
-        return cls.objects.create(bus=bus, customer=customer, seat=seat, start_stop=start_stop, end_stop=end_stop)
+        return cls.objects.create(
+            bus=bus, customer=customer, seat=seat, start_stop=start_stop, end_stop=end_stop,
+            travel_date=travel_date, **fields
+        )
 
     def __str__(self):
         return f'Booking: {self.customer} - {self.seat} on {self.bus} ({self.start_stop} → {self.end_stop})'
@@ -226,13 +332,6 @@ class Booking(models.Model):
             except (ValueError, TypeError):
                 pass
         
-        # Update seat status based on booking status
-        if self.status == 'Confirmed':
-            self.seat.status = 'Booked'
-        elif self.status in ['Cancelled', 'Refunded']:
-            self.seat.status = 'Available'
-        self.seat.save()
-        
         # Mark as completed if travel date passed
         if isinstance(self.travel_date, datetime.date) and self.travel_date < timezone.now().date() and self.status not in ['Cancelled', 'Refunded']:
             self.status = 'Completed'
@@ -244,4 +343,107 @@ class PassengerOTP(models.Model):
     otp = models.CharField(max_length=6)
     created_at = models.DateTimeField(auto_now_add=True)
     is_verified = models.BooleanField(default=False)
-    booking = models.ForeignKey('Booking', on_delete=models.CASCADE, null=True, blank=True)
\ No newline at end of file
+    booking = models.ForeignKey('Booking', on_delete=models.CASCADE, null=True, blank=True)
+
+class OutboundEmail(models.Model):
+    """Transactional outbox: emails are written here and sent by run_email_worker"""
+    STATUS_CHOICES = [
+        ('Pending', 'Pending'),
+        ('Sent', 'Sent'),
+        ('Failed', 'Failed'),
+    ]
+
+    to_email = models.EmailField()
+    to_name = models.CharField(max_length=100, blank=True)
+    subject = models.CharField(max_length=255)
+    text_body = models.TextField()
+    html_body = models.TextField(blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='Pending')
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['created_at']
+        indexes = [models.Index(fields=['status', 'next_attempt_at'])]
+
+    def __str__(self):
+        return f"{self.subject} to {self.to_email} ({self.status})"
+
+
+class ExportJob(models.Model):
+    """An operator's bookings export, built by run_export_worker and stored under EXPORT_ROOT"""
+    STATUS_CHOICES = [
+        ('Pending', 'Pending'),
+        ('Running', 'Running'),
+        ('Done', 'Done'),
+        ('Failed', 'Failed'),
+    ]
+
+    operator = models.ForeignKey(User, on_delete=models.CASCADE, related_name='export_jobs')
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='Pending')
+    watermark = models.CharField(max_length=64, blank=True)
+    file_path = models.CharField(max_length=255, blank=True)
+    rows = models.PositiveIntegerField(default=0)
+    sheets_built = models.PositiveIntegerField(default=0)
+    sheets_reused = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [models.Index(fields=['status', 'created_at'])]
+
+    def __str__(self):
+        return f"Export {self.pk} for {self.operator} ({self.status})"
+
+
+class SeatHold(models.Model):
+    """
+    A seat set aside for one booking session between seat selection and
+    payment, until expires_at. Expired holds are ignored and swept by
+    expire_seat_holds.
+    """
+    bus = models.ForeignKey(Bus, on_delete=models.CASCADE, related_name='seat_holds')
+    seat = models.ForeignKey(Seat, on_delete=models.CASCADE, related_name='holds')
+    start_stop = models.ForeignKey(Stop, on_delete=models.CASCADE, related_name='+')
+    end_stop = models.ForeignKey(Stop, on_delete=models.CASCADE, related_name='+')
+    travel_date = models.DateField()
+    holder = models.CharField(max_length=40, help_text="Session key of the booking session")
+    expires_at = models.DateTimeField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['bus', 'travel_date', 'expires_at']),
+            models.Index(fields=['holder']),
+            models.Index(fields=['expires_at']),
+        ]
+
+    def __str__(self):
+        return f"Hold on {self.seat} for {self.travel_date} until {self.expires_at}"
+
+
+class IdempotencyKey(models.Model):
+    """
+    A client token seen on a state-changing POST and the redirect it was
+    answered with, replayed if the same POST arrives again. status_code is
+    null while the first request is still running.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='idempotency_keys')
+    key = models.CharField(max_length=64)
+    status_code = models.PositiveSmallIntegerField(null=True, blank=True)
+    location = models.CharField(max_length=255, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'key'], name='unique_idempotency_key'),
+        ]
+
+    def __str__(self):
+        return f"{self.key} for {self.user} ({self.status_code or 'in progress'})"
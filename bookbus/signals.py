@@ -0,0 +1,84 @@
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import QuerySet
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from .models import Booking, Bus, BusStop, Seat, Stop
+from .utils.bus_cache import bump_bus_versions, bump_stop_buses
+from .utils.trip_utils import sync_trip_occurrences
+from .utils.seat_occupancy import invalidate_occupancy
+from .utils.connection_search import bump_timetable_version
+from .utils.stop_search import bump_stop_index_version
+
+
+@receiver(post_save, sender=Bus)
+def update_trip_occurrences(sender, instance, raw=False, **kwargs):
+    """
+    Keep the materialized trip dates in step with the bus schedule
+    """
+    if raw:
+        return
+    sync_trip_occurrences(instance)
+
+
+@receiver(post_save, sender=Bus)
+@receiver(post_delete, sender=Bus)
+@receiver(post_save, sender=BusStop)
+@receiver(post_delete, sender=BusStop)
+def invalidate_timetable(sender, **kwargs):
+    """
+    Any schedule change makes the in-memory connection timetables stale
+    """
+    bump_timetable_version()
+
+
+@receiver(post_save, sender=Stop)
+@receiver(post_delete, sender=Stop)
+def invalidate_stop_index(sender, **kwargs):
+    """
+    New, renamed or deleted stops make the in-memory search indexes stale
+    """
+    bump_stop_index_version()
+
+
+@receiver(post_save, sender=Bus)
+@receiver(post_delete, sender=Bus)
+@receiver(post_save, sender=BusStop)
+@receiver(post_delete, sender=BusStop)
+@receiver(post_save, sender=Seat)
+@receiver(post_delete, sender=Seat)
+def invalidate_bus_fragments(sender, instance, origin=None, **kwargs):
+    """
+    The bus's cached route and seat blocks are stale. save_bus() always saves
+    the Bus itself, so its bulk stop and seat writes are covered too. A
+    deleted bus gets a new version as well, so the ETags handed out for its
+    pages stop matching.
+    """
+    # Stops and seats deleted along with their bus (or its operator) leave nothing to refresh
+    origin_model = origin.model if isinstance(origin, QuerySet) else type(origin)
+    if sender is not Bus and origin_model in (Bus, User):
+        return
+    bus_id = instance.pk if sender is Bus else instance.bus_id
+    transaction.on_commit(lambda: bump_bus_versions([bus_id]))
+
+
+@receiver(post_save, sender=Stop)
+def invalidate_stop_buses(sender, instance, created=False, raw=False, **kwargs):
+    """
+    A renamed stop changes the route blocks of every bus calling at it
+    """
+    if created or raw:
+        return
+    transaction.on_commit(lambda: bump_stop_buses(instance.pk))
+
+
+@receiver(post_delete, sender=Booking)
+def invalidate_booking_occupancy(sender, instance, origin=None, **kwargs):
+    """
+    A deleted booking (from the admin, or with its customer) frees its seat;
+    bookings deleted along with their bus leave no seat map to refresh
+    """
+    origin_model = origin.model if isinstance(origin, QuerySet) else type(origin)
+    if origin_model is Bus:
+        return
+    transaction.on_commit(lambda: invalidate_occupancy(instance.bus_id, instance.travel_date))
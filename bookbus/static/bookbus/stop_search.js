@@ -0,0 +1,126 @@
+// Turns every <select data-stop-search="url"> into a search box that fetches
+// matching stops as the user types. The select stays in the form, hidden,
+// holding only the chosen stop, so it submits exactly as before.
+(function() {
+    const DEBOUNCE_MS = 200;
+
+    function stopLabel(stop) {
+        return `${stop.name}, ${stop.city}`;
+    }
+
+    function setStop(select, stop) {
+        const placeholder = select.dataset.placeholder || '';
+        select.innerHTML = '';
+        if (!select.multiple) select.add(new Option(placeholder, ''));
+        select.add(new Option(stopLabel(stop), stop.id, true, true));
+        select.dispatchEvent(new Event('change'));
+    }
+
+    // A button with data-stop-nearby="url" and data-target="select id" fills
+    // that select with the stop nearest to the browser's location
+    function attachNearby(button) {
+        button.addEventListener('click', function() {
+            if (!navigator.geolocation) return;
+            button.disabled = true;
+            navigator.geolocation.getCurrentPosition(function(position) {
+                const {latitude, longitude} = position.coords;
+                fetch(`${button.dataset.stopNearby}?lat=${latitude}&lng=${longitude}&k=1`)
+                    .then(response => response.json())
+                    .then(data => {
+                        if (data.results && data.results.length) {
+                            setStop(document.getElementById(button.dataset.target), data.results[0]);
+                        } else {
+                            alert('No stops found near you');
+                        }
+                    })
+                    .finally(() => { button.disabled = false; });
+            }, function() { button.disabled = false; });
+        });
+    }
+
+    function attach(select) {
+        const placeholder = select.options.length && !select.options[0].value ? select.options[0].text : '';
+        select.dataset.placeholder = placeholder;
+        const wrapper = document.createElement('div');
+        wrapper.className = 'position-relative';
+
+        const input = document.createElement('input');
+        input.type = 'search';
+        input.className = 'form-control';
+        input.placeholder = placeholder;
+        input.autocomplete = 'off';
+        if (select.id) {
+            input.id = `${select.id}_search`;
+            const label = document.querySelector(`label[for="${select.id}"]`);
+            if (label) label.htmlFor = input.id;
+        }
+
+        const menu = document.createElement('div');
+        menu.className = 'list-group position-absolute w-100 shadow-sm';
+        menu.style.zIndex = 1000;
+
+        select.parentNode.insertBefore(wrapper, select);
+        wrapper.appendChild(input);
+        wrapper.appendChild(menu);
+        wrapper.appendChild(select);
+        select.style.display = 'none';
+
+        function syncInput() {
+            const option = select.options[select.selectedIndex];
+            input.value = option && option.value ? option.text : '';
+        }
+
+        function choose(stop) {
+            menu.innerHTML = '';
+            setStop(select, stop);
+        }
+
+        function show(stops) {
+            menu.innerHTML = '';
+            stops.forEach(stop => {
+                const item = document.createElement('button');
+                item.type = 'button';
+                item.className = 'list-group-item list-group-item-action';
+                item.textContent = stopLabel(stop);
+                item.addEventListener('mousedown', event => {
+                    event.preventDefault();
+                    choose(stop);
+                });
+                menu.appendChild(item);
+            });
+        }
+
+        let timer = null;
+        let latest = 0;
+        input.addEventListener('input', function() {
+            clearTimeout(timer);
+            const query = input.value.trim();
+            if (!query) {
+                select.value = '';
+                menu.innerHTML = '';
+                return;
+            }
+            timer = setTimeout(function() {
+                const request = ++latest;
+                fetch(`${select.dataset.stopSearch}?q=${encodeURIComponent(query)}`)
+                    .then(response => response.json())
+                    .then(data => {
+                        // Ignore responses that arrive after a newer query
+                        if (request === latest) show(data.results);
+                    })
+                    .catch(() => { menu.innerHTML = ''; });
+            }, DEBOUNCE_MS);
+        });
+        input.addEventListener('blur', function() {
+            menu.innerHTML = '';
+            syncInput();
+        });
+        select.addEventListener('change', syncInput);
+        syncInput();
+    }
+
+    document.addEventListener('DOMContentLoaded', function() {
+        document.querySelectorAll('select[data-stop-search]').forEach(attach);
+        document.querySelectorAll('[data-stop-nearby]').forEach(attachNearby);
+    });
+})();
@@ -1,6 +1,8 @@
 from django import template
 from datetime import timedelta, datetime, date
 from django.template.defaulttags import register
+from django.utils.html import format_html
+from bookbus.utils.idempotency import FIELD_NAME, new_key
 
 register = template.Library()
 
@@ -9,12 +11,12 @@ def get_item(dictionary, key):
     return dict(dictionary).get(int(key))
 
 @register.filter
-def time_since_previous_stop(bus_stop):
+def time_since_previous_stop(bus_stop, stop_list=None):
     try:
-        # Get all stops for this bus route ordered by stop_order
-        stops = bus_stop.bus.busstops.order_by('stop_order')
-        # Find the current stop's position in the queryset
-        stop_list = list(stops)
+        # All stops for this bus route ordered by stop_order; pass them in to avoid a query per stop
+        if stop_list is None:
+            stop_list = list(bus_stop.bus.bus_stops.order_by('stop_order'))
+        # Find the current stop's position in the list
         current_index = stop_list.index(bus_stop)
         if current_index > 0:
             previous_stop = stop_list[current_index - 1]
@@ -60,4 +62,9 @@ def calculate_time_difference(start_stop, end_stop):
 
 @register.filter
 def add(date, days):
-    return date + timedelta(days=days)
\ No newline at end of file
+    return date + timedelta(days=days)
+
+@register.simple_tag
+def idempotency_field():
+    """A hidden one-off token that makes resubmitting the form harmless (see utils/idempotency.py)"""
+    return format_html('<input type="hidden" name="{}" value="{}">', FIELD_NAME, new_key())
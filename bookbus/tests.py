@@ -1,3 +1,1203 @@
-from django.test import TestCase
+import asyncio
+import datetime
+import json
+import os
+import tempfile
+import threading
+from types import SimpleNamespace
+from unittest import mock
+from asgiref.sync import async_to_sync, sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import Group, User
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import F, Prefetch, Sum
+from django.http import HttpResponse, HttpResponseRedirect
+from django.test import (
+    RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings, skipUnlessDBFeature
+)
+from django.urls import reverse
+from django.utils import timezone
+from openpyxl import load_workbook
+from users.models import Profile, Transaction
+from . import middleware
+from .middleware import BUDGET_HEADER, RequestMetricsMiddleware
+from .models import (
+    Booking, Bus, BusStop, ExportJob, IdempotencyKey, OutboundEmail, PassengerOTP, RouteSegmentIndex, Seat, SeatHold,
+    Stop, TripOccurrence
+)
+from .utils.booking_service import commit_bookings
+from .utils.bus_cache import BUS_VERSION_KEY, ROUTE_FRAGMENT, SEATS_FRAGMENT, bus_versions, cached_fragments
+from .utils.bus_builder import save_bus
+from .utils.connection_search import (
+    TIMETABLE_VERSION_KEY, Timetable, bump_timetable_version, find_connections, get_timetable_version
+)
+from .utils.email_utils import (
+    BACKOFF_SECONDS, CLAIM_SECONDS, MAX_ATTEMPTS, deliver_pending, mail_session, queue_email, queue_emails
+)
+from .utils.export_utils import (
+    EXPORT_JOB_TIMEOUT_MINUTES, EXPORT_RETENTION_HOURS, claim_export_job, export_bookings_file, purge_exports,
+    request_export, run_export_job
+)
+from .utils.idempotency import FIELD_NAME, idempotent
+from .utils.mail_stub import MailStubServer
+from .utils.metrics import QueryBudgetExceeded, render_metrics, track_request
+from .utils.nearby_stops import nearest_stops, stop_exists_near
+from .utils.pagination import decode_cursor, keyset_page
+from .utils.route_index import build_route_segments, sync_route_index
+from .utils.seat_holds import expire_holds, hold_seats
+from .utils.seat_events import broker, seat_event_stream
+from .utils.seat_occupancy import booked_seat_counts, leg_mask, seat_map
+from .utils.stop_search import STOP_INDEX_VERSION_KEY, StopIndex, bump_stop_index_version, get_stop_index_version
+from .utils.synthetic_network import clear_network, seed_network
+from .utils.trip_utils import service_dates, sync_trip_occurrences
 
-# Create your tests here.
+LOCMEM_CACHE = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+def make_bus(operator, name='T', fares=(100, 100, 0), n_stops=3):
+    """A bus running every day over `n_stops` new stops, with one General seat per fare"""
+    stops = [
+        Stop.objects.create(
+            name=f'{name} stop {i}', country='IN', city=f'{name} city {i}',
+            latitude=12 + i * 0.1, longitude=77 + i * 0.1
+        )
+        for i in range(n_stops)
+    ]
+    now = timezone.now()
+    bus = Bus.objects.create(
+        travels=operator, start_time=now, end_time=now + datetime.timedelta(days=30),
+        operating_days=list(range(7)), journey_start=stops[0], journey_end=stops[-1]
+    )
+    bus_stops = [
+        BusStop.objects.create(bus=bus, stop=stop, stop_order=i, arrival_time=datetime.time(8 + i, 0))
+        for i, stop in enumerate(stops, 1)
+    ]
+    seats = [
+        Seat.objects.create(bus=bus, name=f'G{i}', seat_class='General', fare=fare)
+        for i, fare in enumerate(fares, 1)
+    ]
+    return bus, bus_stops, seats
+
+
+def add_coins(user, coins):
+    Profile.objects.filter(user=user).update(coins=F('coins') + coins)
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class BookingTransactionTests(TransactionTestCase):
+    """
+    Bookings, holds and the ledger with real commits, so the on_commit
+    invalidations of the cached seat map run as they do in production.
+    """
+
+    def setUp(self):
+        self.operator = User.objects.create_user('operator', password='x')
+        self.customer = User.objects.create_user('customer', password='x')
+        self.other = User.objects.create_user('other', password='x')
+        self.bus, self.bus_stops, self.seats = make_bus(self.operator)
+        self.travel_date = timezone.localdate() + datetime.timedelta(days=1)
+        add_coins(self.customer, 1000)
+        add_coins(self.other, 1000)
+
+    def passenger(self, seat, start=0, end=-1):
+        return {
+            'seat_id': seat.pk, 'name': 'Passenger', 'email': 'passenger@example.com',
+            'start_stop': self.bus_stops[start].pk, 'end_stop': self.bus_stops[end].pk,
+        }
+
+    def stop_ids(self):
+        return self.bus_stops[0].stop_id, self.bus_stops[-1].stop_id
+
+    def book(self, customer, seats, **segment):
+        return commit_bookings(
+            self.bus, customer, self.travel_date, [self.passenger(seat, **segment) for seat in seats]
+        )
+
+    def booked(self):
+        return {seat['name'] for seat in seat_map(self.bus.pk, self.travel_date) if seat['is_booked']}
+
+    def test_seat_is_not_sold_twice(self):
+        self.assertEqual(len(self.book(self.customer, [self.seats[0]])), 1)
+        self.assertEqual(self.book(self.other, [self.seats[0]]), [])
+        # A group with one taken seat still gets the free one
+        self.assertEqual([booking.seat for booking in self.book(self.other, self.seats[:2])], [self.seats[1]])
+
+        self.assertEqual(Booking.objects.filter(seat=self.seats[0], status='Confirmed').count(), 1)
+        self.assertEqual(Profile.objects.get(user=self.other).coins, 900)
+        self.assertEqual(self.booked(), {'G1', 'G2'})
+
+    def test_disjoint_legs_share_a_seat(self):
+        self.assertEqual(len(self.book(self.customer, [self.seats[0]], start=0, end=1)), 1)
+        self.assertEqual(len(self.book(self.other, [self.seats[0]], start=1, end=2)), 1)
+        self.assertEqual(self.book(self.other, [self.seats[0]], start=0, end=2), [])
+
+    @skipUnlessDBFeature('has_select_for_update')
+    def test_concurrent_bookings_sell_a_seat_once(self):
+        barrier = threading.Barrier(4)
+        made = []
+
+        def attempt(customer):
+            try:
+                barrier.wait()
+                made.extend(self.book(customer, [self.seats[0]]))
+            finally:
+                connection.close()
+
+        customers = [self.customer, self.other] + [
+            User.objects.create_user(f'rush{i}', password='x') for i in range(2)
+        ]
+        for customer in customers[2:]:
+            add_coins(customer, 1000)
+        threads = [threading.Thread(target=attempt, args=(customer,)) for customer in customers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(made), 1)
+        self.assertEqual(Booking.objects.filter(seat=self.seats[0]).count(), 1)
+        self.assertEqual(Transaction.objects.filter(transaction_type='BOOKING').count(), 1)
+        self.assertEqual(Profile.objects.filter(user__in=customers).aggregate(total=Sum('coins'))['total'], 3900)
+
+    def test_hold_blocks_other_sessions_until_it_expires(self):
+        self.assertEqual(hold_seats(self.bus, self.travel_date, [self.seats[0].pk], *self.stop_ids(), 'first'), [])
+        self.assertEqual(
+            hold_seats(self.bus, self.travel_date, [self.seats[0].pk, self.seats[1].pk], *self.stop_ids(), 'second'),
+            ['G1']
+        )
+        # Nothing is held when any seat clashes
+        self.assertFalse(SeatHold.objects.filter(holder='second').exists())
+
+        held = {seat['name'] for seat in seat_map(self.bus.pk, self.travel_date, holder='second') if seat['is_held']}
+        self.assertEqual(held, {'G1'})
+        self.assertEqual(
+            commit_bookings(self.bus, self.other, self.travel_date, [self.passenger(self.seats[0])], holder='second'),
+            []
+        )
+
+        SeatHold.objects.update(expires_at=timezone.now() - datetime.timedelta(seconds=1))
+        # An expired hold no longer counts, even before it is deleted
+        self.assertEqual(hold_seats(self.bus, self.travel_date, [self.seats[0].pk], *self.stop_ids(), 'second'), [])
+        self.assertEqual(expire_holds(), 1)
+        self.assertEqual(list(SeatHold.objects.values_list('holder', flat=True)), ['second'])
+
+    def test_booking_releases_the_holders_own_holds(self):
+        hold_seats(self.bus, self.travel_date, [self.seats[0].pk], *self.stop_ids(), 'mine')
+        bookings = commit_bookings(
+            self.bus, self.customer, self.travel_date, [self.passenger(self.seats[0])], holder='mine'
+        )
+        self.assertEqual(len(bookings), 1)
+        self.assertFalse(SeatHold.objects.exists())
+
+    def test_balances_after_booking_and_cancelling(self):
+        self.book(self.customer, self.seats)
+        self.assertEqual(Profile.objects.get(user=self.customer).coins, 800)
+        self.assertEqual(Profile.objects.get(user=self.operator).balance, 200)
+        self.assertEqual(Transaction.objects.filter(user=self.customer, transaction_type='BOOKING').count(), 3)
+        self.assertEqual(self.booked(), {'G1', 'G2', 'G3'})
+
+        self.client.force_login(self.customer)
+        for booking in Booking.objects.filter(customer=self.customer).order_by('pk'):
+            response = self.client.post(reverse('cancel-booking', kwargs={'pk': booking.pk}))
+            self.assertEqual(response.status_code, 302)
+
+        self.assertEqual(Booking.objects.filter(status='Cancelled').count(), 3)
+        self.assertEqual(Profile.objects.get(user=self.customer).coins, 1000)
+        self.assertEqual(Profile.objects.get(user=self.operator).balance, 0)
+        refunds = Transaction.objects.filter(user=self.customer, transaction_type='CANCELLATION')
+        self.assertEqual(sorted(refunds.values_list('amount', flat=True)), [0, 100, 100])
+        self.assertEqual(self.booked(), set())
+
+    def test_zero_fare_seat_books_without_coins(self):
+        poor = User.objects.create_user('poor', password='x')
+        bookings = self.book(poor, [self.seats[2]])
+        self.assertEqual(len(bookings), 1)
+        self.assertEqual(Profile.objects.get(user=poor).coins, 0)
+        self.assertEqual(list(Transaction.objects.filter(user=poor).values_list('amount', flat=True)), [0])
+
+    def test_unaffordable_group_books_nothing(self):
+        poor = User.objects.create_user('poor', password='x')
+        add_coins(poor, 150)
+        with self.assertRaises(ValueError):
+            self.book(poor, self.seats)
+        self.assertFalse(Booking.objects.exists())
+        self.assertFalse(Transaction.objects.exists())
+        self.assertEqual(Profile.objects.get(user=poor).coins, 150)
+        self.assertEqual(self.booked(), set())
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class ExportJobTests(TestCase):
+    def setUp(self):
+        export_root = tempfile.TemporaryDirectory()
+        self.addCleanup(export_root.cleanup)
+        export_settings = override_settings(EXPORT_ROOT=export_root.name)
+        export_settings.enable()
+        self.addCleanup(export_settings.disable)
+        self.operator = User.objects.create_user('operator', password='x')
+        customer = User.objects.create_user('customer', password='x')
+        self.bus, bus_stops, self.seats = make_bus(self.operator)
+        Booking.objects.create(
+            bus=self.bus, customer=customer, seat=self.seats[0], start_stop=bus_stops[0].stop,
+            end_stop=bus_stops[-1].stop, travel_date=timezone.localdate(), passenger_name='Passenger',
+            passenger_email='passenger@example.com', status='Confirmed'
+        )
+
+    def export(self):
+        return run_export_job(request_export(self.operator))
+
+    def test_renames_invalidate_the_export(self):
+        first = self.export()
+        self.assertEqual((first.status, first.sheets_built), ('Done', 1))
+        self.assertEqual(request_export(self.operator), first)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.seats[0].name = 'W1'
+            self.seats[0].save()
+        second = request_export(self.operator)
+        self.assertNotEqual(second, first)
+        self.assertEqual(run_export_job(second).sheets_built, 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            stop = self.bus.journey_start
+            stop.name = 'Renamed stop'
+            stop.save()
+        self.assertNotEqual(request_export(self.operator), second)
+
+    def test_purge_deletes_old_jobs_and_unshared_files(self):
+        old = self.export()
+        # Nothing changed, so this job hands out the old job's workbook
+        shared = run_export_job(ExportJob.objects.create(operator=self.operator))
+        self.assertEqual(shared.file_path, old.file_path)
+        ExportJob.objects.filter(pk=old.pk).update(
+            finished_at=timezone.now() - datetime.timedelta(hours=EXPORT_RETENTION_HOURS + 1)
+        )
+
+        self.assertEqual(purge_exports(), 1)
+        self.assertFalse(ExportJob.objects.filter(pk=old.pk).exists())
+        self.assertTrue(os.path.exists(shared.file_path))
+
+        later = timezone.now() + datetime.timedelta(hours=EXPORT_RETENTION_HOURS + 1)
+        self.assertEqual(purge_exports(now=later), 1)
+        self.assertFalse(os.path.exists(shared.file_path))
+        self.assertEqual(os.listdir(os.path.join(settings.EXPORT_ROOT, 'fragments')), [])
+
+    def test_job_of_a_dead_worker_is_passed_by_and_failed(self):
+        abandoned = request_export(self.operator)
+        self.assertEqual(claim_export_job(), abandoned)
+        self.assertEqual(request_export(self.operator), abandoned)
+
+        ExportJob.objects.filter(pk=abandoned.pk).update(
+            started_at=timezone.now() - datetime.timedelta(minutes=EXPORT_JOB_TIMEOUT_MINUTES + 1)
+        )
+        fresh = request_export(self.operator)
+        self.assertNotEqual(fresh, abandoned)
+        self.assertEqual(fresh.status, 'Pending')
+
+        purge_exports()
+        abandoned.refresh_from_db()
+        self.assertEqual(abandoned.status, 'Failed')
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class SeatCountTests(TestCase):
+    def setUp(self):
+        self.operator = User.objects.create_user('operator', password='x')
+        self.bus, self.bus_stops, self.seats = make_bus(self.operator, fares=(100, 100, 100))
+        self.stops = [(bus_stop.stop_id, bus_stop.arrival_time, False) for bus_stop in self.bus_stops]
+
+    def book(self, seat, status):
+        return Booking.objects.create(
+            bus=self.bus, customer=self.operator, seat=seat, start_stop=self.bus_stops[0].stop,
+            end_stop=self.bus_stops[-1].stop, travel_date=timezone.localdate(), passenger_name='Passenger',
+            passenger_email='passenger@example.com', status=status
+        )
+
+    def save(self, general_count):
+        save_bus(self.bus, self.stops, {'General': (general_count, 100), 'Sleeper': (0, 0), 'Luxury': (0, 0)})
+
+    def test_seats_with_open_bookings_are_not_removed(self):
+        booking = self.book(self.seats[1], 'Confirmed')
+        with self.assertRaisesMessage(ValueError, 'G2'):
+            self.save(1)
+        self.assertEqual(Seat.objects.filter(bus=self.bus).count(), 3)
+        self.assertTrue(Booking.objects.filter(pk=booking.pk).exists())
+
+        # Above the highest booked seat is fine
+        self.save(2)
+        self.assertEqual(sorted(Seat.objects.filter(bus=self.bus).values_list('name', flat=True)), ['G1', 'G2'])
+
+    def test_seats_with_only_cancelled_bookings_are_removed(self):
+        self.book(self.seats[2], 'Cancelled')
+        self.save(2)
+        self.assertFalse(Seat.objects.filter(pk=self.seats[2].pk).exists())
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class SyntheticNetworkTests(TestCase):
+    today = datetime.date(2025, 6, 2)
+
+    def seed(self, seed):
+        counts = seed_network(30, 9, 80, seed=seed, today=self.today, tag='unit')
+        stops = list(Stop.objects.filter(name__startswith='unit stop ').order_by('name').values_list(
+            'name', 'city', 'latitude', 'longitude'
+        ))
+        timetables = [
+            [(bus_stop.stop.name, bus_stop.arrival_time, bus_stop.is_next_day) for bus_stop in bus.bus_stops.all()]
+            for bus in Bus.objects.filter(travels__username__startswith='unit-').order_by('pk').prefetch_related(
+                Prefetch('bus_stops', queryset=BusStop.objects.select_related('stop').order_by('stop_order'))
+            )
+        ]
+        bookings = list(Booking.objects.filter(bus__travels__username__startswith='unit-').order_by('pk').values_list(
+            'seat__name', 'start_stop__name', 'end_stop__name', 'travel_date', 'status', 'customer__username'
+        ))
+        return counts, stops, timetables, bookings
+
+    def test_same_seed_same_network(self):
+        first = self.seed(7)
+        self.assertEqual(clear_network('unit'), 9)
+        self.assertFalse(Stop.objects.filter(name__startswith='unit stop ').exists())
+        self.assertEqual(self.seed(7), first)
+        clear_network('unit')
+        self.assertNotEqual(self.seed(8)[1], first[1])
+
+    def test_derived_rows_match_the_buses(self):
+        counts, _, timetables, _ = self.seed(7)
+        self.assertEqual(counts['buses'], 9)
+        self.assertEqual(counts['bus_stops'], sum(len(timetable) for timetable in timetables))
+        self.assertEqual(RouteSegmentIndex.objects.count(), sum(
+            len(timetable) * (len(timetable) - 1) // 2 for timetable in timetables
+        ))
+        self.assertEqual(TripOccurrence.objects.count(), counts['trips'])
+
+        # No two live bookings share a leg of a seat
+        taken = {}
+        for booking in Booking.objects.exclude(status='Cancelled').select_related('seat'):
+            stop_ids = list(BusStop.objects.filter(bus_id=booking.bus_id).order_by('stop_order').values_list(
+                'stop_id', flat=True
+            ))
+            legs = set(range(stop_ids.index(booking.start_stop_id), stop_ids.index(booking.end_stop_id)))
+            key = (booking.seat_id, booking.travel_date)
+            self.assertFalse(taken.get(key, set()) & legs)
+            taken.setdefault(key, set()).update(legs)
+
+
+class SearchResultsTests(TestCase):
+    """Keyset pages of the home search and the booked seat counts shown on them"""
+
+    def setUp(self):
+        operator = User.objects.create_user('operator', password='x')
+        stops = [
+            Stop.objects.create(name=f'Stop {i}', country='IN', city='City', latitude=12 + i, longitude=77)
+            for i in range(2)
+        ]
+        start = timezone.now().replace(microsecond=0)
+        # Two pairs share a start_time, so the id has to break the tie
+        for hours in (0, 1, 1, 2, 3, 3, 4):
+            Bus.objects.create(
+                travels=operator, start_time=start + datetime.timedelta(hours=hours),
+                end_time=start + datetime.timedelta(days=30), journey_start=stops[0], journey_end=stops[1]
+            )
+        self.expected = list(Bus.objects.order_by('-start_time', '-pk'))
+
+    def test_pages_forward_and_back(self):
+        pages = [keyset_page(Bus.objects.all(), page_size=3)]
+        while pages[-1].has_next:
+            pages.append(keyset_page(Bus.objects.all(), after=pages[-1].next_cursor, page_size=3))
+
+        self.assertEqual([len(page) for page in pages], [3, 3, 1])
+        self.assertEqual([bus for page in pages for bus in page], self.expected)
+        self.assertFalse(pages[0].has_previous)
+        self.assertTrue(pages[-1].has_previous)
+
+        back = keyset_page(Bus.objects.all(), before=pages[-1].previous_cursor, page_size=3)
+        self.assertEqual(list(back), list(pages[1]))
+        self.assertTrue(back.has_next)
+        self.assertTrue(back.has_previous)
+        first = keyset_page(Bus.objects.all(), before=back.previous_cursor, page_size=3)
+        self.assertEqual(list(first), list(pages[0]))
+        self.assertFalse(first.has_previous)
+
+    def test_bad_cursor_is_the_first_page(self):
+        self.assertIsNone(decode_cursor('not a cursor'))
+        self.assertEqual(list(keyset_page(Bus.objects.all(), after='not a cursor', page_size=3)), self.expected[:3])
+
+    def test_no_rows(self):
+        page = keyset_page(Bus.objects.none())
+        self.assertEqual(len(page), 0)
+        self.assertFalse(page.has_other_pages)
+
+    def test_booked_seat_counts(self):
+        customer = User.objects.create_user('customer', password='x')
+        bus, bus_stops, seats = make_bus(User.objects.get(username='operator'), name='Counted')
+        travel_date = timezone.localdate()
+        for seat, status, legs in [
+            (seats[0], 'Confirmed', (0, 1)), (seats[0], 'Confirmed', (1, 2)),
+            (seats[1], 'Cancelled', (0, 2)), (seats[2], 'Pending', (0, 2)),
+        ]:
+            Booking.objects.create(
+                bus=bus, customer=customer, seat=seat, start_stop=bus_stops[legs[0]].stop,
+                end_stop=bus_stops[legs[1]].stop, travel_date=travel_date, passenger_name='Passenger',
+                passenger_email='passenger@example.com', status=status
+            )
+        other = Bus.objects.exclude(pk=bus.pk).first()
+        # A seat booked on two legs counts once, a cancelled one not at all
+        self.assertEqual(booked_seat_counts([bus.pk, other.pk], travel_date), {bus.pk: 2})
+        self.assertEqual(booked_seat_counts([bus.pk], travel_date + datetime.timedelta(days=1)), {})
+
+
+class ConnectionSearchTests(SimpleTestCase):
+    """RAPTOR over a hand-made timetable: stops 1 to 5, times in minutes from midnight"""
+    travel_date = datetime.date(2025, 6, 2)  # a Monday
+
+    def timetable(self, *trips):
+        first_day = self.travel_date - datetime.timedelta(days=30)
+        last_day = self.travel_date + datetime.timedelta(days=30)
+        return Timetable([
+            (bus_id, first_day, last_day, days, stops, times) for bus_id, days, stops, times in trips
+        ])
+
+    def setUp(self):
+        self.trips = [
+            (1, [], [1, 2, 3], [480, 540, 600]),  # 08:00 1 -> 10:00 3
+            (2, [], [3, 4], [630, 690]),  # 10:30 3 -> 11:30 4
+            (3, [], [1, 4], [540, 780]),  # 09:00 1 -> 13:00 4, direct
+        ]
+
+    def legs(self, journey):
+        return [(leg.bus_id, leg.from_stop_id, leg.to_stop_id, leg.departure.time()) for leg in journey.legs]
+
+    def test_direct_and_faster_transfer(self):
+        journeys = self.timetable(*self.trips).search(1, 4, self.travel_date)
+        self.assertEqual([self.legs(journey) for journey in journeys], [
+            [(3, 1, 4, datetime.time(9, 0))],
+            [(1, 1, 3, datetime.time(8, 0)), (2, 3, 4, datetime.time(10, 30))],
+        ])
+        self.assertEqual(journeys[1].transfers, 1)
+        self.assertEqual(journeys[1].arrival, datetime.datetime(2025, 6, 2, 11, 30))
+
+    def test_transfer_needs_the_minimum_connection_time(self):
+        journeys = self.timetable(*self.trips).search(1, 4, self.travel_date, min_transfer=45)
+        self.assertEqual([self.legs(journey) for journey in journeys], [[(3, 1, 4, datetime.time(9, 0))]])
+
+    def test_departure_time_and_operating_days(self):
+        timetable = self.timetable(*self.trips)
+        self.assertEqual(timetable.search(1, 4, self.travel_date, departure=8 * 60 + 30)[0].legs[0].bus_id, 3)
+        # Past the last departure, the next day's trips are offered
+        late = timetable.search(1, 4, self.travel_date, departure=10 * 60)
+        self.assertEqual(late[0].departure, datetime.datetime(2025, 6, 3, 9, 0))
+        self.assertEqual(late[0].legs[0].service_date, datetime.date(2025, 6, 3))
+
+        # The transfer bus does not run on Mondays
+        trips = self.trips[:1] + [(2, [1, 2, 3, 4, 5, 6], [3, 4], [630, 690])] + self.trips[2:]
+        journeys = self.timetable(*trips).search(1, 4, self.travel_date)
+        self.assertEqual([journey.legs[0].bus_id for journey in journeys], [3])
+
+    def test_overnight_trip_arrives_next_day(self):
+        journeys = self.timetable((1, [], [1, 5], [1380, 1530])).search(1, 5, self.travel_date)
+        self.assertEqual(journeys[0].arrival, datetime.datetime(2025, 6, 3, 1, 30))
+        self.assertEqual(journeys[0].legs[0].service_date, self.travel_date)
+
+    def test_transfer_limit_and_unknown_stops(self):
+        timetable = self.timetable(*self.trips[:2])
+        self.assertEqual(timetable.search(1, 4, self.travel_date, max_transfers=0), [])
+        self.assertEqual(len(timetable.search(1, 4, self.travel_date, max_transfers=1)), 1)
+        self.assertEqual(timetable.search(99, 4, self.travel_date), [])
+        self.assertEqual(timetable.search(1, 1, self.travel_date), [])
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class TimetableVersionTests(TestCase):
+    def test_evicted_counter_never_comes_back_at_an_old_value(self):
+        seen = {get_timetable_version()}
+        bump_timetable_version()
+        seen.add(get_timetable_version())
+        cache.delete(TIMETABLE_VERSION_KEY)
+        self.assertNotIn(get_timetable_version(), seen)
+        cache.delete(TIMETABLE_VERSION_KEY)
+        bump_timetable_version()
+        self.assertNotIn(get_timetable_version(), seen)
+
+    def test_timetable_reloads_after_a_stop_time_changes(self):
+        operator = User.objects.create_user('operator', password='x')
+        with self.captureOnCommitCallbacks(execute=True):
+            bus, bus_stops, _ = make_bus(operator)
+        travel_date = timezone.localdate() + datetime.timedelta(days=1)
+        journeys = find_connections(bus_stops[0].stop_id, bus_stops[2].stop_id, travel_date)
+        self.assertEqual(journeys[0].departure.time(), datetime.time(9, 0))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            bus_stops[0].arrival_time = datetime.time(8, 30)
+            bus_stops[0].save()
+        journeys = find_connections(bus_stops[0].stop_id, bus_stops[2].stop_id, travel_date)
+        self.assertEqual(journeys[0].departure.time(), datetime.time(8, 30))
+
+
+class StopIndexTests(SimpleTestCase):
+    def setUp(self):
+        self.index = StopIndex([
+            (1, 'Majestic Bus Stand', 'Bengaluru', 'IN'),
+            (2, 'Mysore Road', 'Bengaluru', 'IN'),
+            (3, 'Central Station', 'Mysuru', 'IN'),
+            (4, 'São Paulo Terminal', 'Mumbai', 'IN'),
+        ])
+
+    def ids(self, query, limit=10):
+        return [stop['id'] for stop in self.index.search(query, limit)]
+
+    def test_name_start_ranks_before_later_word_and_city(self):
+        self.assertEqual(self.ids('my'), [2, 3])
+        self.assertEqual(self.ids('m'), [1, 2, 4, 3])
+
+    def test_matches_ignore_case_accents_and_punctuation(self):
+        self.assertEqual(self.ids('SAO-paulo'), [4])
+        self.assertEqual(self.ids('bus stand'), [1])
+
+    def test_limit_and_empty_query(self):
+        self.assertEqual(self.ids('m', limit=2), [1, 2])
+        self.assertEqual(self.ids('  '), [])
+        self.assertEqual(self.ids('xyz'), [])
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class StopSearchViewTests(TestCase):
+    def test_new_stop_is_searchable_and_limit_is_clamped(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            for i in range(30):
+                Stop.objects.create(name=f'Ring Road {i}', city='Pune', country='IN', latitude=18, longitude=73)
+        response = self.client.get(reverse('stop-search'), {'q': 'ring', 'limit': 100})
+        self.assertEqual(len(response.json()['results']), 25)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Stop.objects.create(name='Riverside', city='Pune', country='IN', latitude=18, longitude=73)
+        response = self.client.get(reverse('stop-search'), {'q': 'river', 'limit': 'x'})
+        self.assertEqual([stop['name'] for stop in response.json()['results']], ['Riverside'])
+
+    def test_evicted_counter_never_comes_back_at_an_old_value(self):
+        seen = {get_stop_index_version()}
+        bump_stop_index_version()
+        seen.add(get_stop_index_version())
+        cache.delete(STOP_INDEX_VERSION_KEY)
+        self.assertNotIn(get_stop_index_version(), seen)
+
+
+class NearestStopsTests(TestCase):
+    def setUp(self):
+        # About 111 m per 0.001 degree of latitude
+        for name, offset in [('Here', 0), ('Near', 0.001), ('Nearer', 0.0005), ('Far', 0.02)]:
+            Stop.objects.create(name=name, country='IN', city='City', latitude=12.9716 + offset, longitude=77.5946)
+
+    def test_nearest_first_within_radius(self):
+        stops = nearest_stops(12.9716, 77.5946, k=10, radius=500)
+        self.assertEqual([stop['name'] for stop in stops], ['Here', 'Nearer', 'Near'])
+        self.assertEqual(stops[0]['distance'], 0)
+        self.assertAlmostEqual(stops[2]['distance'], 111.2, delta=1)
+
+    def test_k_and_far_stops(self):
+        self.assertEqual([stop['name'] for stop in nearest_stops(12.9716, 77.5946, k=2)], ['Here', 'Nearer'])
+        self.assertEqual([stop['name'] for stop in nearest_stops(12.9916, 77.5946, radius=100)], ['Far'])
+        self.assertEqual(nearest_stops(13.5, 77.5946), [])
+
+    def test_duplicate_check(self):
+        self.assertTrue(stop_exists_near(12.97161, 77.5946))
+        self.assertFalse(stop_exists_near(12.9730, 77.5946))
+
+
+class IdempotencyTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('customer', password='x')
+        self.factory = RequestFactory()
+        self.calls = []
+
+        @idempotent('confirm_booking')
+        def view(request):
+            self.calls.append(request.POST.get('seat'))
+            if request.POST.get('seat') == 'taken':
+                return HttpResponse('Seat taken', status=200)
+            return HttpResponseRedirect(f'/booked/{len(self.calls)}/')
+        self.view = view
+
+    def post(self, user=None, **data):
+        request = self.factory.post('/book/', data)
+        request.user = user or self.user
+        return self.view(request)
+
+    def test_repeat_replays_the_redirect(self):
+        first = self.post(confirm_booking='1', seat='G1', **{FIELD_NAME: 'token'})
+        repeat = self.post(confirm_booking='1', seat='G1', **{FIELD_NAME: 'token'})
+        self.assertEqual(self.calls, ['G1'])
+        self.assertEqual((repeat.status_code, repeat['Location']), (first.status_code, first['Location']))
+
+        self.post(confirm_booking='1', seat='G2', **{FIELD_NAME: 'other token'})
+        other_user = User.objects.create_user('other', password='x')
+        self.post(other_user, confirm_booking='1', seat='G3', **{FIELD_NAME: 'token'})
+        self.assertEqual(self.calls, ['G1', 'G2', 'G3'])
+
+    def test_answers_that_are_not_redirects_release_the_token(self):
+        self.post(confirm_booking='1', seat='taken', **{FIELD_NAME: 'token'})
+        self.assertFalse(IdempotencyKey.objects.exists())
+        response = self.post(confirm_booking='1', seat='G1', **{FIELD_NAME: 'token'})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(self.calls, ['taken', 'G1'])
+
+    def test_posts_without_token_or_action_always_run(self):
+        self.post(confirm_booking='1', seat='G1')
+        self.post(confirm_booking='1', seat='G1')
+        self.post(select_seats='1', seat='G1', **{FIELD_NAME: 'token'})
+        self.post(select_seats='1', seat='G1', **{FIELD_NAME: 'token'})
+        self.assertEqual(len(self.calls), 4)
+        self.assertFalse(IdempotencyKey.objects.exists())
+
+    def test_repeat_of_a_running_request_is_told_to_retry(self):
+        IdempotencyKey.objects.create(user=self.user, key='token')
+        response = self.post(confirm_booking='1', seat='G1', **{FIELD_NAME: 'token'})
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response['Retry-After'], '1')
+        self.assertEqual(self.calls, [])
+
+
+class DeadWorkerSession:
+    """Stands in for a mail session whose worker dies mid-send"""
+
+    def post(self, *args, **kwargs):
+        raise RuntimeError('Worker died')
+
+
+class OutboxTests(TestCase):
+    def setUp(self):
+        self.stub = MailStubServer(seed=0)
+        url = self.stub.start()
+        self.addCleanup(self.stub.server_close)
+        self.addCleanup(self.stub.shutdown)
+        settings_override = override_settings(MAILJET_API_URL=url)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.session = mail_session()
+        self.addCleanup(self.session.close)
+
+    def test_sends_due_emails_in_batches(self):
+        queue_emails([dict(to_email=f'rider{i}@example.com', subject='Ticket', text_body='Hi') for i in range(5)])
+        later = queue_email('later@example.com', 'Ticket', 'Hi')
+        OutboundEmail.objects.filter(pk=later.pk).update(next_attempt_at=timezone.now() + datetime.timedelta(hours=1))
+
+        self.assertEqual(deliver_pending(self.session, batch_size=2), (2, 0))
+        self.assertEqual(deliver_pending(self.session, batch_size=2), (2, 0))
+        self.assertEqual(deliver_pending(self.session, batch_size=2), (1, 0))
+        self.assertEqual(deliver_pending(self.session, batch_size=2), (0, 0))
+        self.assertEqual(self.stub.requests, 3)
+        self.assertEqual(
+            sorted(message['To'][0]['Email'] for message in self.stub.delivered),
+            [f'rider{i}@example.com' for i in range(5)]
+        )
+        self.assertEqual(OutboundEmail.objects.filter(status='Sent', sent_at__isnull=False).count(), 5)
+        self.assertEqual(OutboundEmail.objects.get(pk=later.pk).status, 'Pending')
+
+    def test_failures_back_off_and_are_retried(self):
+        email = queue_email('rider@example.com', 'Ticket', 'Hi')
+        self.stub.failure_rate = 1.0
+        started = timezone.now()
+        self.assertEqual(deliver_pending(self.session), (0, 1))
+        email.refresh_from_db()
+        self.assertEqual((email.status, email.attempts), ('Pending', 1))
+        self.assertIn('Simulated failure', email.last_error)
+        self.assertGreaterEqual(email.next_attempt_at, started + datetime.timedelta(seconds=BACKOFF_SECONDS))
+        # Not due again until the backoff has passed
+        self.assertEqual(deliver_pending(self.session), (0, 0))
+
+        self.stub.failure_rate = 0.0
+        OutboundEmail.objects.filter(pk=email.pk).update(next_attempt_at=timezone.now())
+        self.assertEqual(deliver_pending(self.session), (1, 0))
+        email.refresh_from_db()
+        self.assertEqual((email.status, email.attempts, email.last_error), ('Sent', 2, ''))
+
+    def test_gives_up_after_max_attempts(self):
+        email = queue_email('rider@example.com', 'Ticket', 'Hi')
+        OutboundEmail.objects.filter(pk=email.pk).update(attempts=MAX_ATTEMPTS - 1)
+        self.stub.failure_rate = 1.0
+        with self.assertLogs('bookbus.utils.email_utils', 'ERROR'):
+            self.assertEqual(deliver_pending(self.session), (0, 1))
+        email.refresh_from_db()
+        self.assertEqual((email.status, email.attempts), ('Failed', MAX_ATTEMPTS))
+
+    def test_claim_of_a_dead_worker_lapses(self):
+        email = queue_email('rider@example.com', 'Ticket', 'Hi')
+        started = timezone.now()
+        with self.assertRaises(RuntimeError):
+            deliver_pending(DeadWorkerSession())
+        email.refresh_from_db()
+        self.assertEqual((email.status, email.attempts), ('Pending', 0))
+        self.assertGreaterEqual(email.next_attempt_at, started + datetime.timedelta(seconds=CLAIM_SECONDS))
+        # Another worker leaves it alone until the claim runs out
+        self.assertEqual(deliver_pending(self.session), (0, 0))
+
+        OutboundEmail.objects.filter(pk=email.pk).update(next_attempt_at=timezone.now())
+        self.assertEqual(deliver_pending(self.session), (1, 0))
+        self.assertEqual(len(self.stub.delivered), 1)
+
+
+def observed_requests(route):
+    """How many requests to `route` this process has filed, from /metrics"""
+    prefix = f'bookbus_request_queries_count{{route="{route}",'
+    for line in render_metrics().splitlines():
+        if line.startswith(prefix):
+            return int(line.rsplit(' ', 1)[1])
+    return 0
+
+
+class RequestMetricsTests(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def respond(self, method, queries):
+        """Runs a request through the middleware; its view runs `queries` SQL queries"""
+        def view(request):
+            for _ in range(queries):
+                User.objects.exists()
+            return HttpResponse('ok')
+
+        request = getattr(self.factory, method)('/buses/1/')
+        request.resolver_match = SimpleNamespace(view_name='bus-detail')
+        return RequestMetricsMiddleware(view)(request)
+
+    def test_queries_count_for_every_open_tracker(self):
+        with track_request() as outer:
+            User.objects.exists()
+            with track_request() as inner:
+                User.objects.exists()
+                User.objects.exists()
+        User.objects.exists()
+        self.assertEqual((outer.queries, inner.queries), (3, 2))
+        self.assertGreater(outer.db_seconds, 0)
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_requests_are_filed_under_their_url_name(self):
+        before = observed_requests('bookbus-home')
+        self.client.get(reverse('bookbus-home'))
+        self.assertEqual(observed_requests('bookbus-home'), before + 1)
+
+        response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer secret')
+        self.assertContains(response, 'bookbus_request_duration_seconds_bucket{route="bookbus-home"')
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+
+    @mock.patch.dict('bookbus.utils.metrics.QUERY_BUDGETS', {'bus-detail': 2})
+    def test_over_budget_is_flagged(self):
+        self.assertFalse(self.respond('get', 2).has_header(BUDGET_HEADER))
+        with self.assertLogs('bookbus.middleware', 'WARNING'):
+            response = self.respond('get', 3)
+        self.assertEqual(response[BUDGET_HEADER], '3/2')
+
+    @mock.patch.dict('bookbus.utils.metrics.QUERY_BUDGETS', {'bus-detail': 2})
+    @mock.patch.object(middleware, 'QUERY_BUDGET_STRICT', True)
+    def test_strict_budget_fails_only_safe_methods(self):
+        with self.assertLogs('bookbus.middleware', 'WARNING'):
+            with self.assertRaises(QueryBudgetExceeded):
+                self.respond('get', 3)
+            with self.assertRaises(QueryBudgetExceeded):
+                self.respond('head', 3)
+            response = self.respond('post', 3)
+        self.assertEqual((response.status_code, response[BUDGET_HEADER]), (200, '3/2'))
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class BusDetailQueryTests(TestCase):
+    def setUp(self):
+        self.bus, _, _ = make_bus(User.objects.create_user('operator', password='x'))
+        self.url = reverse('bus-detail', args=[self.bus.pk])
+
+    def login(self, *groups):
+        user = User.objects.create_user('user', password='x')
+        user.groups.set([Group.objects.get_or_create(name=name)[0] for name in groups])
+        self.client.force_login(user)
+
+    def test_customer_stays_within_budget(self):
+        self.login('Customer')
+        # Stops and seat summary for the route and seat blocks on top of the warm page
+        with self.assertNumQueries(settings.QUERY_BUDGETS['bus-detail']):
+            self.client.get(self.url)
+        # Session, user, bus, and the user's groups once for every check on the page
+        with self.assertNumQueries(4):
+            response = self.client.get(self.url)
+        self.assertContains(response, reverse('bus-book', args=[self.bus.pk]))
+        self.assertNotContains(response, reverse('bus-create'))
+
+    def test_group_links(self):
+        self.login('BusAdmin')
+        response = self.client.get(self.url)
+        self.assertContains(response, reverse('bus-create'))
+        self.assertNotContains(response, reverse('bus-book', args=[self.bus.pk]))
+
+        self.client.logout()
+        response = self.client.get(self.url)
+        self.assertNotContains(response, reverse('bus-create'))
+        self.assertNotContains(response, reverse('bus-book', args=[self.bus.pk]))
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class TripOccurrenceTests(TestCase):
+    def setUp(self):
+        self.bus, _, _ = make_bus(User.objects.create_user('operator', password='x'))
+
+    def trip_dates(self):
+        return set(TripOccurrence.objects.filter(bus=self.bus).values_list('service_date', flat=True))
+
+    def test_saving_a_bus_keeps_its_dates_in_step(self):
+        self.assertEqual(len(self.trip_dates()), 31)
+
+        self.bus.operating_days = [0, 3]
+        self.bus.save()
+        self.assertEqual(self.trip_dates(), set(service_dates(self.bus)))
+        self.assertTrue(all(day.weekday() in (0, 3) for day in self.trip_dates()))
+
+        self.bus.end_time += datetime.timedelta(days=7)
+        # The save above already synced, so only the new week is written
+        self.assertEqual(sync_trip_occurrences(self.bus), (2, 0))
+        self.assertEqual(sync_trip_occurrences(self.bus), (0, 0))
+
+    def test_home_lists_only_buses_running_on_the_date(self):
+        self.bus.operating_days = [0]
+        self.bus.save()
+        monday = timezone.localdate() + datetime.timedelta(days=7 - timezone.localdate().weekday())
+        for day, listed in [(monday, True), (monday + datetime.timedelta(days=1), False)]:
+            response = self.client.get(reverse('bookbus-home'), {'travel_date': day.isoformat()})
+            self.assertEqual(self.bus in response.context['buses'], listed, day)
+
+
+class RouteIndexTests(TestCase):
+    def stops(self, bus_stops):
+        return [(bs.stop_id, bs.stop_order, bs.arrival_time, bs.is_next_day) for bs in bus_stops]
+
+    def test_segments_cover_every_forward_pair(self):
+        stops = [(10, 1, datetime.time(22, 0), False), (11, 2, datetime.time(23, 30), False),
+                 (12, 3, datetime.time(1, 0), True)]
+        segments = build_route_segments(7, stops)
+        self.assertEqual(
+            [(s.from_stop_id, s.to_stop_id, s.departure_offset, s.duration) for s in segments],
+            [(10, 11, 0, 90), (10, 12, 0, 180), (11, 12, 90, 90)]
+        )
+        self.assertEqual(build_route_segments(7, []), [])
+
+    def test_sync_writes_only_what_changed(self):
+        bus, bus_stops, _ = make_bus(User.objects.create_user('operator', password='x'))
+        stops = self.stops(bus_stops)
+        self.assertEqual(sync_route_index(bus.pk, stops), 3)
+        self.assertEqual(sync_route_index(bus.pk, stops), 0)
+
+        # A later last stop changes the two pairs ending there
+        stops[-1] = stops[-1][:2] + (datetime.time(12, 0), False)
+        self.assertEqual(sync_route_index(bus.pk, stops), 2)
+        self.assertEqual(RouteSegmentIndex.objects.get(bus=bus, from_order=1, to_order=3).duration, 180)
+
+        self.assertEqual(sync_route_index(bus.pk, stops[:2]), 2)
+        self.assertEqual(
+            list(RouteSegmentIndex.objects.filter(bus=bus).values_list('from_order', 'to_order')), [(1, 2)]
+        )
+
+    @override_settings(CACHES=LOCMEM_CACHE)
+    def test_home_matches_stop_pairs_in_route_order(self):
+        bus, bus_stops, _ = make_bus(User.objects.create_user('operator', password='x'))
+        sync_route_index(bus.pk, self.stops(bus_stops))
+        first, last = bus_stops[0].stop_id, bus_stops[-1].stop_id
+        for start, end, listed in [(first, last, True), (last, first, False)]:
+            response = self.client.get(reverse('bookbus-home'), {'journey_start': start, 'journey_end': end})
+            self.assertEqual(bus in response.context['buses'], listed)
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class ExportWorkbookTests(TestCase):
+    def setUp(self):
+        self.operator = User.objects.create_user('operator', password='x')
+        self.customer = User.objects.create_user('customer', password='x')
+
+    def book(self, bus, bus_stops, seat, status='Confirmed'):
+        return Booking.objects.create(
+            bus=bus, customer=self.customer, seat=seat, start_stop=bus_stops[0].stop, end_stop=bus_stops[-1].stop,
+            travel_date=timezone.localdate(), passenger_name='Passenger', passenger_email='passenger@example.com',
+            status=status, cancelled_at=timezone.now() if status == 'Cancelled' else None
+        )
+
+    def test_one_sheet_per_bus_read_in_chunks(self):
+        first, first_stops, first_seats = make_bus(self.operator, 'A')
+        second, second_stops, second_seats = make_bus(self.operator, 'B')
+        self.book(first, first_stops, first_seats[0])
+        self.book(first, first_stops, first_seats[1], 'Cancelled')
+        self.book(second, second_stops, second_seats[0])
+
+        # A chunk size of one makes every row its own database fetch
+        workbook = load_workbook(export_bookings_file(self.operator, chunk_size=1))
+        self.assertEqual(workbook.sheetnames, [f'Bus-{first.pk}', f'Bus-{second.pk}'])
+
+        rows = list(workbook[f'Bus-{first.pk}'].values)
+        self.assertEqual(rows[2][0], 'Total Bookings: 2')
+        self.assertEqual(rows[4][:3], ('Booking ID', 'Bus ID', 'Status'))
+        self.assertEqual([row[2] for row in rows[5:7]], ['Confirmed', 'Cancelled'])
+        self.assertEqual(rows[5][12], 'N/A')
+        self.assertEqual(rows[8][:2], ('Confirmed Bookings:', '=COUNTIF(C6:C7,"Confirmed")'))
+        self.assertEqual(len(list(workbook[f'Bus-{second.pk}'].values)), 10)
+
+    def test_operator_without_bookings(self):
+        make_bus(self.operator)
+        workbook = load_workbook(export_bookings_file(self.operator))
+        self.assertEqual(workbook.sheetnames, ['Bookings'])
+        self.assertEqual(workbook['Bookings']['A1'].value, 'No bookings yet')
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class SaveBusTests(TestCase):
+    def setUp(self):
+        self.operator = User.objects.create_user('operator', password='x')
+        self.stop_ids = [
+            Stop.objects.create(name=f'Stop {i}', country='IN', city='City', latitude=12 + i, longitude=77).pk
+            for i in range(4)
+        ]
+        now = timezone.now()
+        self.bus = save_bus(
+            Bus(travels=self.operator, start_time=now, end_time=now + datetime.timedelta(days=7)),
+            self.stops(9, 10, 11), {'General': (2, 100), 'Sleeper': (1, 300), 'Luxury': (0, 0)}
+        )
+
+    def stops(self, *hours):
+        return [(stop_id, datetime.time(hour, 0), False) for stop_id, hour in zip(self.stop_ids, hours)]
+
+    def snapshot(self):
+        return (
+            {order: (pk, time) for pk, order, time in
+             BusStop.objects.filter(bus=self.bus).values_list('pk', 'stop_order', 'arrival_time')},
+            {name: (pk, fare) for pk, name, fare in
+             Seat.objects.filter(bus=self.bus).values_list('pk', 'name', 'fare')},
+        )
+
+    def test_new_bus(self):
+        bus_stops, seats = self.snapshot()
+        self.assertEqual(len(bus_stops), 3)
+        self.assertEqual({name: fare for name, (_, fare) in seats.items()}, {'G1': 100, 'G2': 100, 'S1': 300})
+        self.assertEqual((self.bus.journey_start_id, self.bus.journey_end_id), (self.stop_ids[0], self.stop_ids[2]))
+        self.assertEqual(RouteSegmentIndex.objects.filter(bus=self.bus).count(), 3)
+
+    def test_edit_writes_only_what_changed(self):
+        before_stops, before_seats = self.snapshot()
+        save_bus(self.bus, self.stops(9, 10, 12), {'General': (3, 100), 'Sleeper': (1, 350), 'Luxury': (0, 0)})
+        after_stops, after_seats = self.snapshot()
+
+        # Stops are matched on their order, so the rows keep their ids
+        self.assertEqual({order: pk for order, (pk, _) in after_stops.items()},
+                         {order: pk for order, (pk, _) in before_stops.items()})
+        self.assertEqual(after_stops[3][1], datetime.time(12, 0))
+        self.assertEqual(RouteSegmentIndex.objects.get(bus=self.bus, from_order=1, to_order=3).duration, 180)
+
+        # Existing seats are updated in place and the new one goes at the end of its class
+        self.assertEqual(after_seats['G1'][0], before_seats['G1'][0])
+        self.assertEqual(after_seats['S1'], (before_seats['S1'][0], 350))
+        self.assertEqual(sorted(after_seats), ['G1', 'G2', 'G3', 'S1'])
+
+    def test_route_change_moves_the_journey_ends(self):
+        stops = self.stops(9, 10, 11, 12)
+        save_bus(self.bus, stops, {'General': (2, 100), 'Sleeper': (1, 300), 'Luxury': (0, 0)})
+        self.bus.refresh_from_db()
+        self.assertEqual(self.bus.journey_end_id, self.stop_ids[3])
+        self.assertEqual(RouteSegmentIndex.objects.filter(bus=self.bus).count(), 6)
+
+        save_bus(self.bus, stops[:2], {'General': (2, 100), 'Sleeper': (1, 300), 'Luxury': (0, 0)})
+        self.assertEqual(BusStop.objects.filter(bus=self.bus).count(), 2)
+        self.assertEqual(RouteSegmentIndex.objects.filter(bus=self.bus).count(), 1)
+
+    def test_unknown_stop_is_refused(self):
+        with self.assertRaisesMessage(ValueError, 'no longer exist'):
+            save_bus(self.bus, self.stops(9, 10) + [(0, datetime.time(11, 0), False)],
+                     {'General': (2, 100), 'Sleeper': (1, 300), 'Luxury': (0, 0)})
+        self.assertEqual(BusStop.objects.filter(bus=self.bus).count(), 3)
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class BusFragmentCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        operator = User.objects.create_user('operator', password='x')
+        self.bus, self.bus_stops, self.seats = make_bus(operator, 'A')
+        self.other_bus, _, _ = make_bus(operator, 'B')
+        for bus in (self.bus, self.other_bus):
+            self.client.get(reverse('bus-detail', args=[bus.pk]))
+
+    def cached(self, fragment_name, bus):
+        bus.cache_version = bus_versions([bus.pk])[bus.pk]
+        return bus.pk in cached_fragments(fragment_name, [bus])
+
+    def test_rendered_blocks_are_reused_until_the_bus_changes(self):
+        self.assertTrue(self.cached(ROUTE_FRAGMENT, self.bus))
+        self.assertTrue(self.cached(SEATS_FRAGMENT, self.bus))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Seat.objects.create(bus=self.bus, name='G9', seat_class='General', fare=100)
+        self.assertFalse(self.cached(SEATS_FRAGMENT, self.bus))
+        self.assertTrue(self.cached(SEATS_FRAGMENT, self.other_bus))
+
+    def test_renamed_stop_refreshes_every_bus_calling_there(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            stop = self.bus_stops[0].stop
+            stop.name = 'Renamed stop'
+            stop.save()
+        self.assertFalse(self.cached(ROUTE_FRAGMENT, self.bus))
+        self.assertTrue(self.cached(ROUTE_FRAGMENT, self.other_bus))
+        self.assertContains(self.client.get(reverse('bus-detail', args=[self.bus.pk])), 'Renamed stop')
+
+    def test_evicted_version_starts_from_the_clock(self):
+        version = bus_versions([self.bus.pk])[self.bus.pk]
+        cache.delete(BUS_VERSION_KEY.format(self.bus.pk))
+        self.assertGreater(bus_versions([self.bus.pk])[self.bus.pk], version)
+        self.assertFalse(self.cached(ROUTE_FRAGMENT, self.bus))
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class ConditionalGetTests(TestCase):
+    def setUp(self):
+        self.operator = User.objects.create_user('operator', password='x')
+        self.bus, self.bus_stops, self.seats = make_bus(self.operator)
+        self.detail_url = reverse('bus-detail', args=[self.bus.pk])
+
+    def revalidate(self, url, response):
+        return self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+
+    def test_bus_detail(self):
+        first = self.client.get(self.detail_url)
+        self.assertIn('public', first['Cache-Control'])
+        self.assertEqual(self.revalidate(self.detail_url, first).status_code, 304)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.seats[0].fare = 150
+            self.seats[0].save()
+        changed = self.revalidate(self.detail_url, first)
+        self.assertEqual(changed.status_code, 200)
+        self.assertNotEqual(changed['ETag'], first['ETag'])
+
+        # Signed-in pages carry the user in the tag and stay out of shared caches
+        self.client.force_login(self.operator)
+        mine = self.revalidate(self.detail_url, changed)
+        self.assertEqual(mine.status_code, 200)
+        self.assertIn('private', mine['Cache-Control'])
+
+    def test_home_listing(self):
+        url = reverse('bookbus-home')
+        first = self.client.get(url)
+        self.assertEqual(self.revalidate(url, first).status_code, 304)
+        with self.captureOnCommitCallbacks(execute=True):
+            make_bus(self.operator, 'New')
+        self.assertEqual(self.revalidate(url, first).status_code, 200)
+
+    def test_seat_map_changes_with_bookings_on_the_date(self):
+        customer = User.objects.create_user('customer', password='x')
+        self.client.force_login(customer)
+        travel_date = timezone.localdate() + datetime.timedelta(days=1)
+        session = self.client.session
+        session['booking_data'] = {
+            'selected_seats': [], 'travel_date': travel_date.isoformat(), 'verified_emails': {}, 'sent_otps': {}
+        }
+        session.save()
+        url = reverse('bus-book', args=[self.bus.pk])
+
+        first = self.client.get(url)
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(self.revalidate(url, first).status_code, 304)
+
+        Booking.objects.create(
+            bus=self.bus, customer=self.operator, seat=self.seats[0], start_stop=self.bus_stops[0].stop,
+            end_stop=self.bus_stops[-1].stop, travel_date=travel_date + datetime.timedelta(days=1),
+            passenger_name='Passenger', passenger_email='passenger@example.com', status='Confirmed'
+        )
+        self.assertEqual(self.revalidate(url, first).status_code, 304)
+        Booking.objects.create(
+            bus=self.bus, customer=self.operator, seat=self.seats[0], start_stop=self.bus_stops[0].stop,
+            end_stop=self.bus_stops[-1].stop, travel_date=travel_date, passenger_name='Passenger',
+            passenger_email='passenger@example.com', status='Confirmed'
+        )
+        self.assertEqual(self.revalidate(url, first).status_code, 200)
+
+
+def read_event(text):
+    """(event name, seats) of one Server-Sent Event"""
+    fields = dict(line.split(': ', 1) for line in text.strip().splitlines())
+    return fields['event'], {seat['id']: (seat['booked'], seat['held']) for seat in json.loads(fields['data'])['seats']}
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class SeatEventStreamTests(TransactionTestCase):
+    def setUp(self):
+        self.operator = User.objects.create_user('operator', password='x')
+        self.customer = User.objects.create_user('customer', password='x')
+        add_coins(self.customer, 1000)
+        self.bus, self.bus_stops, self.seats = make_bus(self.operator)
+        self.travel_date = timezone.localdate() + datetime.timedelta(days=1)
+
+    def book(self, seat):
+        return commit_bookings(self.bus, self.customer, self.travel_date, [{
+            'seat_id': seat.pk, 'name': 'Passenger', 'email': 'passenger@example.com',
+            'start_stop': self.bus_stops[0].pk, 'end_stop': self.bus_stops[-1].pk,
+        }])
+
+    def hold(self, seat, holder):
+        return hold_seats(
+            self.bus, self.travel_date, [seat.pk], self.bus_stops[0].stop_id, self.bus_stops[-1].stop_id, holder
+        )
+
+    def test_snapshot_then_only_the_seats_that_changed(self):
+        async def watch():
+            stream = seat_event_stream(self.bus.pk, self.travel_date, leg_mask(0, 2), holder='mine')
+            try:
+                self.assertTrue((await anext(stream)).startswith('retry: '))
+                events = [read_event(await anext(stream))]
+                # Commits in this process wake the stream without waiting for a poll
+                await sync_to_async(self.book)(self.seats[0])
+                events.append(read_event(await asyncio.wait_for(anext(stream), 1)))
+                await sync_to_async(self.hold)(self.seats[1], 'theirs')
+                events.append(read_event(await asyncio.wait_for(anext(stream), 1)))
+                self.assertIn(self.bus.pk, broker._waiters)
+            finally:
+                await stream.aclose()
+            return events
+
+        self.assertEqual(self.hold(self.seats[2], 'mine'), [])
+        snapshot, booked, held = async_to_sync(watch)()
+        self.assertEqual(snapshot, ('snapshot', {seat.pk: (False, False) for seat in self.seats}))
+        self.assertEqual(booked, ('seats', {self.seats[0].pk: (True, False)}))
+        self.assertEqual(held, ('seats', {self.seats[1].pk: (False, True)}))
+        self.assertNotIn(self.bus.pk, broker._waiters)
+
+    def test_view_streams_the_seat_map_of_the_date(self):
+        url = reverse('bus-seat-events', args=[self.bus.pk])
+
+        async def get(**query):
+            response = await self.async_client.get(url, query)
+            if not response.streaming:
+                return response, None
+            stream = aiter(response.streaming_content)
+            try:
+                await anext(stream)
+                return response, read_event((await anext(stream)).decode())
+            finally:
+                await stream.aclose()
+
+        response, _ = async_to_sync(get)()
+        self.assertEqual(response.status_code, 400)
+
+        self.book(self.seats[0])
+        response, snapshot = async_to_sync(get)(
+            date=self.travel_date.isoformat(), start=self.bus_stops[0].pk, end=self.bus_stops[1].pk
+        )
+        self.assertEqual((response['Content-Type'], response['X-Accel-Buffering']), ('text/event-stream', 'no'))
+        booked = {seat.pk: (seat == self.seats[0], False) for seat in self.seats}
+        self.assertEqual(snapshot, ('snapshot', booked))
+
+
+class PassengerOTPTests(TestCase):
+    async def test_otp_is_stored_and_its_email_queued(self):
+        url = reverse('send_passenger_otp')
+        response = await self.async_client.post(url, {'email': 'passenger@example.com'}, content_type='application/json')
+        self.assertEqual(response.json(), {'success': True})
+        otp = await PassengerOTP.objects.aget(email='passenger@example.com')
+        email = await OutboundEmail.objects.aget(to_email='passenger@example.com')
+        self.assertIn(otp.otp, email.text_body)
+
+        response = await self.async_client.post(url, {'email': 'not an email'}, content_type='application/json')
+        self.assertFalse(response.json()['success'])
+        response = await self.async_client.get(url)
+        self.assertEqual(response.json(), {'success': False, 'message': 'Invalid request'})
+        self.assertEqual(await OutboundEmail.objects.acount(), 1)
@@ -10,12 +10,19 @@ urlpatterns = [
     path('bus/new/', bus_views.BusCreateView.as_view(), name="bus-create"),
     path('bus/<int:pk>/update/', bus_views.BusUpdateView.as_view(), name="bus-update"),
     path('bus/<int:pk>/delete/', bus_views.BusDeleteView.as_view(), name="bus-delete"),
+    path('stops/search/', bus_views.stop_search, name='stop-search'),
+    path('stops/nearby/', bus_views.nearby_stops, name='stop-nearby'),
     path('add-stop/', bus_views.StopCreateView.as_view() , name='add-stop'),
     path('bus/<int:pk>/book/', bus_views.bus_book, name='bus-book'),
+    path('bus/<int:pk>/seats/events/', bus_views.seat_events, name='bus-seat-events'),
     path('bus/<int:pk>/passenger-info/', bus_views.passenger_info, name='passenger-info'),
     path('send-passenger-otp/', bus_views.send_passenger_otp, name='send_passenger_otp'),
     path('booking/<int:pk>/cancel/', bus_views.cancel_booking, name='cancel-booking'),
     path('export/', bus_views.ExportBookingsView.as_view(), name='export-view'),
     path('export/excel/', bus_views.ExportBookingsExcelView.as_view(), name='export-excel'),
+    path('export/jobs/', bus_views.ExportJobCreateView.as_view(), name='export-job-create'),
+    path('export/jobs/<int:pk>/', bus_views.ExportJobStatusView.as_view(), name='export-job-status'),
+    path('export/jobs/<int:pk>/download/', bus_views.ExportJobDownloadView.as_view(), name='export-job-download'),
+    path('metrics', bus_views.MetricsView.as_view(), name='metrics'),
     path('about/',bus_views.about, name="bookbus-about")
 ]
\ No newline at end of file
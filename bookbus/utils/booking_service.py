@@ -0,0 +1,126 @@
+"""
+Commits a group booking from bus_book in a fixed number of queries.
+
+All the group's seats are locked with one select_for_update ordered by id,
+so concurrent groups asking for overlapping seats queue on the same rows
+in the same order instead of deadlocking. Stops come from one in_bulk(),
+conflicting bookings and other sessions' holds are each found with one
+query, and the bookings, ledger entries and confirmation emails are all
+bulk inserted. The cached seat map is patched once the transaction
+commits.
+"""
+from django.db import transaction
+from bookbus.models import Booking, BusStop, Seat
+from .email_utils import queue_emails
+from .seat_holds import held_by_others, release_holds
+from .seat_events import publish_seat_change
+from .seat_occupancy import get_route, invalidate_occupancy, seat_conflicts, segment_mask
+from .transaction_utils import post_transactions
+
+
+def booking_email(booking):
+    """Confirmation email for a booking, as queue_emails() arguments"""
+    details = [
+        ('Bus', booking.bus),
+        ('Seat', f'{booking.seat.name} ({booking.seat.seat_class})'),
+        ('Travel Date', booking.travel_date),
+        ('From', booking.start_stop),
+        ('To', booking.end_stop),
+        ('Fare', f'₹{booking.seat.fare}'),
+    ]
+    text_lines = '\n'.join(f'{label}: {value}' for label, value in details)
+    html_items = ''.join(f'<li><strong>{label}:</strong> {value}</li>' for label, value in details)
+    return {
+        'to_email': booking.passenger_email,
+        'to_name': booking.passenger_name,
+        'subject': f'Booking Confirmation - {booking.bus}',
+        'text_body': (
+            f"Dear {booking.passenger_name},\n\n"
+            f"Your booking has been confirmed. Here are your travel details:\n\n"
+            f"{text_lines}\n\n"
+            f"Thank you for choosing our service!"
+        ),
+        'html_body': (
+            f"<h3>Booking Confirmation - {booking.bus}</h3>"
+            f"<p>Dear {booking.passenger_name},</p>"
+            f"<p>Your booking has been confirmed. Here are your travel details:</p>"
+            f"<ul>{html_items}</ul>"
+            f"<p>Thank you for choosing our service!</p>"
+        ),
+    }
+
+
+def _bus_stop_id(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def commit_bookings(bus, customer, travel_date, passengers, holder=None):
+    """
+    Books a group of seats on one bus and date for `customer` and charges
+    them in one transaction. `passengers` is a list of dicts with seat_id,
+    name, email, start_stop and end_stop (BusStop ids). Seats with an invalid
+    segment, an overlapping booking or another session's hold are skipped.
+    Returns the bookings made; raises ValueError, booking nothing, if the
+    customer cannot pay.
+    """
+    route = get_route(bus.pk)
+    bus_stops = BusStop.objects.filter(bus=bus).select_related('stop').in_bulk({
+        bus_stop_id
+        for passenger in passengers
+        for bus_stop_id in (_bus_stop_id(passenger['start_stop']), _bus_stop_id(passenger['end_stop']))
+        if bus_stop_id is not None
+    })
+
+    # seat id -> (passenger, start BusStop, end BusStop, leg mask), first request per seat wins
+    requests = {}
+    for passenger in passengers:
+        start = bus_stops.get(_bus_stop_id(passenger['start_stop']))
+        end = bus_stops.get(_bus_stop_id(passenger['end_stop']))
+        if start is None or end is None or passenger['seat_id'] in requests:
+            continue
+        wanted = segment_mask(route, start.stop_id, end.stop_id)
+        if wanted is not None:
+            requests[passenger['seat_id']] = (passenger, start, end, wanted)
+
+    with transaction.atomic():
+        seats = list(Seat.objects.select_for_update().filter(bus=bus, pk__in=list(requests)).order_by('pk'))
+        wanted = {seat.pk: requests[seat.pk][3] for seat in seats}
+        taken = seat_conflicts(bus.pk, travel_date, wanted, route)
+        if holder:
+            taken |= held_by_others(bus, travel_date, wanted, holder, route)
+
+        bookings = []
+        for seat in seats:
+            if seat.pk in taken:
+                continue
+            passenger, start, end, _ = requests[seat.pk]
+            bookings.append(Booking(
+                bus=bus,
+                customer=customer,
+                seat=seat,
+                start_stop=start.stop,
+                end_stop=end.stop,
+                travel_date=travel_date,
+                passenger_name=passenger['name'],
+                passenger_email=passenger['email'],
+                status='Confirmed'
+            ))
+        if not bookings:
+            return []
+
+        Booking.objects.bulk_create(bookings)
+        post_transactions(customer, 'BOOKING', [
+            (bus.travels, booking.seat.fare, f"Seat {booking.seat.name} booked through {bus.travels}")
+            for booking in bookings
+        ])
+        # Sent by run_email_worker once this transaction commits
+        queue_emails([booking_email(booking) for booking in bookings])
+        if holder:
+            release_holds(bus, holder)
+
+        transaction.on_commit(lambda: invalidate_occupancy(bus.pk, travel_date))
+        transaction.on_commit(lambda: publish_seat_change(bus.pk, travel_date))
+    return bookings
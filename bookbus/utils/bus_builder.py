@@ -0,0 +1,213 @@
+"""
+Creates and edits a bus together with its stops and seats.
+
+BusCreateView and BusUpdateView both go through save_bus(), which checks
+every stop with one in_bulk() and runs in one transaction. A new bus gets
+its stops and seats with bulk_create(). An edited bus is diffed instead:
+stops are matched on stop_order and only the inserts, updates and deletes
+needed are written, a fare change is one UPDATE per seat class, and a
+seat count change adds or removes seats at the end of the class. Seats
+with open bookings are never removed, as their bookings would go with
+them unrefunded; the edit is refused instead. The
+route index and caches are refreshed only for what changed; bulk writes
+skip model signals, so that happens explicitly once the transaction
+commits.
+"""
+import datetime
+from django.db import transaction
+from django.db.models import Count, Max, Min
+from bookbus.models import Booking, BusStop, Seat, Stop
+from .connection_search import bump_timetable_version
+from .route_index import sync_route_index
+from .seat_occupancy import SEAT_CLASSES, invalidate_route, invalidate_seat_layout, natural_sort_key
+
+SEAT_PREFIXES = {'General': 'G', 'Sleeper': 'S', 'Luxury': 'L'}
+# Bookings that still hold their seat; removing the seat would delete them
+OPEN_BOOKING_STATUSES = ('Pending', 'Confirmed')
+
+
+def parse_stops(data):
+    """
+    Reads the stop_order, stop_times and next_day_flags fields posted by the bus form.
+    Returns [(stop_id, arrival_time, is_next_day)] in route order or raises
+    ValueError with a message for the form.
+    """
+    stop_order = [stop_id for stop_id in data.get('stop_order', '').split(',') if stop_id]
+    stop_times = [time for time in data.get('stop_times', '').split(',') if time]
+    next_day_flags = [flag for flag in data.get('next_day_flags', '').split(',') if flag]
+
+    if len(stop_order) < 2:
+        raise ValueError("Please select at least 2 stops")
+
+    if len(stop_order) != len(stop_times) or len(stop_order) != len(next_day_flags):
+        raise ValueError("Invalid stop data")
+
+    stops = []
+    for stop_id, time_str, next_day in zip(stop_order, stop_times, next_day_flags):
+        try:
+            stop_id = int(stop_id)
+        except ValueError:
+            raise ValueError("One or more selected stops no longer exist")
+        try:
+            time_obj = datetime.datetime.strptime(time_str, "%H:%M").time()
+        except ValueError:
+            raise ValueError(f"Invalid time format for stop {stop_id}")
+        stops.append((stop_id, time_obj, next_day == '1'))
+    return stops
+
+
+def seat_config(cleaned_data):
+    """{seat_class: (count, fare)} from the bus form; classes without seats have no fare"""
+    config = {}
+    for seat_class in SEAT_CLASSES:
+        count = cleaned_data[f'{seat_class.lower()}_count']
+        config[seat_class] = (count, cleaned_data[f'{seat_class.lower()}_fare'] if count else 0)
+    return config
+
+
+def current_seat_config(bus):
+    """{seat_class: (count, lowest fare, highest fare)} of a saved bus, in one query"""
+    config = {seat_class: (0, 0, 0) for seat_class in SEAT_CLASSES}
+    for row in Seat.objects.filter(bus=bus).values('seat_class').annotate(
+        count=Count('id'), min_fare=Min('fare'), max_fare=Max('fare')
+    ):
+        config[row['seat_class']] = (row['count'], row['min_fare'], row['max_fare'])
+    return config
+
+
+def seat_name(seat_class, number):
+    return f"{SEAT_PREFIXES[seat_class]}{number}"
+
+
+def build_seats(bus, config):
+    return [
+        Seat(bus=bus, name=seat_name(seat_class, number), seat_class=seat_class, fare=fare)
+        for seat_class, (count, fare) in config.items()
+        for number in range(1, count + 1)
+    ]
+
+
+def sync_seats(bus, seats):
+    """
+    Brings a saved bus's seats in line with `seats` (from seat_config()).
+    Returns True if anything was written; raises ValueError if a seat to be
+    removed has open bookings.
+    """
+    changed = False
+    for seat_class, (current_count, min_fare, max_fare) in current_seat_config(bus).items():
+        count, fare = seats[seat_class]
+
+        if current_count and count and not min_fare == max_fare == fare:
+            Seat.objects.filter(bus=bus, seat_class=seat_class).update(fare=fare)
+            changed = True
+
+        if count != current_count:
+            names = set(Seat.objects.filter(bus=bus, seat_class=seat_class).values_list('name', flat=True))
+            wanted = {seat_name(seat_class, number) for number in range(1, count + 1)}
+            if names - wanted:
+                # Locked like commit_bookings() locks them, so no booking slips in before the delete
+                removed = list(Seat.objects.select_for_update().filter(
+                    bus=bus, seat_class=seat_class, name__in=names - wanted
+                ).order_by('pk').values_list('pk', flat=True))
+                booked = set(Booking.objects.filter(
+                    seat__in=removed, status__in=OPEN_BOOKING_STATUSES
+                ).values_list('seat__name', flat=True))
+                if booked:
+                    booked = sorted(booked, key=lambda name: natural_sort_key(seat_class, name))
+                    raise ValueError(
+                        f"Cannot reduce {seat_class} seats to {count}: {', '.join(booked)} "
+                        f"still have open bookings. Cancel them first."
+                    )
+                Seat.objects.filter(pk__in=removed).delete()
+            Seat.objects.bulk_create([
+                Seat(bus=bus, name=name, seat_class=seat_class, fare=fare)
+                for name in sorted(wanted - names)
+            ])
+            changed = True
+    return changed
+
+
+def sync_bus_stops(bus, stops):
+    """
+    Brings a saved bus's stops in line with `stops` (from parse_stops()),
+    matching rows on stop_order. Returns (stops_changed, route_changed): whether
+    anything was written, and whether the sequence of stops itself changed
+    rather than just arrival times.
+    """
+    wanted = {
+        order: (stop_id, arrival_time, is_next_day)
+        for order, (stop_id, arrival_time, is_next_day) in enumerate(stops, start=1)
+    }
+    existing = {
+        order: (pk, (stop_id, arrival_time, is_next_day))
+        for pk, order, stop_id, arrival_time, is_next_day in BusStop.objects.filter(bus=bus).values_list(
+            'pk', 'stop_order', 'stop_id', 'arrival_time', 'is_next_day'
+        )
+    }
+
+    stale = [pk for order, (pk, _) in existing.items() if order not in wanted]
+    missing = [
+        BusStop(bus=bus, stop_id=stop_id, stop_order=order, arrival_time=arrival_time, is_next_day=is_next_day)
+        for order, (stop_id, arrival_time, is_next_day) in wanted.items()
+        if order not in existing
+    ]
+    changed = []
+    for order, (pk, values) in existing.items():
+        if order in wanted and values != wanted[order]:
+            stop_id, arrival_time, is_next_day = wanted[order]
+            changed.append(BusStop(
+                pk=pk, bus=bus, stop_id=stop_id, stop_order=order, arrival_time=arrival_time, is_next_day=is_next_day
+            ))
+
+    if stale:
+        BusStop.objects.filter(pk__in=stale).delete()
+    if changed:
+        BusStop.objects.bulk_update(changed, ['stop', 'arrival_time', 'is_next_day'])
+    if missing:
+        BusStop.objects.bulk_create(missing)
+
+    route_changed = bool(stale or missing) or any(
+        existing[order][1][0] != wanted[order][0] for order in existing if order in wanted
+    )
+    return bool(stale or changed or missing), route_changed
+
+
+def save_bus(bus, stops, seats):
+    """
+    Saves a new or edited bus with its stops and seats. `stops` comes from
+    parse_stops() and `seats` from seat_config(). Raises ValueError if a stop
+    does not exist.
+    """
+    stop_objects = Stop.objects.in_bulk({stop_id for stop_id, _, _ in stops})
+    if len(stop_objects) != len({stop_id for stop_id, _, _ in stops}):
+        raise ValueError("One or more selected stops no longer exist")
+
+    with transaction.atomic():
+        is_new = bus.pk is None
+        bus.journey_start = stop_objects[stops[0][0]]
+        bus.journey_end = stop_objects[stops[-1][0]]
+        bus.save()
+
+        if is_new:
+            BusStop.objects.bulk_create([
+                BusStop(bus=bus, stop_id=stop_id, stop_order=order, arrival_time=arrival_time, is_next_day=is_next_day)
+                for order, (stop_id, arrival_time, is_next_day) in enumerate(stops, start=1)
+            ])
+            Seat.objects.bulk_create(build_seats(bus, seats))
+            stops_changed = route_changed = seats_changed = True
+        else:
+            stops_changed, route_changed = sync_bus_stops(bus, stops)
+            seats_changed = sync_seats(bus, seats)
+
+        if stops_changed:
+            sync_route_index(bus.pk, [
+                (stop_id, order, arrival_time, is_next_day)
+                for order, (stop_id, arrival_time, is_next_day) in enumerate(stops, start=1)
+            ])
+            transaction.on_commit(bump_timetable_version)
+        if route_changed:
+            transaction.on_commit(lambda: invalidate_route(bus.pk))
+        if seats_changed:
+            transaction.on_commit(lambda: invalidate_seat_layout(bus.pk))
+
+    return bus
@@ -0,0 +1,90 @@
+"""
+Per-bus cache versions for the rendered route and seat blocks.
+
+Every bus has a version counter in the cache. The template fragments that
+show its stops and seats ({% cache %} blocks named in FRAGMENTS) and its
+cached seat total are keyed by that version, so a write to the bus, its
+stops or seats, or a stop on its route only has to bump the counter; the
+old entries are never read again and simply age out.
+
+A missing counter starts from the current time in nanoseconds rather than
+from 1, so a counter evicted by the file-based cache's culling can never
+come back at a value whose stale fragments are still stored.
+"""
+import time
+from django.core.cache import cache
+from django.core.cache.utils import make_template_fragment_key
+from django.db.models import Count
+from bookbus.models import BusStop, Seat
+
+BUS_VERSION_KEY = 'bus_version:{}'
+SEAT_TOTAL_KEY = 'bus_seat_total:{}:{}'
+FRAGMENT_TIMEOUT = 60 * 60 * 24
+# {% cache %} fragment names used by the templates, each varying on (bus.pk, bus.cache_version)
+ROUTE_FRAGMENT = 'bus_route'
+ROUTE_NAMES_FRAGMENT = 'bus_route_names'
+SEATS_FRAGMENT = 'bus_seats'
+
+
+def bus_versions(bus_ids):
+    """{bus_id: version} with one cache read, starting counters that are missing"""
+    keys = {bus_id: BUS_VERSION_KEY.format(bus_id) for bus_id in bus_ids}
+    found = cache.get_many(keys.values())
+    versions = {}
+    for bus_id, key in keys.items():
+        if key not in found:
+            # Another worker may start the same counter at the same moment; whichever add lands wins
+            cache.add(key, time.time_ns(), None)
+            found[key] = cache.get(key)
+        versions[bus_id] = found[key]
+    return versions
+
+
+def bump_bus_versions(bus_ids):
+    """Call after anything shown in a bus's cached blocks changes"""
+    for bus_id in set(bus_ids):
+        key = BUS_VERSION_KEY.format(bus_id)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, time.time_ns(), None)
+
+
+def bump_stop_buses(stop_id):
+    """Call after a stop is renamed; every bus calling at it shows the name"""
+    bump_bus_versions(BusStop.objects.filter(stop_id=stop_id).values_list('bus_id', flat=True))
+
+
+def with_cache_versions(buses):
+    """Sets cache_version on each bus, for the {% cache %} blocks; returns the buses"""
+    versions = bus_versions([bus.pk for bus in buses])
+    for bus in buses:
+        bus.cache_version = versions[bus.pk]
+    return buses
+
+
+def cached_fragments(fragment_name, buses):
+    """Pks of the buses (with cache_version set) whose `fragment_name` block is cached"""
+    keys = {
+        make_template_fragment_key(fragment_name, [bus.pk, bus.cache_version]): bus.pk
+        for bus in buses
+    }
+    return {keys[key] for key in cache.get_many(keys)}
+
+
+def seat_totals(buses):
+    """{bus_id: seat count} for buses with cache_version set, counting only those not cached"""
+    keys = {bus.pk: SEAT_TOTAL_KEY.format(bus.pk, bus.cache_version) for bus in buses}
+    found = cache.get_many(keys.values())
+    totals = {bus_id: found[key] for bus_id, key in keys.items() if key in found}
+
+    missing = [bus_id for bus_id in keys if bus_id not in totals]
+    if missing:
+        counted = dict.fromkeys(missing, 0)
+        counted.update(
+            Seat.objects.filter(bus_id__in=missing).order_by().values('bus_id')
+            .annotate(total=Count('id')).values_list('bus_id', 'total')
+        )
+        cache.set_many({keys[bus_id]: total for bus_id, total in counted.items()}, FRAGMENT_TIMEOUT)
+        totals.update(counted)
+    return totals
@@ -0,0 +1,73 @@
+"""
+ETags for the pages that get reloaded and polled: bus detail, the bus_book
+seat map and the home search.
+
+A page's ETag hashes only values that are cheap to read: the per-bus cache
+versions (see bus_cache), the timetable version, and one indexed aggregate
+over the bookings and live seat holds of a (bus, date). A request whose
+If-None-Match still matches is answered 304 before the context is built or
+the template rendered, so a seat map polled during checkout costs a cache
+read and two small queries.
+
+Pages differ per user (the navbar, the Book button), so the user is part of
+every tag. A page with flash messages waiting gets no tag: showing them
+uses them up. Pages an anonymous visitor sees unfiltered are marked public
+for SHARED_PAGE_MAX_AGE seconds so nginx can serve them from its cache;
+everything else is private and revalidated on every use.
+"""
+import hashlib
+from django.conf import settings
+from django.contrib.messages import get_messages
+from django.db.models import Count, Max
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from bookbus.models import Booking, SeatHold
+
+SHARED_PAGE_MAX_AGE = getattr(settings, 'SHARED_PAGE_MAX_AGE', 30)
+
+
+def page_etag(request, *parts):
+    """A strong ETag over `parts` and the user, or None while messages are waiting"""
+    if len(get_messages(request)):
+        return None
+    digest = hashlib.md5(repr((request.user.pk,) + parts).encode(), usedforsecurity=False)
+    return f'"{digest.hexdigest()}"'
+
+
+def booking_stamp(bus_ids, travel_date):
+    """Changes whenever a booking of one of the buses on the date is made, cancelled or deleted"""
+    stamp = Booking.objects.filter(bus_id__in=list(bus_ids), travel_date=travel_date).aggregate(
+        count=Count('id'), created=Max('created_at'), cancelled=Max('cancelled_at')
+    )
+    return stamp['count'], stamp['created'], stamp['cancelled']
+
+
+def hold_stamp(bus_id, travel_date):
+    """Changes whenever a seat hold on the bus and date is taken, released or runs out"""
+    stamp = SeatHold.objects.filter(
+        bus_id=bus_id, travel_date=travel_date, expires_at__gt=timezone.now()
+    ).aggregate(count=Count('id'), created=Max('created_at'))
+    return stamp['count'], stamp['created']
+
+
+def not_modified(request, etag, shared=False):
+    """A 304 response if the client's copy still matches `etag`, otherwise None"""
+    if etag is None or request.method not in ('GET', 'HEAD'):
+        return None
+    response = get_conditional_response(request, etag=etag)
+    return with_validator(response, etag, shared) if response is not None else None
+
+
+def with_validator(response, etag, shared=False):
+    """
+    Sets the ETag and the caching headers on a page or its 304.
+    `shared` pages may be stored by nginx; the rest only by the browser.
+    """
+    if etag is not None and response.status_code in (200, 304):
+        response.headers.setdefault('ETag', etag)
+    if shared and etag is not None:
+        patch_cache_control(response, public=True, max_age=SHARED_PAGE_MAX_AGE)
+    else:
+        patch_cache_control(response, private=True, no_cache=True)
+    patch_vary_headers(response, ['Cookie'])
+    return response
@@ -0,0 +1,319 @@
+"""
+Multi-leg connection search over the BusStop timetable.
+
+The timetable is loaded once per worker into plain Python structures and
+queried with a round-based (RAPTOR) scan: round k finds the earliest arrival
+at every stop using at most k buses. Bus and stop saves bump a version
+counter in the cache, and each worker reloads its copy when it notices the
+counter has moved. A missing counter starts from the current time in
+nanoseconds, as the bus versions do (see bus_cache), so an evicted counter
+never comes back at a value a worker still holds.
+"""
+import bisect
+import datetime
+import threading
+import time
+from collections import defaultdict
+from itertools import groupby
+from django.core.cache import cache
+from bookbus.models import Bus, BusStop
+from .route_index import minutes_of_day
+
+TIMETABLE_VERSION_KEY = 'timetable_version'
+DEFAULT_MAX_TRANSFERS = 2
+DEFAULT_MIN_TRANSFER_MINUTES = 15
+DAY_MINUTES = 24 * 60
+NEVER = 10 ** 9
+ALL_DAYS = 0b1111111
+
+_timetable = None
+_timetable_version = None
+_timetable_lock = threading.Lock()
+
+
+def bump_timetable_version():
+    """Tell every worker that its in-memory timetable is stale"""
+    try:
+        cache.incr(TIMETABLE_VERSION_KEY)
+    except ValueError:
+        cache.set(TIMETABLE_VERSION_KEY, time.time_ns(), None)
+
+
+def get_timetable_version():
+    version = cache.get(TIMETABLE_VERSION_KEY)
+    if version is None:
+        cache.add(TIMETABLE_VERSION_KEY, time.time_ns(), None)
+        version = cache.get(TIMETABLE_VERSION_KEY)
+    return version
+
+
+class Trip:
+    """One bus run: the minute at which it reaches each stop of its route"""
+    __slots__ = ('bus_id', 'first_day', 'last_day', 'days_mask', 'times')
+
+    def __init__(self, bus_id, first_day, last_day, operating_days, times):
+        self.bus_id = bus_id
+        self.first_day = first_day.toordinal()
+        self.last_day = last_day.toordinal()
+        self.days_mask = ALL_DAYS
+        if operating_days:
+            self.days_mask = sum(1 << int(day) for day in operating_days)
+        self.times = times
+
+    def runs_on(self, ordinal, weekday):
+        return self.first_day <= ordinal <= self.last_day and self.days_mask >> weekday & 1
+
+
+class Route:
+    """Trips that share a stop sequence and never overtake each other"""
+    __slots__ = ('stops', 'trips', 'columns')
+
+    def __init__(self, stops, trips):
+        self.stops = stops
+        self.trips = trips
+        # columns[pos] holds the (sorted) times of every trip at stop `pos`
+        self.columns = [[trip.times[pos] for trip in trips] for pos in range(len(stops))]
+
+
+def _split_overtaking(trips):
+    """
+    Partitions trips (sorted by first departure) into groups in which a
+    later trip is never earlier at any stop, as the scan requires.
+    """
+    groups = []
+    for trip in trips:
+        for group in groups:
+            last = group[-1]
+            if all(a <= b for a, b in zip(last.times, trip.times)):
+                group.append(trip)
+                break
+        else:
+            groups.append([trip])
+    return groups
+
+
+class Timetable:
+    def __init__(self, trips):
+        """
+        `trips` is an iterable of (bus_id, first_day, last_day, operating_days, stop_ids, times)
+        where times are minutes from midnight of the service day.
+        """
+        patterns = defaultdict(list)
+        for bus_id, first_day, last_day, operating_days, stop_ids, times in trips:
+            if len(stop_ids) < 2:
+                continue
+            patterns[tuple(stop_ids)].append(Trip(bus_id, first_day, last_day, operating_days, tuple(times)))
+
+        self.routes = []
+        for stops, pattern_trips in patterns.items():
+            pattern_trips.sort(key=lambda trip: trip.times)
+            for group in _split_overtaking(pattern_trips):
+                self.routes.append(Route(stops, group))
+
+        # stop id -> [(route index, position of the stop on that route)]
+        self.stop_routes = defaultdict(list)
+        for index, route in enumerate(self.routes):
+            for pos, stop_id in enumerate(route.stops):
+                self.stop_routes[stop_id].append((index, pos))
+
+    @classmethod
+    def from_database(cls):
+        buses = {
+            pk: (start_time.date(), end_time.date(), operating_days)
+            for pk, start_time, end_time, operating_days in Bus.objects.values_list(
+                'pk', 'start_time', 'end_time', 'operating_days'
+            )
+        }
+        rows = BusStop.objects.order_by('bus_id', 'stop_order').values_list(
+            'bus_id', 'stop_id', 'arrival_time', 'is_next_day'
+        )
+
+        trips = []
+        for bus_id, bus_stops in groupby(rows.iterator(chunk_size=5000), key=lambda row: row[0]):
+            if bus_id not in buses:
+                continue
+            bus_stops = list(bus_stops)
+            first_day, last_day, operating_days = buses[bus_id]
+            trips.append((
+                bus_id, first_day, last_day, operating_days,
+                [stop_id for _, stop_id, _, _ in bus_stops],
+                [minutes_of_day(time, next_day) for _, _, time, next_day in bus_stops],
+            ))
+        return cls(trips)
+
+    def _earliest_trip(self, route, pos, ready, service_days):
+        """
+        Earliest trip of `route` that can be boarded at `pos` no earlier than
+        `ready`, across the service days around the travel date.
+        Returns (trip, offset) or None.
+        """
+        column = route.columns[pos]
+        best = None
+        for offset, ordinal, weekday in service_days:
+            index = bisect.bisect_left(column, ready - offset)
+            while index < len(column):
+                trip = route.trips[index]
+                if trip.runs_on(ordinal, weekday):
+                    if best is None or trip.times[pos] + offset < best[0].times[pos] + best[1]:
+                        best = (trip, offset)
+                    break
+                index += 1
+        return best
+
+    def search(self, origin, destination, travel_date, departure=0,
+               max_transfers=DEFAULT_MAX_TRANSFERS, min_transfer=DEFAULT_MIN_TRANSFER_MINUTES):
+        """
+        Earliest-arrival journeys from `origin` to `destination` leaving at or
+        after `departure` minutes on `travel_date`. Returns one journey for every
+        number of legs that arrives earlier than all journeys with fewer legs.
+        """
+        if origin == destination or origin not in self.stop_routes:
+            return []
+
+        # Trips that started the day before can still be running after midnight,
+        # and late trips can connect into the next day.
+        service_days = []
+        for days in (-1, 0, 1):
+            day = travel_date + datetime.timedelta(days=days)
+            service_days.append((days * DAY_MINUTES, day.toordinal(), day.weekday()))
+
+        best = {origin: departure}
+        ready = {origin: departure}
+        marked = {origin}
+        labels = []
+        journeys = []
+
+        for round_no in range(max_transfers + 1):
+            queue = {}
+            for stop in marked:
+                for route_index, pos in self.stop_routes.get(stop, ()):
+                    if pos < queue.get(route_index, NEVER):
+                        queue[route_index] = pos
+            if not queue:
+                break
+
+            round_labels = {}
+            marked = set()
+            for route_index, start in queue.items():
+                route = self.routes[route_index]
+                stops = route.stops
+                trip = None
+                offset = board_pos = 0
+
+                for pos in range(start, len(stops)):
+                    stop = stops[pos]
+                    if trip is not None:
+                        arrival = trip.times[pos] + offset
+                        if arrival < best.get(stop, NEVER) and arrival < best.get(destination, NEVER):
+                            best[stop] = arrival
+                            round_labels[stop] = (route_index, trip, offset, board_pos, pos)
+                            marked.add(stop)
+
+                    ready_at = ready.get(stop)
+                    if ready_at is not None and (trip is None or ready_at <= trip.times[pos] + offset):
+                        found = self._earliest_trip(route, pos, ready_at, service_days)
+                        if found is not None and (
+                            trip is None or found[0].times[pos] + found[1] < trip.times[pos] + offset
+                        ):
+                            trip, offset = found
+                            board_pos = pos
+
+            labels.append(round_labels)
+            if destination in round_labels:
+                journeys.append(self._journey(labels, destination, travel_date))
+
+            # Stops reached in this round can be boarded from in the next one
+            for stop in marked:
+                ready[stop] = best[stop] + min_transfer
+
+        return journeys
+
+    def _journey(self, labels, destination, travel_date):
+        legs = []
+        stop = destination
+        round_no = len(labels) - 1
+        while round_no >= 0:
+            label = None
+            for earlier in range(round_no, -1, -1):
+                if stop in labels[earlier]:
+                    label = labels[earlier][stop]
+                    round_no = earlier
+                    break
+            if label is None:
+                break
+
+            route_index, trip, offset, board_pos, alight_pos = label
+            route = self.routes[route_index]
+            legs.append(Leg(
+                bus_id=trip.bus_id,
+                from_stop_id=route.stops[board_pos],
+                to_stop_id=route.stops[alight_pos],
+                service_date=travel_date + datetime.timedelta(days=offset // DAY_MINUTES),
+                departure=_to_datetime(travel_date, trip.times[board_pos] + offset),
+                arrival=_to_datetime(travel_date, trip.times[alight_pos] + offset),
+            ))
+            stop = route.stops[board_pos]
+            round_no -= 1
+
+        legs.reverse()
+        return Journey(legs)
+
+
+class Leg:
+    __slots__ = ('bus_id', 'from_stop_id', 'to_stop_id', 'service_date', 'departure', 'arrival')
+
+    def __init__(self, bus_id, from_stop_id, to_stop_id, service_date, departure, arrival):
+        self.bus_id = bus_id
+        self.from_stop_id = from_stop_id
+        self.to_stop_id = to_stop_id
+        self.service_date = service_date
+        self.departure = departure
+        self.arrival = arrival
+
+
+class Journey:
+    def __init__(self, legs):
+        self.legs = legs
+
+    @property
+    def departure(self):
+        return self.legs[0].departure
+
+    @property
+    def arrival(self):
+        return self.legs[-1].arrival
+
+    @property
+    def transfers(self):
+        return len(self.legs) - 1
+
+
+def _to_datetime(travel_date, minutes):
+    return datetime.datetime.combine(travel_date, datetime.time.min) + datetime.timedelta(minutes=minutes)
+
+
+def get_timetable():
+    """The per-worker timetable, reloaded when the version counter moves"""
+    global _timetable, _timetable_version
+    version = get_timetable_version()
+    if _timetable is None or _timetable_version != version:
+        with _timetable_lock:
+            if _timetable is None or _timetable_version != version:
+                _timetable = Timetable.from_database()
+                _timetable_version = version
+    return _timetable
+
+
+def find_connections(origin_id, destination_id, travel_date, departure_time=None,
+                     max_transfers=DEFAULT_MAX_TRANSFERS, min_transfer_minutes=DEFAULT_MIN_TRANSFER_MINUTES):
+    """
+    Journeys from one stop to another on `travel_date`, allowing up to
+    `max_transfers` changes with at least `min_transfer_minutes` at each.
+    """
+    departure = minutes_of_day(departure_time) if departure_time else 0
+    return get_timetable().search(
+        origin_id, destination_id, travel_date,
+        departure=departure,
+        max_transfers=max_transfers,
+        min_transfer=min_transfer_minutes
+    )
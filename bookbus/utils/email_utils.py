@@ -0,0 +1,162 @@
+"""
+Outbox for Mailjet emails.
+
+Views call queue_email(), which only inserts an OutboundEmail row, so the
+email commits or rolls back together with whatever the view was doing and
+no request waits on Mailjet. run_email_worker claims pending rows in
+batches (select_for_update with skip_locked, so several workers can run),
+sends each batch in one Mailjet call over a pooled session, and retries
+failures with exponential backoff. The claim is committed before the call,
+so a slow Mailjet holds no transaction or row locks open.
+"""
+import datetime
+import logging
+import requests
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from bookbus.models import OutboundEmail
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 50
+MAX_ATTEMPTS = 8
+BACKOFF_SECONDS = 30
+MAX_BACKOFF_SECONDS = 60 * 60
+REQUEST_TIMEOUT = 10
+# How long claimed emails stay with one worker; past this another may retry them
+CLAIM_SECONDS = REQUEST_TIMEOUT * 3
+
+
+def queue_email(to_email, subject, text_body, html_body='', to_name=''):
+    """Adds an email to the outbox; it is sent once the current transaction commits"""
+    return OutboundEmail.objects.create(
+        to_email=to_email,
+        to_name=to_name,
+        subject=subject,
+        text_body=text_body,
+        html_body=html_body,
+    )
+
+
+async def aqueue_email(to_email, subject, text_body, html_body='', to_name=''):
+    """queue_email() for async views; the email is committed at once, as there is no transaction"""
+    return await OutboundEmail.objects.acreate(
+        to_email=to_email,
+        to_name=to_name,
+        subject=subject,
+        text_body=text_body,
+        html_body=html_body,
+    )
+
+
+def queue_emails(emails):
+    """queue_email() for many emails in one INSERT; `emails` holds dicts of its arguments"""
+    return OutboundEmail.objects.bulk_create([OutboundEmail(**email) for email in emails])
+
+
+def mail_session(pool_size=10):
+    """A requests session that keeps its connections to Mailjet open between batches"""
+    session = requests.Session()
+    session.auth = (settings.MAILJET_API_KEY, settings.MAILJET_API_SECRET)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def mailjet_message(email):
+    recipient = {'Email': email.to_email}
+    if email.to_name:
+        recipient['Name'] = email.to_name
+    message = {
+        'From': {'Email': settings.MAILJET_SENDER_EMAIL, 'Name': 'BookBus'},
+        'To': [recipient],
+        'Subject': email.subject,
+        'TextPart': email.text_body,
+    }
+    if email.html_body:
+        message['HTMLPart'] = email.html_body
+    return message
+
+
+def send_batch(session, emails):
+    """
+    Sends `emails` in one Mailjet call. Returns a list with one entry per
+    email: None if it was accepted, otherwise the error text.
+    """
+    try:
+        response = session.post(
+            settings.MAILJET_API_URL,
+            json={'Messages': [mailjet_message(email) for email in emails]},
+            timeout=REQUEST_TIMEOUT
+        )
+    except requests.RequestException as e:
+        return [str(e)] * len(emails)
+
+    # Mailjet answers 200 when every message is accepted and 400 when some are
+    # not, in both cases with one status per message in request order
+    try:
+        results = response.json().get('Messages')
+    except ValueError:
+        results = None
+    if not isinstance(results, list) or len(results) != len(emails):
+        return [f'HTTP {response.status_code}: {response.text[:500]}'] * len(emails)
+
+    return [
+        None if result.get('Status') == 'success' else str(result.get('Errors') or result)[:500]
+        for result in results
+    ]
+
+
+def backoff(attempts):
+    """Delay before the next try after `attempts` failed ones: 30s, 1m, 2m, ... up to an hour"""
+    return datetime.timedelta(seconds=min(BACKOFF_SECONDS * 2 ** (attempts - 1), MAX_BACKOFF_SECONDS))
+
+
+def deliver_pending(session, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Claims up to `batch_size` due emails and sends them. Claiming moves their
+    next attempt CLAIM_SECONDS ahead, so if this worker dies mid-batch they
+    are picked up again after that.
+    Returns (sent, failed), both 0 when nothing was due.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        emails = list(
+            OutboundEmail.objects.select_for_update(skip_locked=True).filter(
+                status='Pending',
+                next_attempt_at__lte=now
+            ).order_by('next_attempt_at')[:batch_size]
+        )
+        if not emails:
+            return 0, 0
+        OutboundEmail.objects.filter(pk__in=[email.pk for email in emails]).update(
+            next_attempt_at=now + datetime.timedelta(seconds=CLAIM_SECONDS)
+        )
+
+    results = send_batch(session, emails)
+    now = timezone.now()
+    sent = failed = 0
+    for email, error in zip(emails, results):
+        email.attempts += 1
+        if error is None:
+            email.status = 'Sent'
+            email.sent_at = now
+            email.last_error = ''
+            sent += 1
+            continue
+
+        email.last_error = error
+        if email.attempts >= MAX_ATTEMPTS:
+            email.status = 'Failed'
+            logger.error(f"Giving up on email {email.pk} to {email.to_email}: {error}")
+        else:
+            email.next_attempt_at = now + backoff(email.attempts)
+        failed += 1
+
+    OutboundEmail.objects.bulk_update(
+        emails, ['status', 'attempts', 'next_attempt_at', 'last_error', 'sent_at']
+    )
+    return sent, failed
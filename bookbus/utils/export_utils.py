@@ -0,0 +1,339 @@
+"""
+Streaming Excel export of an operator's bookings.
+
+Rows are read with values_list().iterator() and written straight into
+openpyxl write-only worksheets, which spool each sheet to disk, so memory
+stays flat however many bookings there are. The finished workbook lands in
+a spooled temporary file that the view hands to FileResponse.
+
+Exports requested from the export page run as ExportJobs in
+run_export_worker instead. Each bus's rows are cached on disk as a
+fragment keyed by a watermark of that bus's bookings (count, latest
+date_booked and cancelled_at, completed count and fare total) and of its
+cache version (see bus_cache), which moves when the bus, its seats or a
+stop on its route is renamed. Only buses whose rows changed are read
+again; if no bus changed, the previous workbook is handed out as is.
+purge_exports deletes jobs finished more than EXPORT_RETENTION_HOURS ago
+with their workbooks, and fragments no export has used for as long. A job
+left Running EXPORT_JOB_TIMEOUT_MINUTES after it was claimed belongs to a
+worker that died: requests for a new export pass it by, and purge_exports
+marks it Failed.
+"""
+import glob
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from datetime import timedelta
+from itertools import chain, groupby
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Max, Q, Sum
+from django.utils import timezone
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font
+from openpyxl.utils import get_column_letter
+from bookbus.models import Booking, ExportJob
+from .bus_cache import bus_versions
+
+logger = logging.getLogger(__name__)
+
+EXPORT_CHUNK_SIZE = 2000
+# Exports smaller than this stay in memory, larger ones roll over to disk
+SPOOL_MAX_SIZE = 8 * 1024 * 1024
+EXPORT_RETENTION_HOURS = getattr(settings, 'EXPORT_RETENTION_HOURS', 24)
+EXPORT_JOB_TIMEOUT_MINUTES = getattr(settings, 'EXPORT_JOB_TIMEOUT_MINUTES', 30)
+
+HEADERS = [
+    ("Booking ID", 10),
+    ("Bus ID", 10),
+    ("Status", 12),
+    ("Seat", 10),
+    ("Seat Class", 15),
+    ("From", 25),
+    ("To", 25),
+    ("Travel Date", 15),
+    ("Passenger", 25),
+    ("Email", 30),
+    ("Fare", 10),
+    ("Booked At", 20),
+    ("Cancelled At", 20)
+]
+HEADER_ROW = 5
+
+ROW_FIELDS = [
+    'id', 'bus_id', 'status', 'seat__name', 'seat__seat_class', 'start_stop__name', 'end_stop__name',
+    'travel_date', 'passenger_name', 'passenger_email', 'seat__fare', 'created_at', 'cancelled_at'
+]
+
+
+def operator_bookings(operator):
+    return Booking.objects.filter(bus__travels=operator)
+
+
+def _checksum(value):
+    return hashlib.sha1(value.encode()).hexdigest()[:16]
+
+
+def export_buses(bookings):
+    """
+    (bus id, route, booking count, watermark) for every bus with bookings, in
+    export order. The watermark changes whenever the bus's exported rows do.
+    """
+    rows = bookings.values(
+        'bus_id', 'bus__journey_start__name', 'bus__journey_end__name'
+    ).annotate(
+        total=Count('id'),
+        completed=Count('id', filter=Q(status='Completed')),
+        last_booked=Max('date_booked'),
+        last_cancelled=Max('cancelled_at'),
+        fares=Sum('seat__fare'),
+    ).order_by('bus_id')
+    rows = list(rows)
+    versions = bus_versions([row['bus_id'] for row in rows])
+    return [
+        (
+            row['bus_id'],
+            f"{row['bus__journey_start__name']} to {row['bus__journey_end__name']}",
+            row['total'],
+            _checksum(
+                f"{row['total']}|{row['completed']}|{row['last_booked']}|{row['last_cancelled']}|{row['fares']}"
+                f"|{versions[row['bus_id']]}"
+            ),
+        )
+        for row in rows
+    ]
+
+
+def export_rows(bookings, chunk_size=EXPORT_CHUNK_SIZE):
+    """Spreadsheet rows ordered by bus, read from the database in chunks"""
+    rows = bookings.order_by('bus_id', 'travel_date', 'id').values_list(*ROW_FIELDS)
+    for row in rows.iterator(chunk_size=chunk_size):
+        row = list(row)
+        row[7] = row[7].strftime("%Y-%m-%d")
+        row[11] = row[11].strftime("%Y-%m-%d %H:%M")
+        row[12] = row[12].strftime("%Y-%m-%d %H:%M") if row[12] else "N/A"
+        yield row
+
+
+def _bold_row(ws, values):
+    row = []
+    for value in values:
+        cell = WriteOnlyCell(ws, value=value)
+        cell.font = Font(bold=True)
+        row.append(cell)
+    return row
+
+
+def write_bookings_workbook(fileobj, buses, rows):
+    """
+    Writes one sheet per bus into `fileobj`. `buses` is the output of
+    export_buses() and `rows` an iterable of rows ordered by bus id (the
+    second column), as produced by export_rows().
+    """
+    wb = Workbook(write_only=True)
+    counts = {bus_id: (route, total) for bus_id, route, total, *_ in buses}
+
+    for bus_id, bus_rows in groupby(rows, key=lambda row: row[1]):
+        route, total = counts.get(bus_id, ('', 0))
+        ws = wb.create_sheet(title=f"Bus-{bus_id}")
+        for col_num, (_, width) in enumerate(HEADERS, 1):
+            ws.column_dimensions[get_column_letter(col_num)].width = width
+
+        ws.append([f"Bus ID: {bus_id}"])
+        ws.append([f"Route: {route}"])
+        ws.append([f"Total Bookings: {total}"])
+        ws.append([])
+        ws.append(_bold_row(ws, [header for header, _ in HEADERS]))
+
+        last_row = HEADER_ROW
+        for row in bus_rows:
+            ws.append(row)
+            last_row += 1
+
+        if last_row > HEADER_ROW:
+            ws.append([])
+            ws.append(_bold_row(ws, ["Confirmed Bookings:", f'=COUNTIF(C6:C{last_row},"Confirmed")']))
+            ws.append(_bold_row(ws, ["Cancelled Bookings:", f'=COUNTIF(C6:C{last_row},"Cancelled")']))
+            ws.append(_bold_row(ws, ["Total Revenue:", f'=SUMIF(C6:C{last_row},"Confirmed",K6:K{last_row})']))
+
+    if not wb.worksheets:
+        wb.create_sheet(title="Bookings").append(["No bookings yet"])
+    wb.save(fileobj)
+
+
+def export_bookings_file(operator, chunk_size=EXPORT_CHUNK_SIZE):
+    """The operator's bookings as an .xlsx in a spooled temporary file, rewound for reading"""
+    bookings = operator_bookings(operator)
+    fileobj = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    write_bookings_workbook(fileobj, export_buses(bookings), export_rows(bookings, chunk_size))
+    fileobj.seek(0)
+    return fileobj
+
+
+def _export_dir(name):
+    path = os.path.join(settings.EXPORT_ROOT, name)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def fragment_path(bus_id, watermark):
+    return os.path.join(_export_dir('fragments'), f'bus-{bus_id}-{watermark}.jsonl')
+
+
+def write_fragment(bookings, bus_id, watermark, chunk_size=EXPORT_CHUNK_SIZE):
+    """Caches a bus's rows on disk and drops its older fragments"""
+    path = fragment_path(bus_id, watermark)
+    partial = f'{path}.{os.getpid()}.tmp'
+    with open(partial, 'w') as fragment:
+        for row in export_rows(bookings.filter(bus_id=bus_id), chunk_size):
+            fragment.write(json.dumps(row))
+            fragment.write('\n')
+    os.replace(partial, path)
+
+    for stale in glob.glob(os.path.join(os.path.dirname(path), f'bus-{bus_id}-*.jsonl')):
+        if stale != path:
+            try:
+                os.remove(stale)
+            except FileNotFoundError:
+                pass
+    return path
+
+
+def read_fragment(path):
+    with open(path) as fragment:
+        for line in fragment:
+            yield json.loads(line)
+
+
+def export_watermark(buses):
+    """Changes whenever any sheet of the export would"""
+    return _checksum(';'.join(f'{bus_id}:{route}:{watermark}' for bus_id, route, _, watermark in buses))
+
+
+def _reusable_job(operator, watermark):
+    for job in ExportJob.objects.filter(operator=operator, status='Done', watermark=watermark)[:5]:
+        if job.file_path and os.path.exists(job.file_path):
+            return job
+    return None
+
+
+def _stale_since(now=None):
+    """Jobs claimed before this and still Running were left by a worker that died"""
+    return (now or timezone.now()) - timedelta(minutes=EXPORT_JOB_TIMEOUT_MINUTES)
+
+
+def request_export(operator):
+    """
+    The ExportJob serving this operator's next download: a finished export if
+    no booking has changed since, a job already queued, or a new one.
+    """
+    watermark = export_watermark(export_buses(operator_bookings(operator)))
+    job = _reusable_job(operator, watermark)
+    if job is None:
+        job = ExportJob.objects.filter(
+            Q(status='Pending') | Q(status='Running', started_at__gte=_stale_since()), operator=operator
+        ).first()
+    if job is None:
+        job = ExportJob.objects.create(operator=operator)
+    return job
+
+
+def build_export(job, chunk_size=EXPORT_CHUNK_SIZE):
+    """Writes the job's workbook, rebuilding only the fragments of buses whose bookings changed"""
+    bookings = operator_bookings(job.operator)
+    buses = export_buses(bookings)
+    job.watermark = export_watermark(buses)
+
+    previous = _reusable_job(job.operator, job.watermark)
+    if previous is not None:
+        job.file_path = previous.file_path
+        job.rows = previous.rows
+        job.sheets_reused = len(buses)
+        return
+
+    paths = []
+    for bus_id, _, total, watermark in buses:
+        path = fragment_path(bus_id, watermark)
+        if os.path.exists(path):
+            # Marks it as in use, so purge_exports keeps it
+            os.utime(path)
+            job.sheets_reused += 1
+        else:
+            write_fragment(bookings, bus_id, watermark, chunk_size)
+            job.sheets_built += 1
+        paths.append(path)
+        job.rows += total
+
+    path = os.path.join(_export_dir('jobs'), f'bookings-{job.operator_id}-{job.pk}.xlsx')
+    partial = f'{path}.tmp'
+    with open(partial, 'wb') as fileobj:
+        write_bookings_workbook(fileobj, buses, chain.from_iterable(read_fragment(p) for p in paths))
+    os.replace(partial, path)
+    job.file_path = path
+
+
+def claim_export_job():
+    """Marks the oldest pending job as running and returns it, or None"""
+    with transaction.atomic():
+        job = ExportJob.objects.select_for_update(skip_locked=True).filter(
+            status='Pending'
+        ).order_by('created_at').first()
+        if job is not None:
+            job.status = 'Running'
+            job.started_at = timezone.now()
+            job.save(update_fields=['status', 'started_at'])
+    return job
+
+
+def run_export_job(job, chunk_size=EXPORT_CHUNK_SIZE):
+    try:
+        build_export(job, chunk_size)
+        job.status = 'Done'
+    except Exception as e:
+        logger.exception(f"Export {job.pk} failed")
+        job.status = 'Failed'
+        job.error = str(e)
+    job.finished_at = timezone.now()
+    job.save()
+    return job
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def purge_exports(now=None):
+    """
+    Fails jobs whose worker died, deletes jobs finished more than
+    EXPORT_RETENTION_HOURS ago and the workbooks no remaining job hands out,
+    then fragments and partial files left untouched for as long. Returns how
+    many jobs were deleted.
+    """
+    ExportJob.objects.filter(
+        Q(started_at__lt=_stale_since(now)) | Q(started_at__isnull=True), status='Running'
+    ).update(
+        status='Failed', error='The export worker stopped before finishing', finished_at=now or timezone.now()
+    )
+    cutoff = (now or timezone.now()) - timedelta(hours=EXPORT_RETENTION_HOURS)
+    expired = ExportJob.objects.filter(status__in=['Done', 'Failed'], finished_at__lt=cutoff)
+    paths = set(expired.exclude(file_path='').values_list('file_path', flat=True))
+    deleted, _ = expired.delete()
+    # A job that reused an older workbook shares its file
+    paths -= set(ExportJob.objects.filter(file_path__in=paths).values_list('file_path', flat=True))
+    for path in paths:
+        _remove(path)
+
+    for pattern in ('fragments/*.jsonl', 'fragments/*.tmp', 'jobs/*.tmp'):
+        for path in glob.glob(os.path.join(settings.EXPORT_ROOT, pattern)):
+            try:
+                if os.path.getmtime(path) < cutoff.timestamp():
+                    _remove(path)
+            except FileNotFoundError:
+                pass
+    return deleted
@@ -0,0 +1,127 @@
+"""
+Geohash grid cells and distances for stop lookups by location.
+
+Every stop stores the geohash of its grid cell at GRID_PRECISION (cells of
+roughly 610 m by 1.2 km at the equator). A radius search lists the cells
+overlapping the circle's bounding box, fetches the stops in those cells
+with one indexed IN query and ranks them with a vectorized haversine.
+"""
+import math
+import numpy as np
+
+GRID_PRECISION = 6
+EARTH_RADIUS_M = 6371000
+METERS_PER_DEGREE = EARTH_RADIUS_M * math.pi / 180
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+MAX_COVERING_CELLS = 1024
+
+
+def _bits(precision):
+    """(latitude bits, longitude bits) of a geohash with `precision` characters"""
+    total = 5 * precision
+    return total // 2, (total + 1) // 2
+
+
+def _index(value, low, high, bits):
+    return min(int((value - low) / (high - low) * (1 << bits)), (1 << bits) - 1)
+
+
+def _cell(lat_index, lng_index, precision):
+    """Geohash of a cell given its row and column on the grid"""
+    lat_bits, lng_bits = _bits(precision)
+    code = 0
+    for bit in range(5 * precision):
+        # Bits alternate longitude, latitude, starting from the most significant
+        if bit % 2 == 0:
+            lng_bits -= 1
+            code = code << 1 | (lng_index >> lng_bits & 1)
+        else:
+            lat_bits -= 1
+            code = code << 1 | (lat_index >> lat_bits & 1)
+    return ''.join(BASE32[code >> shift & 31] for shift in range(5 * (precision - 1), -1, -5))
+
+
+def encode_cell(latitude, longitude, precision=GRID_PRECISION):
+    lat_bits, lng_bits = _bits(precision)
+    return _cell(
+        _index(latitude, -90, 90, lat_bits),
+        _index(longitude, -180, 180, lng_bits),
+        precision
+    )
+
+
+def encode_cells(latitudes, longitudes, precision=GRID_PRECISION):
+    """encode_cell() over arrays of coordinates, for backfills and benchmarks"""
+    lat_bits, lng_bits = _bits(precision)
+    lat_index = np.minimum(((np.asarray(latitudes) + 90) / 180 * (1 << lat_bits)).astype(np.int64), (1 << lat_bits) - 1)
+    lng_index = np.minimum(((np.asarray(longitudes) + 180) / 360 * (1 << lng_bits)).astype(np.int64), (1 << lng_bits) - 1)
+
+    codes = np.zeros(len(lat_index), dtype=np.int64)
+    for bit in range(5 * precision):
+        if bit % 2 == 0:
+            lng_bits -= 1
+            codes = codes << 1 | (lng_index >> lng_bits & 1)
+        else:
+            lat_bits -= 1
+            codes = codes << 1 | (lat_index >> lat_bits & 1)
+
+    alphabet = np.array(list(BASE32))
+    characters = [alphabet[codes >> shift & 31] for shift in range(5 * (precision - 1), -1, -5)]
+    return [''.join(chars) for chars in zip(*characters)]
+
+
+def cells_covering(latitude, longitude, radius, precision=GRID_PRECISION, max_cells=MAX_COVERING_CELLS):
+    """
+    Geohashes of every cell that overlaps the `radius` metre circle around a
+    point, or None if there are more than `max_cells` (close to the poles)
+    """
+    lat_bits, lng_bits = _bits(precision)
+    delta_lat = radius / METERS_PER_DEGREE
+    cos_lat = math.cos(math.radians(min(abs(latitude) + delta_lat, 90)))
+    delta_lng = 180 if cos_lat < 1e-6 else min(delta_lat / cos_lat, 180)
+
+    lat_low = _index(max(latitude - delta_lat, -90), -90, 90, lat_bits)
+    lat_high = _index(min(latitude + delta_lat, 90), -90, 90, lat_bits)
+    columns = 1 << lng_bits
+    if delta_lng >= 180:
+        lng_indexes = range(columns)
+    else:
+        # Columns wrap around the antimeridian
+        lng_low = _index(longitude - delta_lng + 360 if longitude - delta_lng < -180 else longitude - delta_lng,
+                         -180, 180, lng_bits)
+        lng_high = _index(longitude + delta_lng - 360 if longitude + delta_lng >= 180 else longitude + delta_lng,
+                          -180, 180, lng_bits)
+        span = (lng_high - lng_low) % columns
+        lng_indexes = [(lng_low + step) % columns for step in range(span + 1)]
+
+    if (lat_high - lat_low + 1) * len(lng_indexes) > max_cells:
+        return None
+    return [
+        _cell(lat_index, lng_index, precision)
+        for lat_index in range(lat_low, lat_high + 1)
+        for lng_index in lng_indexes
+    ]
+
+
+def haversine(latitude, longitude, latitudes, longitudes):
+    """Great-circle distances in metres from one point to arrays of points"""
+    phi1 = math.radians(latitude)
+    phi2 = np.radians(latitudes)
+    delta_phi = phi2 - phi1
+    delta_lambda = np.radians(longitudes) - math.radians(longitude)
+
+    a = np.sin(delta_phi / 2) ** 2 + math.cos(phi1) * np.cos(phi2) * np.sin(delta_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def rank_by_distance(latitude, longitude, latitudes, longitudes, k, radius):
+    """
+    (positions, distances) of the `k` points nearest to a point within
+    `radius` metres, nearest first
+    """
+    distances = haversine(latitude, longitude, latitudes, longitudes)
+    within = np.flatnonzero(distances <= radius)
+    if len(within) > k:
+        within = within[np.argpartition(distances[within], k - 1)[:k]]
+    order = within[np.argsort(distances[within], kind='stable')]
+    return order, distances[order]
@@ -0,0 +1,107 @@
+"""
+Idempotency keys for POSTs that move seats or coins.
+
+Forms carry a one-off token ({% idempotency_field %}, or an
+Idempotency-Key header). The first POST with a token claims it by
+inserting an IdempotencyKey row and, once the view answers with a
+redirect, stores the status and Location. A repeat of that POST, from a
+double click or a proxy retry, gets the same redirect back without running
+the view, so no seat is locked and nothing reaches the ledger twice. A
+repeat that arrives while the first is still running gets 409 with
+Retry-After straight away, rather than holding a worker while it waits.
+Responses that are not redirects are not stored, and the token is
+released so the form can be sent again. purge_idempotency_keys deletes
+keys older than IDEMPOTENCY_KEY_TTL_HOURS.
+"""
+import datetime
+import uuid
+from functools import wraps
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.http import HttpResponse
+from django.utils import timezone
+from bookbus.models import IdempotencyKey
+
+FIELD_NAME = 'idempotency_key'
+HEADER_NAME = 'HTTP_IDEMPOTENCY_KEY'
+IDEMPOTENCY_KEY_TTL_HOURS = getattr(settings, 'IDEMPOTENCY_KEY_TTL_HOURS', 24)
+# When a repeat that found the first request still running should try again
+RETRY_AFTER_SECONDS = 1
+
+
+def new_key():
+    return uuid.uuid4().hex
+
+
+def request_key(request, actions):
+    """The POST's token, or None if it has none or is not one of `actions`"""
+    if request.method != 'POST' or not request.user.is_authenticated:
+        return None
+    if actions and not any(action in request.POST for action in actions):
+        return None
+    key = request.POST.get(FIELD_NAME) or request.META.get(HEADER_NAME)
+    return key[:64] if key else None
+
+
+def _expiry(now=None):
+    return (now or timezone.now()) - datetime.timedelta(hours=IDEMPOTENCY_KEY_TTL_HOURS)
+
+
+def claim_key(user, key):
+    """(IdempotencyKey, created): a new row if this token is unused, else the one already stored"""
+    IdempotencyKey.objects.filter(user=user, key=key, created_at__lt=_expiry()).delete()
+    try:
+        with transaction.atomic():
+            return IdempotencyKey.objects.create(user=user, key=key), True
+    except IntegrityError:
+        return IdempotencyKey.objects.get(user=user, key=key), False
+
+
+def replay(record):
+    """The stored response of a claimed key, or 409 if the first request is still running"""
+    if record.status_code is None:
+        response = HttpResponse("This request is still being processed.", status=409)
+        response['Retry-After'] = str(RETRY_AFTER_SECONDS)
+        return response
+    response = HttpResponse(status=record.status_code)
+    response['Location'] = record.location
+    return response
+
+
+def idempotent(*actions):
+    """
+    Makes POSTs carrying a token idempotent. With `actions`, only POSTs
+    that include one of those fields (the submit button names) are covered.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            key = request_key(request, actions)
+            if key is None:
+                return view(request, *args, **kwargs)
+
+            record, created = claim_key(request.user, key)
+            if not created:
+                return replay(record)
+
+            try:
+                response = view(request, *args, **kwargs)
+            except Exception:
+                record.delete()
+                raise
+
+            if 300 <= response.status_code < 400 and response.has_header('Location'):
+                record.status_code = response.status_code
+                record.location = response['Location'][:255]
+                record.save(update_fields=['status_code', 'location'])
+            else:
+                record.delete()
+            return response
+        return wrapper
+    return decorator
+
+
+def purge_keys(now=None):
+    """Deletes keys past their TTL; returns how many"""
+    deleted, _ = IdempotencyKey.objects.filter(created_at__lt=_expiry(now)).delete()
+    return deleted
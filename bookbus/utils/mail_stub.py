@@ -0,0 +1,81 @@
+"""
+A local stand-in for the Mailjet send API, for running the email worker
+without sending real mail. Point MAILJET_API_URL at it, e.g.
+
+    python manage.py run_mail_stub --port 8025 --latency 0.3 --failure-rate 0.1
+    MAILJET_API_URL=http://127.0.0.1:8025/v3.1/send python manage.py run_email_worker
+"""
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class MailStubHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            messages = json.loads(self.rfile.read(length)).get('Messages', [])
+        except ValueError:
+            self._reply(400, {'ErrorMessage': 'Invalid JSON'})
+            return
+
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+
+        results = []
+        for message in messages:
+            if server.rng.random() < server.failure_rate:
+                results.append({'Status': 'error', 'Errors': [{'ErrorMessage': 'Simulated failure'}]})
+            else:
+                results.append({'Status': 'success'})
+                with server.lock:
+                    server.delivered.append(message)
+                    server.delivered_at.append(time.perf_counter())
+
+        with server.lock:
+            server.requests += 1
+        ok = all(result['Status'] == 'success' for result in results)
+        self._reply(200 if ok else 400, {'Messages': results})
+
+    def _reply(self, status, body):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class MailStubServer(ThreadingHTTPServer):
+    """Accepts Mailjet v3.1 send requests, with optional latency and random per-message failures"""
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, failure_rate=0.0, seed=None, verbose=False):
+        super().__init__((host, port), MailStubHandler)
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.rng = random.Random(seed)
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        self.delivered = []
+        # time.perf_counter() at which each delivered message was accepted
+        self.delivered_at = []
+        self.requests = 0
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}/v3.1/send'
+
+    def start(self):
+        """Serves from a background thread and returns the send URL"""
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self.url
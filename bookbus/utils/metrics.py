@@ -0,0 +1,226 @@
+"""
+Per-route request metrics: SQL query count, DB time, template render time
+and wall time, kept as cumulative histograms and exposed on /metrics in
+the Prometheus text format.
+
+RequestMetricsMiddleware opens a RequestStats for each request. Every
+connection, in every thread, gets an execute_wrapper when it connects that
+counts each query and adds its time to the stats open in the query's
+context, which sync_to_async carries into the thread running a sync view
+under ASGI. Templates rendered through TimedDjangoTemplates
+(the TEMPLATES backend) add their render time. When the response is
+ready the stats are filed under the resolved URL name, so routes can be
+compared with histogram_quantile() over the buckets below.
+
+Histograms live in the worker process. Each gunicorn worker reports its
+own, labelled with its pid; sum by route when querying.
+Querysets evaluated while a template renders count as both DB and
+template time.
+"""
+import bisect
+import contextlib
+import contextvars
+import os
+import threading
+import time
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.template import TemplateDoesNotExist
+from django.template.backends.django import DjangoTemplates, Template, reraise
+
+# Upper bounds of the histogram buckets; +Inf is implied
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+UNRESOLVED_ROUTE = '<unresolved>'
+
+QUERY_BUDGETS = getattr(settings, 'QUERY_BUDGETS', {})
+QUERY_BUDGET_STRICT = getattr(settings, 'QUERY_BUDGET_STRICT', False)
+
+_current = contextvars.ContextVar('request_stats', default=None)
+# Every tracker open in the context, outermost first; a query counts for each
+_tracking = contextvars.ContextVar('tracked_stats', default=())
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+class RequestStats:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.template_seconds = 0.0
+        self._rendering = 0
+
+    @property
+    def wall_seconds(self):
+        return time.perf_counter() - self.started
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def cumulative(self):
+        """(upper bound, observations at or below it) pairs, ending with +Inf"""
+        total = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            yield bound, total
+
+
+# name -> (help, buckets), in exposition order
+HISTOGRAMS = {
+    'bookbus_request_duration_seconds': ('Wall time per request', SECONDS_BUCKETS),
+    'bookbus_request_db_seconds': ('Time spent in SQL queries per request', SECONDS_BUCKETS),
+    'bookbus_request_template_seconds': ('Time spent rendering templates per request', SECONDS_BUCKETS),
+    'bookbus_request_queries': ('SQL queries per request', QUERY_BUCKETS),
+}
+
+_lock = threading.Lock()
+# route -> histogram name -> Histogram
+_routes = {}
+# route -> requests over their query budget
+_over_budget = {}
+
+
+def _record_query(execute, sql, params, many, context):
+    tracking = _tracking.get()
+    if not tracking:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        elapsed = time.perf_counter() - started
+        for stats in tracking:
+            stats.db_seconds += elapsed
+            stats.queries += 1
+
+
+def _install(connection):
+    if _record_query not in connection.execute_wrappers:
+        # First, so a surrounding connection.execute_wrapper() block still pops its own wrapper
+        connection.execute_wrappers.insert(0, _record_query)
+
+
+def _install_on_connect(sender, connection, **kwargs):
+    _install(connection)
+
+
+connection_created.connect(_install_on_connect, dispatch_uid='bookbus_request_metrics')
+
+
+@contextlib.contextmanager
+def track_request():
+    """Collects the stats of the code run inside it; yields the RequestStats"""
+    stats = RequestStats()
+    # Connections of this thread opened before the receiver above was connected
+    for connection in connections.all():
+        _install(connection)
+    token = _current.set(stats)
+    # Nested inside another tracker, queries count for the outer one too
+    tracking = _tracking.set(_tracking.get() + (stats,))
+    try:
+        yield stats
+    finally:
+        _tracking.reset(tracking)
+        _current.reset(token)
+
+
+def observe(route, stats):
+    values = {
+        'bookbus_request_duration_seconds': stats.wall_seconds,
+        'bookbus_request_db_seconds': stats.db_seconds,
+        'bookbus_request_template_seconds': stats.template_seconds,
+        'bookbus_request_queries': stats.queries,
+    }
+    with _lock:
+        histograms = _routes.get(route)
+        if histograms is None:
+            histograms = _routes[route] = {name: Histogram(buckets) for name, (_, buckets) in HISTOGRAMS.items()}
+        for name, value in values.items():
+            histograms[name].observe(value)
+
+
+def query_budget(route):
+    return QUERY_BUDGETS.get(route)
+
+
+def count_over_budget(route):
+    with _lock:
+        _over_budget[route] = _over_budget.get(route, 0) + 1
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value):
+    return value if isinstance(value, (int, str)) else repr(float(value))
+
+
+def render_metrics():
+    """Everything recorded by this worker in the Prometheus text format"""
+    worker = os.getpid()
+    with _lock:
+        routes = {
+            route: {name: (list(histogram.cumulative()), histogram.sum) for name, histogram in histograms.items()}
+            for route, histograms in sorted(_routes.items())
+        }
+        over_budget = sorted(_over_budget.items())
+
+    lines = []
+    for name, (help_text, _) in HISTOGRAMS.items():
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} histogram')
+        for route, histograms in routes.items():
+            labels = f'route="{_label(route)}",worker="{worker}"'
+            buckets, total = histograms[name]
+            for bound, count in buckets:
+                lines.append(f'{name}_bucket{{{labels},le="{_number(bound)}"}} {count}')
+            lines.append(f'{name}_sum{{{labels}}} {_number(total)}')
+            lines.append(f'{name}_count{{{labels}}} {buckets[-1][1]}')
+
+    name = 'bookbus_query_budget_exceeded_total'
+    lines.append(f'# HELP {name} Requests that ran more SQL queries than their QUERY_BUDGETS entry')
+    lines.append(f'# TYPE {name} counter')
+    for route, count in over_budget:
+        lines.append(f'{name}{{route="{_label(route)}",worker="{worker}"}} {count}')
+    return '\n'.join(lines) + '\n'
+
+
+class TimedTemplate(Template):
+    def render(self, context=None, request=None):
+        stats = _current.get()
+        # Only the outermost render is timed, so templates rendered from a tag are not counted twice
+        if stats is None or stats._rendering:
+            return super().render(context, request)
+        stats._rendering += 1
+        started = time.perf_counter()
+        try:
+            return super().render(context, request)
+        finally:
+            stats._rendering -= 1
+            stats.template_seconds += time.perf_counter() - started
+
+
+class TimedDjangoTemplates(DjangoTemplates):
+    """The Django template backend, with render time added to the request's stats"""
+
+    def from_string(self, template_code):
+        return TimedTemplate(self.engine.from_string(template_code), self)
+
+    def get_template(self, template_name):
+        try:
+            return TimedTemplate(self.engine.get_template(template_name), self)
+        except TemplateDoesNotExist as exc:
+            reraise(exc, self)
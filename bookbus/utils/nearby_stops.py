@@ -0,0 +1,54 @@
+"""
+Stops near a point, for duplicate detection and "stops near me" searches.
+
+Candidates come from one query on the (grid_cell, latitude, longitude)
+index over the cells covering the search circle; they are ranked in NumPy,
+so the cost depends on how many stops are nearby, not on the table size.
+"""
+import numpy as np
+from bookbus.models import Stop
+from .geohash import METERS_PER_DEGREE, cells_covering, rank_by_distance
+
+DEFAULT_K = 10
+DEFAULT_RADIUS_M = 2000
+MAX_K = 50
+# Keeps the covering cell list to a few hundred at most
+MAX_RADIUS_M = 5000
+DUPLICATE_RADIUS_M = 10
+
+
+def nearest_stops(latitude, longitude, k=DEFAULT_K, radius=DEFAULT_RADIUS_M):
+    """
+    Up to `k` stops within `radius` metres of a point, nearest first, as
+    dicts with their distance in metres
+    """
+    k = min(max(k, 1), MAX_K)
+    radius = min(max(radius, 0), MAX_RADIUS_M)
+    cells = cells_covering(latitude, longitude, radius)
+    if cells is not None:
+        stops = Stop.objects.filter(grid_cell__in=cells)
+    else:
+        # Near the poles the circle spans too many cells; a latitude band is small there
+        delta = radius / METERS_PER_DEGREE
+        stops = Stop.objects.filter(latitude__range=(latitude - delta, latitude + delta))
+    rows = list(stops.values_list('id', 'name', 'city', 'latitude', 'longitude'))
+    if not rows:
+        return []
+
+    coordinates = np.array([(lat, lng) for _, _, _, lat, lng in rows], dtype=float)
+    positions, distances = rank_by_distance(latitude, longitude, coordinates[:, 0], coordinates[:, 1], k, radius)
+    return [
+        {
+            'id': rows[position][0],
+            'name': rows[position][1],
+            'city': rows[position][2],
+            'latitude': rows[position][3],
+            'longitude': rows[position][4],
+            'distance': round(float(distance), 1),
+        }
+        for position, distance in zip(positions, distances)
+    ]
+
+
+def stop_exists_near(latitude, longitude, radius=DUPLICATE_RADIUS_M):
+    return bool(nearest_stops(latitude, longitude, k=1, radius=radius))
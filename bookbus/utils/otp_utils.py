@@ -1,38 +1,23 @@
 import random
-import requests
-from django.conf import settings
 from bookbus.models import PassengerOTP
+from .email_utils import aqueue_email
 
 def generate_otp():
     return str(random.randint(100000, 999999))
 
-def send_otp_email(email, booking=None):
+async def asend_otp_email(email, booking=None):
+    """
+    Stores a passenger OTP and queues its email, for async views. The async
+    ORM cannot open a transaction, so these are two inserts; an OTP whose
+    email failed to queue is never sent, and the passenger asks again.
+    """
     otp = generate_otp()
-    PassengerOTP.objects.create(email=email, otp=otp, booking=booking)
-    
-    response = requests.post(
-        "https://api.mailjet.com/v3.1/send",
-        auth=(settings.MAILJET_API_KEY, settings.MAILJET_API_SECRET),
-        json={
-            "Messages": [
-                {
-                    "From": {
-                        "Email": settings.MAILJET_SENDER_EMAIL,
-                        "Name": "BookBus"
-                    },
-                    "To": [
-                        {
-                            "Email": email,
-                        }
-                    ],
-                    "Subject": "Your Booking OTP Verification",
-                    "TextPart": f"Your OTP for booking verification is: {otp}",
-                }
-            ]
-        }
+    await PassengerOTP.objects.acreate(email=email, otp=otp, booking=booking)
+    await aqueue_email(
+        to_email=email,
+        subject="Your Booking OTP Verification",
+        text_body=f"Your OTP for booking verification is: {otp}",
     )
-    if response.status_code != 200:
-        raise Exception(f"Failed to send OTP: {response.text}")
 
 def verify_otp(email, otp_code):
     try:
@@ -0,0 +1,91 @@
+"""
+Keyset pagination for the home search results.
+
+Results are ordered newest start_time first with id as the tie-breaker, and
+a page is fetched with a WHERE on the (start_time, id) of the row it
+continues from plus a LIMIT, instead of an OFFSET and a COUNT(*). Each page
+costs one index range scan however many buses match. Cursors are opaque
+url-safe strings; a cursor that does not decode is treated as the first
+page.
+"""
+import base64
+import binascii
+import datetime
+from django.db.models import Q
+
+PAGE_SIZE = 10
+
+
+def encode_cursor(obj):
+    value = f'{obj.start_time.isoformat()}|{obj.pk}'
+    return base64.urlsafe_b64encode(value.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """(start_time, pk) from a cursor, or None if it is missing or malformed"""
+    if not cursor:
+        return None
+    try:
+        value = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        start_time, pk = value.rsplit('|', 1)
+        return datetime.datetime.fromisoformat(start_time), int(pk)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        return None
+
+
+class KeysetPage:
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    @property
+    def has_other_pages(self):
+        return self.has_next or self.has_previous
+
+
+def keyset_page(queryset, after=None, before=None, page_size=PAGE_SIZE):
+    """
+    One page of `queryset` ordered by (-start_time, -id): the rows following
+    the `after` cursor, the rows preceding the `before` cursor, or the first
+    page. Reads page_size + 1 rows to know whether there is another page.
+    """
+    before_key = decode_cursor(before)
+    after_key = None if before_key else decode_cursor(after)
+
+    if before_key:
+        start_time, pk = before_key
+        rows = list(queryset.filter(
+            Q(start_time__gt=start_time) | Q(start_time=start_time, pk__gt=pk)
+        ).order_by('start_time', 'pk')[:page_size + 1])
+        has_previous, has_next = len(rows) > page_size, True
+        rows = rows[:page_size][::-1]
+    else:
+        if after_key:
+            start_time, pk = after_key
+            queryset = queryset.filter(Q(start_time__lt=start_time) | Q(start_time=start_time, pk__lt=pk))
+        rows = list(queryset.order_by('-start_time', '-pk')[:page_size + 1])
+        has_previous, has_next = after_key is not None, len(rows) > page_size
+        rows = rows[:page_size]
+
+    if not rows:
+        return KeysetPage(rows)
+    return KeysetPage(
+        rows,
+        next_cursor=encode_cursor(rows[-1]) if has_next else None,
+        previous_cursor=encode_cursor(rows[0]) if has_previous else None,
+    )
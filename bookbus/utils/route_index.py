@@ -0,0 +1,103 @@
+from django.db import transaction
+from bookbus.models import BusStop, RouteSegmentIndex
+
+
+def minutes_of_day(arrival_time, is_next_day=False):
+    """
+    Minutes since midnight of the departure day, counting next-day stops past 24h
+    """
+    minutes = arrival_time.hour * 60 + arrival_time.minute
+    return minutes + 24 * 60 if is_next_day else minutes
+
+
+def build_route_segments(bus_id, stops):
+    """
+    Builds the RouteSegmentIndex rows for one bus.
+    `stops` is a list of (stop_id, stop_order, arrival_time, is_next_day) ordered by stop_order.
+    """
+    if not stops:
+        return []
+
+    first_minutes = minutes_of_day(stops[0][2], stops[0][3])
+    offsets = [max(minutes_of_day(time, next_day) - first_minutes, 0) for _, _, time, next_day in stops]
+
+    segments = []
+    for i, (from_stop_id, from_order, _, _) in enumerate(stops):
+        for j in range(i + 1, len(stops)):
+            to_stop_id, to_order, _, _ = stops[j]
+            segments.append(RouteSegmentIndex(
+                bus_id=bus_id,
+                from_stop_id=from_stop_id,
+                to_stop_id=to_stop_id,
+                from_order=from_order,
+                to_order=to_order,
+                departure_offset=offsets[i],
+                duration=max(offsets[j] - offsets[i], 0)
+            ))
+    return segments
+
+
+def write_route_index(bus_id, stops):
+    """
+    Replaces the stop-pair index of a bus; `stops` as for build_route_segments
+    """
+    with transaction.atomic():
+        RouteSegmentIndex.objects.filter(bus_id=bus_id).delete()
+        segments = build_route_segments(bus_id, stops)
+        RouteSegmentIndex.objects.bulk_create(segments, batch_size=1000)
+
+    return len(segments)
+
+
+def rebuild_route_index(bus):
+    """
+    Rewrites the stop-pair index of a single bus from its current BusStop rows
+    """
+    stops = list(
+        BusStop.objects.filter(bus=bus)
+        .order_by('stop_order')
+        .values_list('stop_id', 'stop_order', 'arrival_time', 'is_next_day')
+    )
+    return write_route_index(bus.pk, stops)
+
+
+def sync_route_index(bus_id, stops):
+    """
+    Brings the stop-pair index of a bus in line with `stops` (as for
+    build_route_segments), writing only the pairs whose stops or times
+    changed. Returns the number of rows written.
+    """
+    wanted = {
+        (segment.from_order, segment.to_order): segment
+        for segment in build_route_segments(bus_id, stops)
+    }
+    existing = {
+        (from_order, to_order): (pk, (from_stop_id, to_stop_id, departure_offset, duration))
+        for pk, from_order, to_order, from_stop_id, to_stop_id, departure_offset, duration
+        in RouteSegmentIndex.objects.filter(bus_id=bus_id).values_list(
+            'pk', 'from_order', 'to_order', 'from_stop_id', 'to_stop_id', 'departure_offset', 'duration'
+        )
+    }
+
+    stale = [pk for key, (pk, _) in existing.items() if key not in wanted]
+    missing = [segment for key, segment in wanted.items() if key not in existing]
+    changed = []
+    for key, (pk, values) in existing.items():
+        segment = wanted.get(key)
+        if segment is not None and values != (
+            segment.from_stop_id, segment.to_stop_id, segment.departure_offset, segment.duration
+        ):
+            segment.pk = pk
+            changed.append(segment)
+
+    with transaction.atomic():
+        if stale:
+            RouteSegmentIndex.objects.filter(pk__in=stale).delete()
+        if changed:
+            RouteSegmentIndex.objects.bulk_update(
+                changed, ['from_stop', 'to_stop', 'departure_offset', 'duration'], batch_size=500
+            )
+        if missing:
+            RouteSegmentIndex.objects.bulk_create(missing, batch_size=1000)
+
+    return len(stale) + len(changed) + len(missing)
@@ -0,0 +1,170 @@
+"""
+Live seat availability for the bus_book page, as Server-Sent Events.
+
+An open seat map keeps one stream (seat_event_stream) for its bus, travel
+date and journey legs. The stream sends every seat's state once, then only
+the seats whose state changed.
+
+Committed bookings, cancellations and seat holds call
+publish_seat_change(), which wakes that bus's streams in this process at
+once. Changes made in other worker processes are found by polling: every
+POLL_SECONDS a stream compares the bookings-and-holds stamp of its (bus,
+date) (see conditional) with the last one it saw. Streams in a process
+share the stamp, so a bus costs two small queries per interval however
+many customers are watching it. Each of those reads closes the database
+connection it used, so a waiting stream holds no connection.
+
+A stream ends after STREAM_SECONDS and the browser's EventSource
+reconnects. Streams need the ASGI server: under WSGI an async iterator is
+read to the end before any of it is sent.
+"""
+import asyncio
+import json
+import threading
+import time
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connections
+from .conditional import booking_stamp, hold_stamp
+from .seat_occupancy import seat_map
+
+POLL_SECONDS = getattr(settings, 'SEAT_EVENTS_POLL_SECONDS', 2)
+STREAM_SECONDS = getattr(settings, 'SEAT_EVENTS_STREAM_SECONDS', 300)
+# A comment line this often keeps proxies from closing a quiet stream
+HEARTBEAT_SECONDS = 15
+RETRY_MILLISECONDS = 3000
+
+
+class SeatEventBroker:
+    """
+    Wakes the streams of a bus when its seats change, and remembers each
+    (bus, date) stamp for POLL_SECONDS. publish() may be called from any
+    thread; each stream waits on an asyncio.Event of its own event loop.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._waiters = {}  # {bus_id: {(loop, event): travel_date}}
+        self._stamps = {}  # {(bus_id, travel_date): (time.monotonic(), stamp)}
+
+    def subscribe(self, bus_id, travel_date):
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        with self._lock:
+            self._waiters.setdefault(bus_id, {})[waiter] = travel_date
+        return waiter
+
+    def unsubscribe(self, bus_id, waiter):
+        with self._lock:
+            waiters = self._waiters.get(bus_id, {})
+            waiters.pop(waiter, None)
+            if not waiters:
+                self._waiters.pop(bus_id, None)
+                for key in [key for key in self._stamps if key[0] == bus_id]:
+                    del self._stamps[key]
+
+    def publish(self, bus_id, travel_date=None):
+        """Wakes the streams of the bus on `travel_date`, or on every date"""
+        with self._lock:
+            for key in [key for key in self._stamps if key[0] == bus_id and travel_date in (None, key[1])]:
+                del self._stamps[key]
+            waiters = [
+                waiter for waiter, waiter_date in self._waiters.get(bus_id, {}).items()
+                if travel_date in (None, waiter_date)
+            ]
+        for loop, event in waiters:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                # The stream's loop has closed; it unsubscribes on its way out
+                pass
+
+    async def stamp(self, bus_id, travel_date):
+        key = (bus_id, travel_date)
+        checked = self._stamps.get(key)
+        if checked and time.monotonic() - checked[0] < POLL_SECONDS:
+            return checked[1]
+        stamp = await _released(_stamp)(bus_id, travel_date)
+        with self._lock:
+            self._stamps[key] = (time.monotonic(), stamp)
+        return stamp
+
+
+broker = SeatEventBroker()
+
+
+def publish_seat_change(bus_id, travel_date=None):
+    """Call once a booking, cancellation or hold on the bus has committed"""
+    broker.publish(bus_id, travel_date)
+
+
+def _released(func):
+    """
+    `func` for async callers, closing its thread's connections once it
+    returns. The thread is the request's, so this also lets go of the one
+    the view opened before the stream started.
+    """
+    def call(*args):
+        try:
+            return func(*args)
+        finally:
+            connections.close_all()
+    return sync_to_async(call)
+
+
+def _stamp(bus_id, travel_date):
+    return booking_stamp([bus_id], travel_date), hold_stamp(bus_id, travel_date)
+
+
+def _seat_states(bus_id, travel_date, mask, holder):
+    return {
+        seat['id']: {'id': seat['id'], 'booked': seat['is_booked'], 'held': seat['is_held']}
+        for seat in seat_map(bus_id, travel_date, mask, holder=holder)
+    }
+
+
+def _event(name, seats):
+    return f'event: {name}\ndata: {json.dumps({"seats": seats})}\n\n'
+
+
+async def seat_event_stream(bus_id, travel_date, mask, holder=None):
+    """
+    Yields a 'snapshot' event with every seat, then a 'seats' event with the
+    seats whose booked or held flag changed for the legs in `mask`. Holds of
+    `holder` (the viewer's session) do not count as held.
+    """
+    waiter = broker.subscribe(bus_id, travel_date)
+    changed = waiter[1]
+    try:
+        yield f'retry: {RETRY_MILLISECONDS}\n\n'
+        stamp = await broker.stamp(bus_id, travel_date)
+        seats = await _released(_seat_states)(bus_id, travel_date, mask, holder)
+        yield _event('snapshot', list(seats.values()))
+
+        deadline = time.monotonic() + STREAM_SECONDS
+        last_sent = time.monotonic()
+        recheck = False
+        while time.monotonic() < deadline:
+            try:
+                await asyncio.wait_for(changed.wait(), POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            changed.clear()
+
+            latest = await broker.stamp(bus_id, travel_date)
+            # Another worker may commit a booking a moment before it updates the
+            # cached occupancy, so the seats are read once more after a change
+            if latest != stamp or recheck:
+                recheck = latest != stamp
+                stamp = latest
+                current = await _released(_seat_states)(bus_id, travel_date, mask, holder)
+                delta = [state for seat_id, state in current.items() if seats.get(seat_id) != state]
+                seats = current
+                if delta:
+                    yield _event('seats', delta)
+                    last_sent = time.monotonic()
+                    continue
+            if time.monotonic() - last_sent >= HEARTBEAT_SECONDS:
+                yield ': keepalive\n\n'
+                last_sent = time.monotonic()
+    finally:
+        broker.unsubscribe(bus_id, waiter)
@@ -0,0 +1,69 @@
+"""
+Short-lived seat holds between seat selection and payment in bus_book.
+
+Selecting seats takes a hold on each of them for SEAT_HOLD_MINUTES,
+keyed by the booking session. The seats are locked with select_for_update
+while bookings and other sessions' holds are checked, so two sessions
+cannot hold overlapping legs of the same seat, and a clash is reported
+when seats are picked instead of after OTPs and emails at confirmation.
+Expired holds are simply ignored; expire_seat_holds deletes them.
+"""
+import datetime
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from bookbus.models import Seat, SeatHold
+from .seat_events import publish_seat_change
+from .seat_occupancy import booking_mask, get_route, held_seats, seat_conflicts
+
+SEAT_HOLD_MINUTES = getattr(settings, 'SEAT_HOLD_MINUTES', 10)
+
+
+def hold_seats(bus, travel_date, seat_ids, start_stop_id, end_stop_id, holder):
+    """
+    Replaces `holder`'s holds on the bus with holds on `seat_ids` from
+    `start_stop_id` to `end_stop_id`. Returns the names of seats that are
+    booked or held by another session, in which case nothing is held.
+    """
+    route = get_route(bus.pk)
+    wanted = booking_mask(route, start_stop_id, end_stop_id)
+    expires_at = timezone.now() + datetime.timedelta(minutes=SEAT_HOLD_MINUTES)
+
+    with transaction.atomic():
+        # Locking in id order keeps concurrent selections from deadlocking
+        seats = list(Seat.objects.select_for_update().filter(bus=bus, pk__in=seat_ids).order_by('pk'))
+        requested = {seat.pk: wanted for seat in seats}
+        taken = seat_conflicts(bus.pk, travel_date, requested, route)
+        held = held_seats(bus.pk, travel_date, route, exclude_holder=holder, seat_ids=requested)
+        taken |= {seat_id for seat_id, mask in held.items() if mask & wanted}
+        if taken:
+            return [seat.name for seat in seats if seat.pk in taken]
+
+        SeatHold.objects.filter(bus=bus, holder=holder).delete()
+        SeatHold.objects.bulk_create([
+            SeatHold(
+                bus=bus, seat=seat, start_stop_id=start_stop_id, end_stop_id=end_stop_id,
+                travel_date=travel_date, holder=holder, expires_at=expires_at
+            )
+            for seat in seats
+        ])
+        transaction.on_commit(lambda: publish_seat_change(bus.pk, travel_date))
+    return []
+
+
+def held_by_others(bus, travel_date, wanted, holder, route=None):
+    """Seat ids in `wanted` (seat_id -> leg mask) held on overlapping legs by another session"""
+    route = route or get_route(bus.pk)
+    held = held_seats(bus.pk, travel_date, route, exclude_holder=holder, seat_ids=wanted)
+    return {seat_id for seat_id, mask in held.items() if mask & wanted[seat_id]}
+
+
+def release_holds(bus, holder):
+    if SeatHold.objects.filter(bus=bus, holder=holder).delete()[0]:
+        transaction.on_commit(lambda: publish_seat_change(bus.pk))
+
+
+def expire_holds(now=None):
+    """Deletes holds that have run out; returns how many"""
+    deleted, _ = SeatHold.objects.filter(expires_at__lte=now or timezone.now()).delete()
+    return deleted
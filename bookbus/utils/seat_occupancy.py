@@ -0,0 +1,272 @@
+"""
+Cached, segment-aware seat maps for bus_book.
+
+Each bus has a cached seat layout (seats in display order, so a seat's
+position is its ordinal) and a cached route (its stops in stop_order).
+A route with N stops has N-1 legs; leg i runs from stop i to stop i+1.
+For every (bus, travel date) the occupancy is a list holding one leg
+bitmask per seat ordinal, so a booking from stop a to stop b occupies
+bits a..b-1. Checking a request is one AND, recording a booking one OR.
+
+Occupancy is rebuilt from Booking on a cache miss. Its key carries a
+version per (bus, date) that invalidate_occupancy() bumps once bookings
+are made or cancelled, rather than patching the cached masks: the cache
+is shared by every worker, and two patches (or a patch and a rebuild)
+racing each other would lose one. A rebuild reads the version before the
+bookings, and the bump comes after the commit, so masks built from rows
+older than a change are always stored under a version no longer read.
+The database stays authoritative: the booking path still re-checks seats
+under select_for_update.
+
+Seat holds are short-lived, so they are not cached: the seat map reads
+the live holds of a (bus, date) with one indexed query and lays their leg
+masks over the cached occupancy.
+"""
+import time
+import zlib
+from django.core.cache import cache
+from django.db.models import Count
+from django.utils import timezone
+from bookbus.models import Booking, BusStop, Seat, SeatHold
+
+SEAT_CLASSES = ['General', 'Sleeper', 'Luxury']
+INACTIVE_STATUSES = ['Cancelled', 'Refunded']
+LAYOUT_TIMEOUT = 60 * 60 * 24
+OCCUPANCY_TIMEOUT = 60 * 60 * 24
+
+
+def natural_sort_key(seat_class, name):
+    """Sort G2 before G10 within each seat class"""
+    alpha = ''
+    num = ''
+    for char in name:
+        if char.isdigit():
+            num += char
+        else:
+            alpha += char
+    return (seat_class, alpha.lower(), int(num) if num else 0)
+
+
+def _checksum(ids):
+    return format(zlib.crc32(','.join(str(i) for i in ids).encode()), 'x')
+
+
+def get_seat_layout(bus_id):
+    """
+    Returns {'key': ..., 'seats': [{'id', 'name', 'seat_class', 'fare'}, ...]}
+    with seats in display order. 'key' changes whenever the set of seats does.
+    """
+    layout = cache.get(f'seat_layout:{bus_id}')
+    if layout is None:
+        seats = [
+            {'id': seat_id, 'name': name, 'seat_class': seat_class, 'fare': fare}
+            for seat_id, name, seat_class, fare in Seat.objects.filter(bus_id=bus_id).values_list(
+                'id', 'name', 'seat_class', 'fare'
+            )
+        ]
+        seats.sort(key=lambda seat: natural_sort_key(seat['seat_class'], seat['name']))
+        layout = {
+            'key': _checksum(seat['id'] for seat in seats),
+            'seats': seats,
+        }
+        cache.set(f'seat_layout:{bus_id}', layout, LAYOUT_TIMEOUT)
+    return layout
+
+
+def invalidate_seat_layout(bus_id):
+    """Call after a bus's seats are created, deleted or re-priced"""
+    cache.delete(f'seat_layout:{bus_id}')
+
+
+def get_route(bus_id):
+    """
+    Returns {'key': ..., 'bus_stop_ids': [...], 'stop_ids': [...]} in stop_order.
+    'key' changes whenever the stop sequence does.
+    """
+    route = cache.get(f'seat_route:{bus_id}')
+    if route is None:
+        rows = list(
+            BusStop.objects.filter(bus_id=bus_id).order_by('stop_order').values_list('id', 'stop_id')
+        )
+        route = {
+            'key': _checksum(stop_id for _, stop_id in rows),
+            'bus_stop_ids': [bus_stop_id for bus_stop_id, _ in rows],
+            'stop_ids': [stop_id for _, stop_id in rows],
+        }
+        cache.set(f'seat_route:{bus_id}', route, LAYOUT_TIMEOUT)
+    return route
+
+
+def invalidate_route(bus_id):
+    """Call after a bus's stops are rewritten"""
+    cache.delete(f'seat_route:{bus_id}')
+
+
+def seat_ordinals(layout):
+    return {seat['id']: ordinal for ordinal, seat in enumerate(layout['seats'])}
+
+
+def full_mask(route):
+    """Every leg of the route"""
+    return (1 << max(len(route['stop_ids']) - 1, 0)) - 1
+
+
+def leg_mask(start_pos, end_pos):
+    """Legs covered when boarding at stop position start_pos and leaving at end_pos"""
+    return ((1 << (end_pos - start_pos)) - 1) << start_pos
+
+
+def segment_mask(route, start_stop_id, end_stop_id):
+    """
+    Leg mask of a booking between two Stop ids, or None if the pair is not a
+    forward segment of the route.
+    """
+    stop_ids = route['stop_ids']
+    if start_stop_id not in stop_ids:
+        return None
+    start_pos = stop_ids.index(start_stop_id)
+    try:
+        end_pos = stop_ids.index(end_stop_id, start_pos + 1)
+    except ValueError:
+        return None
+    return leg_mask(start_pos, end_pos)
+
+
+def booking_mask(route, start_stop_id, end_stop_id):
+    """Leg mask of an existing booking; bookings that no longer fit the route block every leg"""
+    mask = segment_mask(route, start_stop_id, end_stop_id)
+    return full_mask(route) if mask is None else mask
+
+
+def _occupancy_version_key(bus_id, travel_date):
+    return f'seat_occupancy_version:{bus_id}:{travel_date.isoformat()}'
+
+
+def _occupancy_version(bus_id, travel_date):
+    key = _occupancy_version_key(bus_id, travel_date)
+    version = cache.get(key)
+    if version is None:
+        # Started from the clock, like the bus versions, so an evicted counter never repeats
+        cache.add(key, time.time_ns(), OCCUPANCY_TIMEOUT)
+        version = cache.get(key)
+    return version
+
+
+def _occupancy_cache_key(bus_id, travel_date, layout, route):
+    return (
+        f'seat_occupancy:{bus_id}:{layout["key"]}:{route["key"]}:{travel_date.isoformat()}:'
+        f'{_occupancy_version(bus_id, travel_date)}'
+    )
+
+
+def get_occupancy(bus_id, travel_date, layout=None, route=None):
+    """
+    Leg masks of a bus on a date, one per seat ordinal, rebuilt from Booking on a miss
+    """
+    layout = layout or get_seat_layout(bus_id)
+    route = route or get_route(bus_id)
+    key = _occupancy_cache_key(bus_id, travel_date, layout, route)
+    occupancy = cache.get(key)
+    if occupancy is None:
+        ordinals = seat_ordinals(layout)
+        bookings = Booking.objects.filter(
+            bus_id=bus_id,
+            travel_date=travel_date
+        ).exclude(
+            status__in=INACTIVE_STATUSES
+        ).values_list('seat_id', 'start_stop_id', 'end_stop_id')
+
+        occupancy = [0] * len(layout['seats'])
+        for seat_id, start_stop_id, end_stop_id in bookings:
+            if seat_id in ordinals:
+                occupancy[ordinals[seat_id]] |= booking_mask(route, start_stop_id, end_stop_id)
+        cache.set(key, occupancy, OCCUPANCY_TIMEOUT)
+    return occupancy
+
+
+def invalidate_occupancy(bus_id, travel_date):
+    """Call once bookings of the bus on the date are committed, cancelled or deleted"""
+    key = _occupancy_version_key(bus_id, travel_date)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, time.time_ns(), OCCUPANCY_TIMEOUT)
+
+
+def seat_conflicts(bus_id, travel_date, wanted, route=None):
+    """
+    Seat ids whose existing bookings overlap the requested legs, read from the
+    database. `wanted` maps seat_id -> leg mask.
+    """
+    route = route or get_route(bus_id)
+    bookings = Booking.objects.filter(
+        bus_id=bus_id,
+        seat_id__in=list(wanted),
+        travel_date=travel_date
+    ).exclude(
+        status__in=INACTIVE_STATUSES
+    ).values_list('seat_id', 'start_stop_id', 'end_stop_id')
+
+    return {
+        seat_id
+        for seat_id, start_stop_id, end_stop_id in bookings
+        if booking_mask(route, start_stop_id, end_stop_id) & wanted[seat_id]
+    }
+
+
+def held_seats(bus_id, travel_date, route, exclude_holder=None, seat_ids=None):
+    """
+    {seat_id: leg mask} of the unexpired holds on a bus and date, leaving out
+    those of `exclude_holder`
+    """
+    holds = SeatHold.objects.filter(bus_id=bus_id, travel_date=travel_date, expires_at__gt=timezone.now())
+    if exclude_holder:
+        holds = holds.exclude(holder=exclude_holder)
+    if seat_ids is not None:
+        holds = holds.filter(seat_id__in=list(seat_ids))
+
+    held = {}
+    for seat_id, start_stop_id, end_stop_id in holds.values_list('seat_id', 'start_stop_id', 'end_stop_id'):
+        held[seat_id] = held.get(seat_id, 0) | booking_mask(route, start_stop_id, end_stop_id)
+    return held
+
+
+def seat_map(bus_id, travel_date=None, mask=None, holder=None):
+    """
+    Seats of a bus in display order, each with an 'is_booked' flag telling
+    whether any leg in `mask` (default: the whole route) is taken on the date,
+    and an 'is_held' flag for legs held by a session other than `holder`
+    """
+    layout = get_seat_layout(bus_id)
+    if not travel_date:
+        return [dict(seat, is_booked=False, is_held=False) for seat in layout['seats']]
+
+    route = get_route(bus_id)
+    mask = full_mask(route) if mask is None else mask
+    occupancy = get_occupancy(bus_id, travel_date, layout, route)
+    held = held_seats(bus_id, travel_date, route, exclude_holder=holder)
+    return [
+        dict(
+            seat,
+            is_booked=bool(occupancy[ordinal] & mask),
+            is_held=bool(held.get(seat['id'], 0) & mask)
+        )
+        for ordinal, seat in enumerate(layout['seats'])
+    ]
+
+
+def booked_seat_counts(bus_ids, travel_date):
+    """
+    {bus_id: seats with an active booking on the date} for a page of buses,
+    in one grouped query. A seat counts as taken if any leg of it is booked.
+    """
+    return dict(
+        Booking.objects.filter(
+            bus_id__in=bus_ids,
+            travel_date=travel_date
+        ).exclude(
+            status__in=INACTIVE_STATUSES
+        ).order_by().values('bus_id').annotate(
+            booked=Count('seat', distinct=True)
+        ).values_list('bus_id', 'booked')
+    )
@@ -0,0 +1,109 @@
+"""
+Prefix search over stop names and cities for the stop autocomplete.
+
+Each worker keeps the stops in sorted lists of (normalized key, stop id):
+one keyed on the full name, one on every later word of the name and one
+on the city. A query is a bisect into each list followed by a forward scan
+while the keys still start with it, so finding the top k matches costs
+O(log n + k) however many stops there are. Matches on the start of the
+name rank first, then on a later word, then on the city. Stop saves bump
+a version counter in the cache and each worker rebuilds its index when it
+notices the counter has moved; a missing counter starts from the current
+time in nanoseconds so an evicted one never repeats a version a worker holds.
+"""
+import bisect
+import re
+import threading
+import time
+import unicodedata
+from django.core.cache import cache
+from bookbus.models import Stop
+
+STOP_INDEX_VERSION_KEY = 'stop_index_version'
+DEFAULT_LIMIT = 10
+MAX_LIMIT = 25
+
+_index = None
+_index_version = None
+_index_lock = threading.Lock()
+
+
+def bump_stop_index_version():
+    """Tell every worker that its stop index is stale"""
+    try:
+        cache.incr(STOP_INDEX_VERSION_KEY)
+    except ValueError:
+        cache.set(STOP_INDEX_VERSION_KEY, time.time_ns(), None)
+
+
+def get_stop_index_version():
+    version = cache.get(STOP_INDEX_VERSION_KEY)
+    if version is None:
+        cache.add(STOP_INDEX_VERSION_KEY, time.time_ns(), None)
+        version = cache.get(STOP_INDEX_VERSION_KEY)
+    return version
+
+
+def normalize(text):
+    """Lowercase, accents stripped and punctuation collapsed to single spaces"""
+    text = unicodedata.normalize('NFKD', text)
+    text = ''.join(char for char in text if not unicodedata.combining(char))
+    return ' '.join(re.sub(r'[\W_]+', ' ', text.casefold()).split())
+
+
+class StopIndex:
+    def __init__(self, stops):
+        """`stops` is an iterable of (id, name, city, country code)"""
+        self.stops = {}
+        names, words, cities = [], [], []
+        for stop_id, name, city, country in stops:
+            self.stops[stop_id] = {'id': stop_id, 'name': name, 'city': city, 'country': str(country)}
+            key = normalize(name)
+            names.append((key, stop_id))
+            parts = key.split(' ')
+            for position in range(1, len(parts)):
+                words.append((' '.join(parts[position:]), stop_id))
+            cities.append((normalize(city), stop_id))
+
+        # In rank order; each tier is sorted so a prefix is one contiguous run
+        self.tiers = [sorted(tier) for tier in (names, words, cities)]
+
+    @classmethod
+    def from_database(cls):
+        return cls(Stop.objects.values_list('id', 'name', 'city', 'country').iterator(chunk_size=5000))
+
+    def search(self, query, limit=DEFAULT_LIMIT):
+        """Up to `limit` stops matching `query`, best first"""
+        query = normalize(query)
+        if not query:
+            return []
+
+        results = []
+        seen = set()
+        for tier in self.tiers:
+            position = bisect.bisect_left(tier, (query,))
+            while position < len(tier) and len(results) < limit:
+                key, stop_id = tier[position]
+                if not key.startswith(query):
+                    break
+                if stop_id not in seen:
+                    seen.add(stop_id)
+                    results.append(self.stops[stop_id])
+                position += 1
+        return results
+
+
+def get_stop_index():
+    """The per-worker stop index, rebuilt when the version counter moves"""
+    global _index, _index_version
+    version = get_stop_index_version()
+    if _index is None or _index_version != version:
+        with _index_lock:
+            if _index is None or _index_version != version:
+                _index = StopIndex.from_database()
+                _index_version = version
+    return _index
+
+
+def search_stops(query, limit=DEFAULT_LIMIT):
+    return get_stop_index().search(query, min(max(limit, 1), MAX_LIMIT))
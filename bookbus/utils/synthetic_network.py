@@ -0,0 +1,225 @@
+"""
+Generates a synthetic bus network in the database for benchmarks.
+
+seed_network() bulk-inserts stops clustered around cities, buses running
+lines of 5-15 of those stops with realistic timetables and operating_days,
+their seats, and a history of bookings, all derived from one random seed
+so the same arguments always build the same network. Bulk inserts skip
+model signals, so route segments, trip dates and stop grid cells are
+written here and the per-worker caches are invalidated at the end.
+
+Every row is named after `tag` so clear_network() can remove the lot.
+"""
+import datetime
+import random
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.utils import timezone
+from bookbus.models import Booking, Bus, BusStop, RouteSegmentIndex, Seat, Stop, TripOccurrence
+from users.models import Profile
+from .bus_builder import build_seats
+from .connection_search import bump_timetable_version
+from .geohash import encode_cells
+from .route_index import build_route_segments
+from .seat_occupancy import invalidate_route, invalidate_seat_layout, leg_mask
+from .stop_search import bump_stop_index_version
+from .trip_utils import service_dates
+
+DEFAULT_TAG = 'synthetic'
+STOPS_PER_CITY = 20
+BUSES_PER_LINE = 4
+BUSES_PER_OPERATOR = 50
+BOOKINGS_PER_CUSTOMER = 20
+# Buses run from this many days before the seed date to as many after it
+SERVICE_DAYS = 90
+BATCH_SIZE = 2000
+
+
+def _stops(rng, tag, count):
+    cities = []
+    for index in range(max(1, count // STOPS_PER_CITY)):
+        cities.append((f'{tag.title()} City {index + 1}', rng.uniform(8, 32), rng.uniform(68, 92)))
+
+    stops = []
+    for index in range(count):
+        city, latitude, longitude = cities[index % len(cities)]
+        stops.append(Stop(
+            name=f'{tag} stop {index + 1}',
+            country='IN',
+            city=city,
+            # Within about 10 km of the city centre
+            latitude=round(latitude + rng.uniform(-0.1, 0.1), 6),
+            longitude=round(longitude + rng.uniform(-0.1, 0.1), 6),
+        ))
+    for stop, cell in zip(stops, encode_cells([s.latitude for s in stops], [s.longitude for s in stops])):
+        stop.grid_cell = cell
+    return stops
+
+
+def _timetable(rng, stop_ids):
+    """[(stop_id, arrival_time, is_next_day)] for one run of a line"""
+    minute = rng.randint(5 * 60, 23 * 60)
+    timetable = []
+    for stop_id in stop_ids:
+        day, minute_of_day = divmod(minute, 24 * 60)
+        timetable.append((stop_id, datetime.time(minute_of_day // 60, minute_of_day % 60), day > 0))
+        minute += rng.randint(20, 90)
+        if minute >= 48 * 60:
+            break
+    return timetable
+
+
+def _seat_config(rng):
+    """Mostly general seats, with sleepers on about half the buses and luxury seats on a quarter"""
+    sleepers = rng.choice([0, 0, 10, 16])
+    luxury = rng.choice([0, 0, 0, 6])
+    return {
+        'General': (rng.randint(20, 40), rng.choice([300, 400, 450, 500])),
+        'Sleeper': (sleepers, rng.choice([700, 800, 900]) if sleepers else 0),
+        'Luxury': (luxury, rng.choice([1200, 1500]) if luxury else 0),
+    }
+
+
+def seed_network(stops, buses, bookings, seed=0, tag=DEFAULT_TAG, today=None):
+    """
+    Inserts `stops` stops, `buses` buses and up to `bookings` bookings (fewer
+    if the random picks keep landing on taken seats) and returns the counts
+    of what was written
+    """
+    rng = random.Random(seed)
+    today = today or timezone.localdate()
+    now = timezone.now()
+    start_time = now - datetime.timedelta(days=SERVICE_DAYS)
+    end_time = now + datetime.timedelta(days=SERVICE_DAYS)
+
+    with transaction.atomic():
+        stop_rows = Stop.objects.bulk_create(_stops(rng, tag, max(stops, 2)), batch_size=BATCH_SIZE)
+        stop_ids = [stop.pk for stop in stop_rows]
+
+        operators = User.objects.bulk_create([
+            User(username=f'{tag}-operator-{index + 1}')
+            for index in range(max(1, -(-buses // BUSES_PER_OPERATOR)))
+        ])
+        customers = User.objects.bulk_create([
+            User(username=f'{tag}-customer-{index + 1}', email=f'{tag}-customer-{index + 1}@example.invalid')
+            for index in range(max(1, -(-bookings // BOOKINGS_PER_CUSTOMER)))
+        ])
+        Profile.objects.bulk_create([Profile(user=user) for user in operators + customers], batch_size=BATCH_SIZE)
+
+        # Several buses run each line at different times of day
+        bus_rows, timetables, seat_configs = [], [], []
+        while len(bus_rows) < buses:
+            line = rng.sample(stop_ids, min(rng.randint(5, 15), len(stop_ids)))
+            for _ in range(min(BUSES_PER_LINE, buses - len(bus_rows))):
+                timetable = _timetable(rng, line)
+                bus_rows.append(Bus(
+                    travels=operators[len(bus_rows) // BUSES_PER_OPERATOR],
+                    start_time=start_time,
+                    end_time=end_time,
+                    operating_days=[] if rng.random() < 0.7 else sorted(rng.sample(range(7), rng.randint(1, 6))),
+                    journey_start_id=timetable[0][0],
+                    journey_end_id=timetable[-1][0],
+                ))
+                timetables.append(timetable)
+                seat_configs.append(_seat_config(rng))
+        Bus.objects.bulk_create(bus_rows, batch_size=BATCH_SIZE)
+
+        bus_stops, seats, segments, trips = [], [], [], []
+        for bus, timetable, seat_config in zip(bus_rows, timetables, seat_configs):
+            stops_in_order = [
+                (stop_id, order, arrival_time, is_next_day)
+                for order, (stop_id, arrival_time, is_next_day) in enumerate(timetable, start=1)
+            ]
+            bus_stops.extend(
+                BusStop(bus=bus, stop_id=stop_id, stop_order=order, arrival_time=arrival_time, is_next_day=is_next_day)
+                for stop_id, order, arrival_time, is_next_day in stops_in_order
+            )
+            seats.extend(build_seats(bus, seat_config))
+            segments.extend(build_route_segments(bus.pk, stops_in_order))
+            trips.extend(TripOccurrence(bus=bus, service_date=day) for day in service_dates(bus))
+        BusStop.objects.bulk_create(bus_stops, batch_size=BATCH_SIZE)
+        Seat.objects.bulk_create(seats, batch_size=BATCH_SIZE)
+        RouteSegmentIndex.objects.bulk_create(segments, batch_size=BATCH_SIZE)
+        TripOccurrence.objects.bulk_create(trips, batch_size=BATCH_SIZE)
+
+        booking_rows = _bookings(rng, bookings, bus_rows, timetables, seats, customers, today)
+        Booking.objects.bulk_create(booking_rows, batch_size=BATCH_SIZE)
+
+        transaction.on_commit(bump_timetable_version)
+        transaction.on_commit(bump_stop_index_version)
+
+    return {
+        'stops': len(stop_rows),
+        'buses': len(bus_rows),
+        'bus_stops': len(bus_stops),
+        'seats': len(seats),
+        'route_segments': len(segments),
+        'trips': len(trips),
+        'bookings': len(booking_rows),
+    }
+
+
+def _bookings(rng, count, buses, timetables, seats, customers, today):
+    """
+    Up to `count` bookings over the past SERVICE_DAYS and the next week, never
+    two on overlapping legs of the same seat
+    """
+    seats_by_bus = {}
+    for seat in seats:
+        seats_by_bus.setdefault(seat.bus_id, []).append(seat)
+    dates = {}
+    taken = {}
+    rows = []
+    for _ in range(count * 2):
+        if len(rows) >= count:
+            break
+        index = rng.randrange(len(buses))
+        bus = buses[index]
+        bus_dates = dates.get(bus.pk)
+        if bus_dates is None:
+            bus_dates = dates[bus.pk] = [
+                day for day in service_dates(bus) if day <= today + datetime.timedelta(days=7)
+            ]
+        if not bus_dates:
+            continue
+
+        stop_ids = [stop_id for stop_id, _, _ in timetables[index]]
+        first = rng.randrange(len(stop_ids) - 1)
+        last = rng.randrange(first + 1, len(stop_ids))
+        seat = rng.choice(seats_by_bus[bus.pk])
+        travel_date = rng.choice(bus_dates)
+        mask = leg_mask(first, last)
+        key = (seat.pk, travel_date)
+        if taken.get(key, 0) & mask:
+            continue
+
+        cancelled = rng.random() < 0.1
+        taken[key] = taken.get(key, 0) | (0 if cancelled else mask)
+        customer = rng.choice(customers)
+        rows.append(Booking(
+            bus=bus,
+            customer=customer,
+            seat=seat,
+            start_stop_id=stop_ids[first],
+            end_stop_id=stop_ids[last],
+            travel_date=travel_date,
+            status='Cancelled' if cancelled else 'Completed' if travel_date < today else 'Confirmed',
+            passenger_name=f'Passenger {len(rows) + 1}',
+            passenger_email=customer.email,
+        ))
+    return rows
+
+
+def clear_network(tag=DEFAULT_TAG):
+    """Deletes everything seed_network() made under `tag`; returns how many buses went"""
+    bus_ids = list(Bus.objects.filter(travels__username__startswith=f'{tag}-operator-').values_list('pk', flat=True))
+    with transaction.atomic():
+        # Deleting the users cascades to their buses, bookings and ledger rows
+        User.objects.filter(username__startswith=f'{tag}-').delete()
+        Stop.objects.filter(name__startswith=f'{tag} stop ').delete()
+        transaction.on_commit(bump_timetable_version)
+        transaction.on_commit(bump_stop_index_version)
+    for bus_id in bus_ids:
+        invalidate_route(bus_id)
+        invalidate_seat_layout(bus_id)
+    return len(bus_ids)
@@ -1,38 +1,146 @@
-from users.models import Transaction
+"""
+Coin ledger.
 
-def create_transaction(user, travels, amount, transaction_type, description=None):
+Balances are never read into Python and written back. A customer's coins
+are debited with one conditional UPDATE (coins >= amount), so two
+concurrent bookings cannot both spend the same coins. Operator earnings are
+credited to one of COIN_SHARDS CoinShard rows picked at random, so bookings
+for the same operator do not queue on a single row lock; the operator's
+balance is their profile coins plus the sum of their shards.
+"""
+import random
+from collections import defaultdict
+from functools import reduce
+from operator import or_
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Q, Value, When
+from users.models import CoinShard, Profile, Transaction
+
+COIN_SHARDS = getattr(settings, 'COIN_SHARDS', 8)
+
+# Operators whose shard rows are known to exist, per worker
+_sharded_users = set()
+
+
+def ensure_coin_shards(user_ids):
+    """Creates any missing shard rows for these users"""
+    missing = [user_id for user_id in set(user_ids) if user_id not in _sharded_users]
+    if not missing:
+        return
+    CoinShard.objects.bulk_create(
+        [CoinShard(user_id=user_id, shard=shard) for user_id in missing for shard in range(COIN_SHARDS)],
+        ignore_conflicts=True
+    )
+    # Only remember them once the rows are committed
+    transaction.on_commit(lambda: _sharded_users.update(missing))
+
+
+def _amount_case(amounts):
+    """CASE giving each row its amount, from [(condition, amount)], so many rows change in one UPDATE"""
+    return Case(
+        *[When(condition, then=Value(amount)) for condition, amount in amounts],
+        default=Value(0),
+        output_field=IntegerField()
+    )
+
+
+def credit_operators(credits):
+    """Adds `credits` ({user_id: amount}) to a random shard of each operator in one UPDATE"""
+    if not credits:
+        return
+    ensure_coin_shards(credits)
+    amounts = [
+        (Q(user_id=user_id, shard=random.randrange(COIN_SHARDS)), amount)
+        for user_id, amount in credits.items()
+    ]
+    CoinShard.objects.filter(reduce(or_, [condition for condition, _ in amounts])).update(
+        coins=F('coins') + _amount_case(amounts)
+    )
+
+
+def debit_operators(debits):
+    """Takes `debits` ({user_id: amount}) off each operator's profile in one UPDATE"""
+    if not debits:
+        return
+    amounts = [(Q(user_id=user_id), amount) for user_id, amount in debits.items()]
+    Profile.objects.filter(user_id__in=list(debits)).update(
+        coins=F('coins') - _amount_case(amounts)
+    )
+
+
+def fold_coin_shards(user):
+    """Moves a user's shard coins onto their profile so they can be spent"""
+    with transaction.atomic():
+        shards = list(CoinShard.objects.select_for_update().filter(user=user).exclude(coins=0))
+        total = sum(shard.coins for shard in shards)
+        if not total:
+            return 0
+        CoinShard.objects.filter(pk__in=[shard.pk for shard in shards]).update(coins=0)
+        Profile.objects.filter(user=user).update(coins=F('coins') + total)
+    return total
+
+
+def debit_user(user, amount):
+    """Conditionally takes `amount` off the user's profile; raises ValueError if they cannot pay"""
+    if Profile.objects.filter(user=user, coins__gte=amount).update(coins=F('coins') - amount):
+        return
+    # Operators spending their own earnings
+    if fold_coin_shards(user) and Profile.objects.filter(user=user, coins__gte=amount).update(
+        coins=F('coins') - amount
+    ):
+        return
+    raise ValueError("Insufficient coins")
+
+
+def post_transactions(user, transaction_type, entries):
     """
-    Creates a transaction and updates the profile's coin balance
+    Records several transactions of one type for `user` and applies them with
+    one update of the user's profile and one of the operators' balances.
+    `entries` is an iterable of (travels, amount, description). Zero amounts
+    (free seats) are recorded but move no coins.
+    Raises ValueError, writing nothing, if the user cannot pay.
     """
     if transaction_type not in [choice[0] for choice in Transaction.TRANSACTION_TYPES]:
         raise ValueError("Invalid transaction type")
-    
-    # Create the transaction record
-    transaction = Transaction.objects.create(
-        user=user,
-        travels=travels,
-        amount=amount,
-        transaction_type=transaction_type,
-        description=description
-    )
-    
-    # Update the profile's coin balance
-    if transaction_type == 'BOOKING':
-        if user.profile.coins < amount:
-            raise ValueError("Insufficient coins")
-        user.profile.coins -= amount
-        travels.profile.coins += amount
-
-
-    elif transaction_type == 'CANCELLATION':
-        user.profile.coins += amount
-        travels.profile.coins -= amount
-    
-    elif transaction_type == 'ADD_COINS':
-        user.profile.coins += amount
-    
-    user.profile.save()
-    if travels:
-        travels.profile.save()
-
-    return transaction
\ No newline at end of file
+    entries = list(entries)
+    if any(amount < 0 for _, amount, _ in entries):
+        raise ValueError("Amount cannot be negative")
+
+    total = sum(amount for _, amount, _ in entries)
+    per_operator = defaultdict(int)
+    for travels, amount, _ in entries:
+        if travels and amount:
+            per_operator[travels.pk] += amount
+
+    with transaction.atomic():
+        if not total:
+            pass
+        elif transaction_type == 'BOOKING':
+            debit_user(user, total)
+            credit_operators(per_operator)
+
+        elif transaction_type == 'CANCELLATION':
+            Profile.objects.filter(user=user).update(coins=F('coins') + total)
+            debit_operators(per_operator)
+
+        elif transaction_type == 'ADD_COINS':
+            Profile.objects.filter(user=user).update(coins=F('coins') + total)
+
+        return Transaction.objects.bulk_create([
+            Transaction(
+                user=user,
+                travels=travels,
+                amount=amount,
+                transaction_type=transaction_type,
+                description=description
+            )
+            for travels, amount, description in entries
+        ])
+
+
+def create_transaction(user, travels, amount, transaction_type, description=None):
+    """
+    Creates a transaction and updates the coin balances
+    """
+    return post_transactions(user, transaction_type, [(travels, amount, description)])[0]
@@ -0,0 +1,44 @@
+import datetime
+from django.db import transaction
+from bookbus.models import TripOccurrence
+
+
+def service_dates(bus):
+    """
+    Returns every date the bus runs on, using the same rules as Bus.runs_on_date
+    """
+    day = bus.start_time.date()
+    last_day = bus.end_time.date()
+    dates = []
+    while day <= last_day:
+        if not bus.operating_days or day.weekday() in bus.operating_days:
+            dates.append(day)
+        day += datetime.timedelta(days=1)
+    return dates
+
+
+def sync_trip_occurrences(bus):
+    """
+    Brings the TripOccurrence rows of a bus in line with its current schedule.
+    Only the dates that were added or removed are written.
+    """
+    wanted = set(service_dates(bus))
+
+    with transaction.atomic():
+        existing = set(
+            TripOccurrence.objects.filter(bus=bus).values_list('service_date', flat=True)
+        )
+
+        stale = existing - wanted
+        if stale:
+            TripOccurrence.objects.filter(bus=bus, service_date__in=stale).delete()
+
+        missing = wanted - existing
+        if missing:
+            TripOccurrence.objects.bulk_create(
+                [TripOccurrence(bus=bus, service_date=day) for day in sorted(missing)],
+                batch_size=1000,
+                ignore_conflicts=True
+            )
+
+    return len(missing), len(stale)
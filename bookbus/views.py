@@ -3,33 +3,49 @@ from django.shortcuts import render, get_object_or_404, redirect
 from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
 from django.contrib.auth.models import User
 from django.views.generic import ListView, DetailView, CreateView, UpdateView, DeleteView, TemplateView, View
-from .models import Bus, Booking, BusStop, Seat, Stop
-from .forms import BookingSeatForm, FilterForm, BusForm, StopForm, BusStopForm, SeatSelectionForm, PassengerInfoForm
-from django.db.models import Q, F, Subquery, OuterRef, Prefetch, Exists, BooleanField, Value
-import datetime, math
+from .models import Bus, Booking, BusStop, Seat, Stop, RouteSegmentIndex, ExportJob
+from .forms import FilterForm, BusForm, StopForm, BusStopForm, PassengerInfoForm
+from django.db.models import Prefetch, prefetch_related_objects
+import datetime
 from django.utils import timezone
-from django.forms import ValidationError
 from django.contrib import messages
 from django.db import transaction
-from django.http import HttpResponse, HttpResponseForbidden
-from django.urls import reverse_lazy
-from openpyxl import Workbook
-from openpyxl.utils import get_column_letter
-from openpyxl.styles import Font, Alignment
+from django.http import HttpResponse, HttpResponseForbidden, FileResponse, Http404, StreamingHttpResponse
+from django.urls import reverse, reverse_lazy
 from django.http import JsonResponse
 from django.views.decorators.csrf import csrf_exempt
-from .utils.otp_utils import send_otp_email
+from .utils.otp_utils import asend_otp_email
+from .utils.export_utils import export_bookings_file, request_export
 from .utils.transaction_utils import create_transaction
-import requests
+from .utils.bus_builder import parse_stops, save_bus, seat_config
+from .utils.connection_search import find_connections, get_timetable_version
+from .utils.seat_occupancy import (
+    SEAT_CLASSES, get_seat_layout, get_route, seat_ordinals, get_occupancy, invalidate_occupancy, seat_map,
+    leg_mask, booked_seat_counts
+)
+from .utils.pagination import keyset_page
+from .utils.bus_cache import ROUTE_NAMES_FRAGMENT, bus_versions, cached_fragments, seat_totals, with_cache_versions
+from .utils.conditional import booking_stamp, hold_stamp, not_modified, page_etag, with_validator
+from .utils.seat_holds import SEAT_HOLD_MINUTES, hold_seats, release_holds
+from .utils.seat_events import publish_seat_change, seat_event_stream
+from .utils.booking_service import commit_bookings
+from .utils.idempotency import idempotent
+from .utils.stop_search import DEFAULT_LIMIT, search_stops
+from .utils.metrics import render_metrics
+from .utils.nearby_stops import DEFAULT_K, DEFAULT_RADIUS_M, DUPLICATE_RADIUS_M, nearest_stops, stop_exists_near
 from django.conf import settings
+from django.utils.crypto import constant_time_compare
+from django.utils.functional import SimpleLazyObject
+from asgiref.sync import sync_to_async
 
 logger = logging.getLogger(__name__)
 
 def home(request):
     form = FilterForm(request.GET or None)
-    buses = Bus.objects.prefetch_related(
-        Prefetch('bus_stops', queryset=BusStop.objects.select_related('stop').order_by('stop_order'))
-    ).all()
+    buses = Bus.objects.select_related('travels', 'journey_start', 'journey_end')
+    travel_date = None
+    connection_search = None
+    connections = []
     
     if form.is_valid():
         start_stop = form.cleaned_data.get('journey_start')
@@ -37,48 +53,129 @@ def home(request):
         travel_date = form.cleaned_data.get('travel_date')
         
         if start_stop and end_stop:
-            start_pos = Subquery(
-                BusStop.objects.filter(
-                    bus=OuterRef('pk'),
-                    stop=start_stop
-                ).values('stop_order')[:1]
-            )
-            end_pos = Subquery(
-                BusStop.objects.filter(
-                    bus=OuterRef('pk'),
-                    stop=end_stop
-                ).values('stop_order')[:1]
-            )
-            buses = buses.annotate(
-                start_pos=start_pos,
-                end_pos=end_pos
-            ).filter(
-                start_pos__isnull=False,
-                end_pos__isnull=False,
-                start_pos__lt=F('end_pos')
-            ).distinct()
+            # One lookup on the precomputed stop-pair index
+            matching_buses = RouteSegmentIndex.objects.filter(
+                from_stop=start_stop,
+                to_stop=end_stop
+            ).values('bus_id')
+            buses = buses.filter(pk__in=matching_buses)
         elif start_stop:
-            buses = buses.filter(bus_stops__stop=start_stop)
+            buses = buses.filter(pk__in=BusStop.objects.filter(stop=start_stop).values('bus_id'))
         elif end_stop:
-            buses = buses.filter(bus_stops__stop=end_stop)
+            buses = buses.filter(pk__in=BusStop.objects.filter(stop=end_stop).values('bus_id'))
         
-        # Date filtering - now shows both recurring and date-range matches
+        # Date filtering - join against the materialized trip dates so both
+        # recurring and date-range buses are matched in the database
         if travel_date:
-            if isinstance(travel_date, str):
-                travel_date = datetime.datetime.strptime(travel_date, '%Y-%m-%d').date()
-            
-            buses = [bus for bus in buses if bus.runs_on_date(travel_date)]
-    
+            buses = buses.filter(trips__service_date=travel_date)
+
+        if start_stop and end_stop and travel_date:
+            # To the minute, so the page (and its ETag) stays the same for a minute
+            departure_time = (
+                timezone.localtime().time().replace(second=0, microsecond=0)
+                if travel_date == timezone.localdate() else None
+            )
+            connection_search = (start_stop.pk, end_stop.pk, travel_date, departure_time)
+
+    page = keyset_page(buses, after=request.GET.get('after'), before=request.GET.get('before'))
+    with_cache_versions(page.object_list)
+
+    # Answered from the client's copy unless a bus on the page, its bookings on
+    # the date or the timetable behind the connections has changed
+    etag = page_etag(
+        request, request.GET.urlencode(), timezone.localdate(),
+        [(bus.pk, bus.cache_version) for bus in page], page.next_cursor, page.previous_cursor,
+        booking_stamp([bus.pk for bus in page], travel_date) if travel_date else None,
+        (connection_search, get_timetable_version()) if connection_search else None,
+    )
+    # Anonymous visitors all see the same unfiltered listing
+    shared = not request.user.is_authenticated and not any(request.GET.get(name) for name in FilterForm.base_fields)
+    response = not_modified(request, etag, shared)
+    if response:
+        return response
+
+    # Journeys that need a change of bus, from the in-memory timetable
+    if connection_search:
+        journeys = find_connections(*connection_search)
+        connections = connection_summaries([journey for journey in journeys if journey.transfers > 0])
+
+    # Stops are only loaded for buses whose cached route line is missing or stale
+    cached = cached_fragments(ROUTE_NAMES_FRAGMENT, page.object_list)
+    prefetch_related_objects(
+        [bus for bus in page if bus.pk not in cached],
+        Prefetch('bus_stops', queryset=BusStop.objects.select_related('stop').order_by('stop_order'))
+    )
+    seat_total = seat_totals(page.object_list)
+    booked = booked_seat_counts([bus.pk for bus in page], travel_date) if travel_date else {}
+    for bus in page:
+        bus.available_seats = seat_total[bus.pk] - booked.get(bus.pk, 0)
+
     context = {
         'form': form,
-        'buses': buses,
+        'buses': page,
+        'connections': connections,
         'today': datetime.datetime.now().date(),
-        'start_cities': Stop.objects.all(),
-        'end_cities': Stop.objects.all(),
-        'is_paginated': True,
-        'page_obj': buses
+        'page': page,
+        'next_query': page_query(request, after=page.next_cursor),
+        'previous_query': page_query(request, before=page.previous_cursor),
     }
-    return render(request, 'bookbus/home.html', context)
+    return with_validator(render(request, 'bookbus/home.html', context), etag, shared)
+
+
+def page_query(request, **cursor):
+    """The current search's query string pointing at another page"""
+    params = request.GET.copy()
+    params.pop('after', None)
+    params.pop('before', None)
+    params.update({name: value for name, value in cursor.items() if value})
+    return params.urlencode()
+
+
+def stop_search(request):
+    """Autocomplete for the stop pickers: the best matching stops as JSON"""
+    try:
+        limit = int(request.GET.get('limit', DEFAULT_LIMIT))
+    except ValueError:
+        limit = DEFAULT_LIMIT
+    return JsonResponse({'results': search_stops(request.GET.get('q', ''), limit)})
+
+
+def nearby_stops(request):
+    """The stops nearest to ?lat=&lng= as JSON, within ?radius= metres"""
+    try:
+        lat = float(request.GET['lat'])
+        lng = float(request.GET['lng'])
+        k = int(request.GET.get('k', DEFAULT_K))
+        radius = float(request.GET.get('radius', DEFAULT_RADIUS_M))
+    except (KeyError, ValueError):
+        return JsonResponse({'error': 'lat and lng are required numbers'}, status=400)
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        return JsonResponse({'error': 'lat or lng out of range'}, status=400)
+    return JsonResponse({'results': nearest_stops(lat, lng, k, radius)})
+
+
+def connection_summaries(journeys):
+    """Resolve the stop ids of each journey leg for display"""
+    stop_ids = {stop_id for journey in journeys for leg in journey.legs for stop_id in (leg.from_stop_id, leg.to_stop_id)}
+    stops = Stop.objects.in_bulk(stop_ids)
+    return [
+        {
+            'departure': journey.departure,
+            'arrival': journey.arrival,
+            'transfers': journey.transfers,
+            'legs': [
+                {
+                    'bus_id': leg.bus_id,
+                    'from_stop': stops.get(leg.from_stop_id),
+                    'to_stop': stops.get(leg.to_stop_id),
+                    'departure': leg.departure,
+                    'arrival': leg.arrival,
+                }
+                for leg in journey.legs
+            ]
+        }
+        for journey in journeys
+    ]
 
 
 class BusListView(ListView):
@@ -98,7 +195,9 @@ class UserBusListView(ListView):
 
     def get_queryset(self):
         user = get_object_or_404(User, username=self.kwargs.get('username'))
-        return Bus.objects.filter(travels=user).order_by('-start_time')
+        return Bus.objects.filter(travels=user).select_related(
+            'travels', 'journey_start', 'journey_end'
+        ).order_by('-start_time')
 
 
 class UserBookingListView(ListView):
@@ -115,6 +214,30 @@ class UserBookingListView(ListView):
 class BusDetailView(DetailView):
     model = Bus
 
+    def get_queryset(self):
+        return Bus.objects.select_related('travels')
+
+    def get(self, request, *args, **kwargs):
+        # The page only changes with the bus's version (and the user)
+        etag = page_etag(request, bus_versions([self.kwargs['pk']])[self.kwargs['pk']])
+        shared = not request.user.is_authenticated
+        return not_modified(request, etag, shared) or with_validator(
+            super().get(request, *args, **kwargs), etag, shared
+        )
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        bus = with_cache_versions([self.object])[0]
+        # The route and seat blocks are cached per bus version; stops and the
+        # seat summary are only loaded when a block has to be rendered again
+        bus_stops = SimpleLazyObject(
+            lambda: list(BusStop.objects.filter(bus=bus).select_related('stop').order_by('stop_order'))
+        )
+        context['bus_stops'] = bus_stops
+        context['first_stop'] = SimpleLazyObject(lambda: bus_stops[0] if bus_stops else None)
+        context['last_stop'] = SimpleLazyObject(lambda: bus_stops[-1] if bus_stops else None)
+        return context
+
 class BusCreateView(LoginRequiredMixin, UserPassesTestMixin, CreateView):
     model = Bus
     form_class = BusForm
@@ -123,95 +246,21 @@ class BusCreateView(LoginRequiredMixin, UserPassesTestMixin, CreateView):
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context['stop_form'] = BusStopForm()
-        context['all_stops'] = Stop.objects.all()
         return context
 
     def form_valid(self, form):
         self.object = form.save(commit=False)
         self.object.travels = self.request.user
-        
-        # Get stops and times from form data
-        stop_order = self.request.POST.get('stop_order', '').split(',')
-        stop_times = self.request.POST.get('stop_times', '').split(',')
-        next_day_flags = self.request.POST.get('next_day_flags', '').split(',')
-        
-        stop_order = [stop_id for stop_id in stop_order if stop_id]
-        stop_times = [time for time in stop_times if time]
-        next_day_flags = [flag for flag in next_day_flags if flag]
-        
-        if len(stop_order) < 2:
-            form.add_error(None, "Please select at least 2 stops")
-            return self.form_invalid(form)
-            
-        if len(stop_order) != len(stop_times) or len(stop_order) != len(next_day_flags):
-            form.add_error(None, "Invalid stop data")
-            return self.form_invalid(form)
-            
+
         try:
-            # Set journey start/end
-            self.object.journey_start = Stop.objects.get(id=stop_order[0])
-            self.object.journey_end = Stop.objects.get(id=stop_order[-1])
-            self.object.save()
-            
-            # Create BusStop relationships with times
-            for order, (stop_id, time_str, next_day) in enumerate(zip(stop_order, stop_times, next_day_flags), start=1):
-                try:
-                    time_obj = datetime.datetime.strptime(time_str, "%H:%M").time()
-                except ValueError:
-                    form.add_error(None, f"Invalid time format for stop {stop_id}")
-                    return self.form_invalid(form)
-                    
-                BusStop.objects.create(
-                    bus=self.object,
-                    stop_id=stop_id,
-                    stop_order=order,
-                    arrival_time=time_obj,
-                    is_next_day=next_day == '1'
-                )
-            
-            # Create Seat objects
-            self.create_seats(
-                general_count=form.cleaned_data['general_count'],
-                sleeper_count=form.cleaned_data['sleeper_count'],
-                luxury_count=form.cleaned_data['luxury_count'],
-                general_fare=form.cleaned_data['general_fare'],
-                sleeper_fare=form.cleaned_data['sleeper_fare'],
-                luxury_fare=form.cleaned_data['luxury_fare']
-            )
-                
-            return redirect('bus-detail', pk=self.object.pk)
-            
-        except Stop.DoesNotExist:
-            form.add_error(None, "One or more selected stops no longer exist")
+            # Stops, seats and the route index are written in one transaction
+            save_bus(self.object, parse_stops(self.request.POST), seat_config(form.cleaned_data))
+        except ValueError as e:
+            self.object = None
+            form.add_error(None, str(e))
             return self.form_invalid(form)
-    
-    def create_seats(self, general_count, sleeper_count, luxury_count, general_fare, sleeper_fare, luxury_fare):
-        # Create General seats
-        for i in range(1, general_count + 1):
-            Seat.objects.create(
-                bus=self.object,
-                name=f"G{i}",
-                seat_class="General",
-                fare=general_fare
-            )
-        
-        # Create Sleeper seats
-        for i in range(1, sleeper_count + 1):
-            Seat.objects.create(
-                bus=self.object,
-                name=f"S{i}",
-                seat_class="Sleeper",
-                fare=sleeper_fare
-            )
-        
-        # Create Luxury seats
-        for i in range(1, luxury_count + 1):
-            Seat.objects.create(
-                bus=self.object,
-                name=f"L{i}",
-                seat_class="Luxury",
-                fare=luxury_fare
-            )
+
+        return redirect('bus-detail', pk=self.object.pk)
     
     def test_func(self):
         return self.request.user.groups.filter(name='BusAdmin').exists()
@@ -222,9 +271,15 @@ class BusUpdateView(LoginRequiredMixin, UserPassesTestMixin, UpdateView):
     form_class = BusForm
     template_name = 'bookbus/bus_form.html'
 
+    def get_queryset(self):
+        # Seat counts and fares for BusForm come from the annotations
+        return Bus.objects.with_seat_summary().prefetch_related(
+            Prefetch('bus_stops', queryset=BusStop.objects.select_related('stop').order_by('stop_order'))
+        )
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        current_stops = self.object.bus_stops.order_by('stop_order')
+        current_stops = list(self.object.bus_stops.all())
         
         # Prepare initial data for stops, times and next_day flags
         stop_ids = []
@@ -232,7 +287,7 @@ class BusUpdateView(LoginRequiredMixin, UserPassesTestMixin, UpdateView):
         next_day_flags = []
         
         for bs in current_stops:
-            stop_ids.append(str(bs.stop.id))
+            stop_ids.append(str(bs.stop_id))
             stop_times.append(bs.arrival_time.strftime("%H:%M"))
             next_day_flags.append('1' if bs.is_next_day else '0')
             
@@ -243,121 +298,20 @@ class BusUpdateView(LoginRequiredMixin, UserPassesTestMixin, UpdateView):
         }
         
         context['stop_form'] = BusStopForm(initial=initial_data)
-        context['all_stops'] = Stop.objects.all()
         context['current_stops'] = current_stops
         return context
 
     def form_valid(self, form):
-        self.object = form.save()
-        
-        # Clear existing stops
-        self.object.bus_stops.all().delete()
-        
-        # Get new stop data
-        stop_order = self.request.POST.get('stop_order', '').split(',')
-        stop_times = self.request.POST.get('stop_times', '').split(',')
-        next_day_flags = self.request.POST.get('next_day_flags', '').split(',')
-        
-        stop_order = [stop_id for stop_id in stop_order if stop_id]
-        stop_times = [time for time in stop_times if time]
-        next_day_flags = [flag for flag in next_day_flags if flag]
-        
-        if len(stop_order) < 2:
-            form.add_error(None, "Please select at least 2 stops")
-            return self.form_invalid(form)
-            
-        if len(stop_order) != len(stop_times) or len(stop_order) != len(next_day_flags):
-            form.add_error(None, "Invalid stop data")
-            return self.form_invalid(form)
-            
+        self.object = form.save(commit=False)
+
         try:
-            # Set journey start/end
-            self.object.journey_start = Stop.objects.get(id=stop_order[0])
-            self.object.journey_end = Stop.objects.get(id=stop_order[-1])
-            self.object.save()
-            
-            # Create BusStop relationships with times
-            for order, (stop_id, time_str, next_day) in enumerate(zip(stop_order, stop_times, next_day_flags), start=1):
-                try:
-                    time_obj = datetime.datetime.strptime(time_str, "%H:%M").time()
-                except ValueError:
-                    form.add_error(None, f"Invalid time format for stop {stop_id}")
-                    return self.form_invalid(form)
-                    
-                BusStop.objects.create(
-                    bus=self.object,
-                    stop_id=stop_id,
-                    stop_order=order,
-                    arrival_time=time_obj,
-                    is_next_day=next_day == '1'
-                )
-            
-            # Recreate seats if configuration changed
-            if self.seat_config_changed(form.cleaned_data):
-                self.object.seats.all().delete()
-                self.create_seats(
-                    general_count=form.cleaned_data['general_count'],
-                    sleeper_count=form.cleaned_data['sleeper_count'],
-                    luxury_count=form.cleaned_data['luxury_count'],
-                    general_fare=form.cleaned_data['general_fare'],
-                    sleeper_fare=form.cleaned_data['sleeper_fare'],
-                    luxury_fare=form.cleaned_data['luxury_fare']
-                )
-                
-            return redirect('bus-detail', pk=self.object.pk)
-            
-        except Stop.DoesNotExist:
-            form.add_error(None, "One or more selected stops no longer exist")
+            # Only the stops, seats and route index rows that changed are written
+            save_bus(self.object, parse_stops(self.request.POST), seat_config(form.cleaned_data))
+        except ValueError as e:
+            form.add_error(None, str(e))
             return self.form_invalid(form)
-    
-    def seat_config_changed(self, cleaned_data):
-        current_counts = {
-            'general': self.object.seats.filter(seat_class="General").count(),
-            'sleeper': self.object.seats.filter(seat_class="Sleeper").count(),
-            'luxury': self.object.seats.filter(seat_class="Luxury").count()
-        }
-        current_fares = {
-            'general': self.object.seats.filter(seat_class="General").first().fare if self.object.seats.filter(seat_class="General").exists() else 0,
-            'sleeper': self.object.seats.filter(seat_class="Sleeper").first().fare if self.object.seats.filter(seat_class="Sleeper").exists() else 0,
-            'luxury': self.object.seats.filter(seat_class="Luxury").first().fare if self.object.seats.filter(seat_class="Luxury").exists() else 0
-        }
-        
-        return (
-            cleaned_data['general_count'] != current_counts['general'] or
-            cleaned_data['sleeper_count'] != current_counts['sleeper'] or
-            cleaned_data['luxury_count'] != current_counts['luxury'] or
-            cleaned_data['general_fare'] != current_fares['general'] or
-            cleaned_data['sleeper_fare'] != current_fares['sleeper'] or
-            cleaned_data['luxury_fare'] != current_fares['luxury']
-        )
 
-    def create_seats(self, general_count, sleeper_count, luxury_count, general_fare, sleeper_fare, luxury_fare):
-        # Create General seats
-        for i in range(1, general_count + 1):
-            Seat.objects.create(
-                bus=self.object,
-                name=f"G{i}",
-                seat_class="General",
-                fare=general_fare
-            )
-        
-        # Create Sleeper seats
-        for i in range(1, sleeper_count + 1):
-            Seat.objects.create(
-                bus=self.object,
-                name=f"S{i}",
-                seat_class="Sleeper",
-                fare=sleeper_fare
-            )
-        
-        # Create Luxury seats
-        for i in range(1, luxury_count + 1):
-            Seat.objects.create(
-                bus=self.object,
-                name=f"L{i}",
-                seat_class="Luxury",
-                fare=luxury_fare
-            )
+        return redirect('bus-detail', pk=self.object.pk)
 
     def test_func(self):
         bus = self.get_object()
@@ -371,9 +325,47 @@ class BusDeleteView(LoginRequiredMixin, UserPassesTestMixin, DeleteView):
         bus = self.get_object()
         return self.request.user == bus.travels
         
+def booking_segment(route, booking_data):
+    """
+    Stop positions (boarding, alighting) chosen for the seat map, defaulting
+    to the whole route when nothing valid is stored in the session
+    """
+    last = max(len(route['bus_stop_ids']) - 1, 0)
+    segment = booking_data.get('segment') or []
+    if len(segment) == 2 and all(bus_stop_id in route['bus_stop_ids'] for bus_stop_id in segment):
+        start_pos = route['bus_stop_ids'].index(segment[0])
+        end_pos = route['bus_stop_ids'].index(segment[1])
+        if start_pos < end_pos:
+            return start_pos, end_pos
+    return 0, last
+
+
+def booking_holder(request):
+    """The session key seat holds are taken under, creating the session if needed"""
+    if not request.session.session_key:
+        request.session.save()
+    return request.session.session_key
+
+
+def bus_book_etag(request, pk, booking_data):
+    """
+    Validator for the seat map page: the bus's version, this session's
+    choices, and the bookings and holds on the chosen date
+    """
+    try:
+        travel_date = datetime.datetime.strptime(booking_data.get('travel_date') or '', '%Y-%m-%d').date()
+    except ValueError:
+        travel_date = None
+    return page_etag(
+        request, bus_versions([pk])[pk], datetime.date.today(), request.session.session_key,
+        sorted(booking_data.items()),
+        booking_stamp([pk], travel_date) if travel_date else None,
+        hold_stamp(pk, travel_date) if travel_date else None,
+    )
+
+
+@idempotent('confirm_booking')
 def bus_book(request, pk):
-    bus = get_object_or_404(Bus, pk=pk)
-    
     # Initialize booking data from session
     booking_data = request.session.get('booking_data', {
         'selected_seats': [],
@@ -382,6 +374,14 @@ def bus_book(request, pk):
         'sent_otps': {}  # {email: timestamp}
     })
 
+    # Polling the seat map re-renders it only after something on it changed
+    etag = bus_book_etag(request, pk, booking_data) if request.method in ('GET', 'HEAD') else None
+    response = not_modified(request, etag)
+    if response:
+        return response
+
+    bus = get_object_or_404(Bus, pk=pk)
+
     if request.method == 'POST':
         if 'update_date' in request.POST:
             # Handle date change
@@ -399,6 +399,7 @@ def bus_book(request, pk):
                     messages.error(request, "Bus doesn't operate on selected date")
                 else:
                     # Update session with new date and clear selections
+                    release_holds(bus, booking_holder(request))
                     booking_data['travel_date'] = travel_date_str
                     booking_data['selected_seats'] = []
                     booking_data['verified_emails'] = {}
@@ -408,6 +409,27 @@ def bus_book(request, pk):
             except ValueError:
                 messages.error(request, "Invalid date format")
             return redirect('bus-book', pk=bus.pk)
+
+        if 'update_segment' in request.POST:
+            # Handle boarding/alighting change for the seat map
+            route = get_route(bus.pk)
+            try:
+                start_id = int(request.POST.get('segment_start'))
+                end_id = int(request.POST.get('segment_end'))
+            except (TypeError, ValueError):
+                messages.error(request, "Invalid boarding or destination stop")
+                return redirect('bus-book', pk=bus.pk)
+
+            if (start_id not in route['bus_stop_ids'] or end_id not in route['bus_stop_ids']
+                    or route['bus_stop_ids'].index(start_id) >= route['bus_stop_ids'].index(end_id)):
+                messages.error(request, "Destination must come after the boarding stop")
+            else:
+                release_holds(bus, booking_holder(request))
+                booking_data['segment'] = [start_id, end_id]
+                booking_data['selected_seats'] = []
+                request.session['booking_data'] = booking_data
+                request.session.modified = True
+            return redirect('bus-book', pk=bus.pk)
         
         if 'select_seats' in request.POST:
             # Validate travel date first
@@ -428,12 +450,14 @@ def bus_book(request, pk):
                 messages.error(request, "Please select at least one seat")
                 return redirect('bus-book', pk=bus.pk)
             
-            # Convert to integers and validate
+            # Convert to integers and validate against the cached seat layout
+            layout = get_seat_layout(bus.pk)
+            ordinals = seat_ordinals(layout)
             valid_seat_ids = []
             for seat_id in selected_seats:
                 try:
                     seat_id_int = int(seat_id)
-                    if Seat.objects.filter(id=seat_id_int, bus=bus).exists():
+                    if seat_id_int in ordinals:
                         valid_seat_ids.append(seat_id_int)
                 except (ValueError, TypeError):
                     continue
@@ -442,16 +466,29 @@ def bus_book(request, pk):
                 messages.error(request, "Invalid seat selection")
                 return redirect('bus-book', pk=bus.pk)
             
-            # Check seat availability
-            unavailable_seats = Booking.objects.filter(
-                seat_id__in=valid_seat_ids,
-                travel_date=travel_date
-            ).exclude(
-                status__in=['Cancelled', 'Refunded']  # Exclude cancelled bookings
-            ).values_list('seat_id', flat=True)
-
-            if unavailable_seats.exists():
-                messages.error(request, f"Seat(s) {', '.join(map(str, unavailable_seats))} are unavailable")
+            # Check seat availability for the chosen legs against the occupancy masks
+            route = get_route(bus.pk)
+            segment_start, segment_end = booking_segment(route, booking_data)
+            wanted = leg_mask(segment_start, segment_end)
+            occupancy = get_occupancy(bus.pk, travel_date, layout, route)
+            unavailable_seats = [
+                layout['seats'][ordinals[seat_id]]['name']
+                for seat_id in valid_seat_ids
+                if occupancy[ordinals[seat_id]] & wanted
+            ]
+
+            if unavailable_seats:
+                messages.error(request, f"Seat(s) {', '.join(unavailable_seats)} are unavailable")
+                return redirect('bus-book', pk=bus.pk)
+
+            # Reserve the seats while the passenger verifies emails and pays
+            unavailable_seats = hold_seats(
+                bus, travel_date, valid_seat_ids,
+                route['stop_ids'][segment_start], route['stop_ids'][segment_end],
+                booking_holder(request)
+            )
+            if unavailable_seats:
+                messages.error(request, f"Seat(s) {', '.join(unavailable_seats)} were just taken by another passenger")
                 return redirect('bus-book', pk=bus.pk)
             
             # Update session with selected seats
@@ -459,7 +496,11 @@ def bus_book(request, pk):
             request.session['booking_data'] = booking_data
             request.session.modified = True
             
-            messages.success(request, f"Selected {len(valid_seat_ids)} seat(s). Please enter passenger details.")
+            messages.success(
+                request,
+                f"Selected {len(valid_seat_ids)} seat(s), held for {SEAT_HOLD_MINUTES} minutes. "
+                f"Please enter passenger details."
+            )
             return redirect('bus-book', pk=bus.pk)
         
         elif 'confirm_booking' in request.POST:
@@ -481,8 +522,9 @@ def bus_book(request, pk):
             profile = request.user.profile
             
             # Check if user has enough coins
-            if profile.coins < total_cost:
-                messages.error(request, f"Insufficient coins. Needed: {total_cost}, Available: {profile.coins}")
+            balance = profile.balance
+            if balance < total_cost:
+                messages.error(request, f"Insufficient coins. Needed: {total_cost}, Available: {balance}")
                 return redirect('bus-book', pk=bus.pk)
             
             # Verify OTPs and collect passenger data
@@ -542,132 +584,24 @@ def bus_book(request, pk):
                 messages.error(request, "No verified bookings to process")
                 return redirect('bus-book', pk=bus.pk)
             
-            # Process verified bookings
-            with transaction.atomic():
-                successful_bookings = 0
-                actual_cost = 0
-                
-                for booking in verified_bookings:
-                    try:
-                        seat = Seat.objects.select_for_update().get(pk=booking['seat_id'], bus=bus)
-                        
-                        # Double-check availability
-                        if Booking.objects.filter(seat=seat, travel_date=travel_date).exclude(status__in=['Cancelled', 'Refunded']).exists():
-                            continue
-                        
-                        # Get boarding and destination points
-                        try:
-                            start_stop = bus.bus_stops.get(id=booking['start_stop'])
-                            end_stop = bus.bus_stops.get(id=booking['end_stop'])
-
-                            if start_stop == end_stop:
-                                continue
-                        except (ValueError, BusStop.DoesNotExist):
-                            continue
-                        
-                        # Create booking
-                        new_booking = Booking.objects.create(
-                            bus=bus,
-                            customer=request.user,
-                            seat=seat,
-                            start_stop=start_stop.stop,
-                            end_stop=end_stop.stop,
-                            travel_date=travel_date,
-                            passenger_name=booking['name'],
-                            passenger_email=booking['email'],
-                            status='Confirmed'
-                        )
-                        successful_bookings += 1
-                        actual_cost += seat.fare
-
-                        subject = f'Booking Confirmation - {new_booking.bus}'
-                        message = f"""
-                        Dear {new_booking.passenger_name},
-                        
-                        Your booking has been confirmed. Here are your travel details:
-                        
-                        Bus: {new_booking.bus}
-                        Seat: {new_booking.seat.name} ({new_booking.seat.seat_class})
-                        Travel Date: {new_booking.travel_date}
-                        From: {new_booking.start_stop}
-                        To: {new_booking.end_stop}
-                        Fare: ₹{new_booking.seat.fare}
-                        
-                        Thank you for choosing our service!
-                        """
-
-                        # Mailgun API request
-                        response = requests.post(
-                            "https://api.mailjet.com/v3.1/send",
-                            auth=(settings.MAILJET_API_KEY, settings.MAILJET_API_SECRET),
-                            json={
-                                "Messages": [
-                                    {
-                                        "From": {
-                                            "Email": settings.MAILJET_SENDER_EMAIL,
-                                            "Name": "BookBus"
-                                        },
-                                        "To": [
-                                            {
-                                                "Email": new_booking.passenger_email,
-                                                "Name": new_booking.passenger_name
-                                            }
-                                        ],
-                                        "Subject": subject,
-                                        "TextPart": message.strip(),
-                                        "HTMLPart": f"""
-                                        <h3>Booking Confirmation - {new_booking.bus}</h3>
-                                        <p>Dear {new_booking.passenger_name},</p>
-                                        <p>Your booking has been confirmed. Here are your travel details:</p>
-                                        <ul>
-                                            <li><strong>Bus:</strong> {new_booking.bus}</li>
-                                            <li><strong>Seat:</strong> {new_booking.seat.name} ({new_booking.seat.seat_class})</li>
-                                            <li><strong>Travel Date:</strong> {new_booking.travel_date}</li>
-                                            <li><strong>From:</strong> {new_booking.start_stop}</li>
-                                            <li><strong>To:</strong> {new_booking.end_stop}</li>
-                                            <li><strong>Fare:</strong> ₹{new_booking.seat.fare}</li>
-                                        </ul>
-                                        <p>Thank you for choosing our service!</p>
-                                        """
-                                    }
-                                ]
-                            }
-                        )
-
-                        
-                        if response.status_code != 200:
-                            raise Exception(f"Failed to send booking confirmation: {response.text}")
-                        
-                    except Exception as e:
-                        # Log error but continue with other bookings
-                        import logging
-                        logger = logging.getLogger(__name__)
-                        logger.error(f"Error processing booking: {str(e)}")
-                        continue
-                    
-                
-                if successful_bookings > 0:
-                    # Deduct coins
-
-                    try:
-                        create_transaction(
-                            user=request.user,
-                            travels=new_booking.bus.travels,
-                            amount=actual_cost,
-                            transaction_type='BOOKING',
-                            description=f"Bus booked through {new_booking.bus.travels}"
-                        )
-                    except ValueError as e:
-                        # Handle errors (like insufficient coins)
-                        print(f"Transaction failed: {str(e)}")
-
-                    # Clear session data
-                    del request.session['booking_data']
-                    messages.success(request, f"Booked {successful_bookings} seat(s)! {actual_cost} coins deducted.")
-                    return redirect('booked-buses', username=request.user.username)
-                else:
-                    messages.error(request, "No seats were booked")
-                    return redirect('bus-book', pk=bus.pk)
+            # Lock, check and insert every seat of the group at once
+            try:
+                bookings = commit_bookings(
+                    bus, request.user, travel_date, verified_bookings, holder=booking_holder(request)
+                )
+            except ValueError as e:
+                messages.error(request, f"Booking failed: {str(e)}")
+                return redirect('bus-book', pk=bus.pk)
+
+            if bookings:
+                # Clear session data
+                del request.session['booking_data']
+                actual_cost = sum(booking.seat.fare for booking in bookings)
+                messages.success(request, f"Booked {len(bookings)} seat(s)! {actual_cost} coins deducted.")
+                return redirect('booked-buses', username=request.user.username)
+            else:
+                messages.error(request, "No seats were booked")
+                return redirect('bus-book', pk=bus.pk)
 
     # Prepare context for GET requests
     travel_date = None
@@ -679,37 +613,18 @@ def bus_book(request, pk):
             request.session['booking_data'] = booking_data
             request.session.modified = True
 
-    # Get seats with availability status
-    seats = bus.seats.annotate(
-        is_booked=Exists(
-            Booking.objects.filter(
-                seat=OuterRef('pk'),
-                travel_date=travel_date
-            ).exclude(
-                status__in=['Cancelled', 'Refunded']
-            )
-        ) if travel_date else Value(False, output_field=BooleanField())
-    ).order_by('seat_class', 'name')
-
-    # Natural sorting
-    def natural_sort_key(seat):
-        name = seat.name
-        alpha = ''
-        num = ''
-        for char in name:
-            if char.isdigit():
-                num += char
-            else:
-                alpha += char
-        return (seat.seat_class, alpha.lower(), int(num) if num else 0)
+    # Seats in display order with availability for the chosen legs
+    route = get_route(bus.pk)
+    segment_start, segment_end = booking_segment(route, booking_data)
+    seats = seat_map(bus.pk, travel_date, leg_mask(segment_start, segment_end), holder=request.session.session_key)
 
-    seats = sorted(seats, key=natural_sort_key)
-
-    # Get selected seat objects
-    selected_seat_objects = Seat.objects.filter(
-        id__in=booking_data.get('selected_seats', []),
-        bus=bus
-    )
+    # Selected seats, in the order the passenger forms are numbered
+    seats_by_id = {seat['id']: seat for seat in seats}
+    selected_seat_objects = [
+        seats_by_id[seat_id]
+        for seat_id in booking_data.get('selected_seats', [])
+        if seat_id in seats_by_id
+    ]
 
     context = {
         'bus': bus,
@@ -717,17 +632,18 @@ def bus_book(request, pk):
         'min_date': datetime.date.today(),
         'max_date': bus.end_time.date(),
         'seats_by_class': {
-            'General': [s for s in seats if s.seat_class == 'General'],
-            'Sleeper': [s for s in seats if s.seat_class == 'Sleeper'],
-            'Luxury': [s for s in seats if s.seat_class == 'Luxury'],
+            seat_class: [s for s in seats if s['seat_class'] == seat_class]
+            for seat_class in SEAT_CLASSES
         },
         'selected_seats': booking_data.get('selected_seats', []),
         'selected_seat_objects': selected_seat_objects,
         'bus_stops': bus.bus_stops.select_related('stop').order_by('stop_order'),
+        'segment_start': route['bus_stop_ids'][segment_start] if route['bus_stop_ids'] else None,
+        'segment_end': route['bus_stop_ids'][segment_end] if route['bus_stop_ids'] else None,
         'verified_emails': booking_data.get('verified_emails', {})
     }
     
-    return render(request, 'bookbus/bus_book.html', context)
+    return with_validator(render(request, 'bookbus/bus_book.html', context), etag)
     
     
 def passenger_info(request, pk):
@@ -784,8 +700,37 @@ def passenger_info(request, pk):
         messages.error(request, f'Error creating booking: {str(e)}')
         return redirect('bus-book', pk=bus.pk)
 
+async def seat_events(request, pk):
+    """
+    Server-Sent Events with the seat map's changes for ?date= and the legs
+    between the ?start= and ?end= BusStop ids, for the open bus_book page
+    """
+    try:
+        travel_date = datetime.date.fromisoformat(request.GET.get('date', ''))
+    except ValueError:
+        return JsonResponse({'error': 'date is required, as YYYY-MM-DD'}, status=400)
+    if not await Bus.objects.filter(pk=pk).aexists():
+        raise Http404
+
+    route = await sync_to_async(get_route)(pk)
+    try:
+        segment = [int(request.GET['start']), int(request.GET['end'])]
+    except (KeyError, ValueError):
+        segment = []
+    segment_start, segment_end = booking_segment(route, {'segment': segment})
+
+    response = StreamingHttpResponse(
+        seat_event_stream(pk, travel_date, leg_mask(segment_start, segment_end), request.session.session_key),
+        content_type='text/event-stream'
+    )
+    response['Cache-Control'] = 'no-cache'
+    # Sent to the browser as it comes rather than buffered by nginx
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
 @csrf_exempt
-def send_passenger_otp(request):
+async def send_passenger_otp(request):
     if request.method == 'POST':
         try:
             import json
@@ -795,7 +740,7 @@ def send_passenger_otp(request):
             if not email or '@' not in email:
                 return JsonResponse({'success': False, 'message': 'Invalid email'})
                 
-            send_otp_email(email)
+            await asend_otp_email(email)
             return JsonResponse({'success': True})
             
         except Exception as e:
@@ -806,7 +751,6 @@ def send_passenger_otp(request):
 
 def cancel_booking(request, pk):
     booking = get_object_or_404(Booking, pk=pk, customer=request.user)
-    profile = request.user.profile
     
     if request.method == 'POST':
         if booking.status != 'Confirmed':
@@ -821,19 +765,17 @@ def cancel_booking(request, pk):
             booking.status = 'Cancelled'
             booking.cancelled_at = timezone.now()  # Add this field to track when cancelled
             booking.save()
+            transaction.on_commit(lambda: invalidate_occupancy(booking.bus_id, booking.travel_date))
+            transaction.on_commit(lambda: publish_seat_change(booking.bus_id, booking.travel_date))
             
             # Refund coins
-            try:
-                create_transaction(
-                    user=user,
-                    travels=booking.bus.travels,
-                    amount=refund_amount,
-                    transaction_type='CANCELLATION',
-                    description=f"Refund for bus booked through {bus.travels} on {booking.date_booked}"
-                )
-            except ValueError as e:
-                # Handle errors (like insufficient coins)
-                print(f"Transaction failed: {str(e)}")
+            create_transaction(
+                user=request.user,
+                travels=booking.bus.travels,
+                amount=refund_amount,
+                transaction_type='CANCELLATION',
+                description=f"Refund for bus booked through {booking.bus.travels} on {booking.date_booked}"
+            )
             
             messages.success(request, f'Booking cancelled successfully! {refund_amount} coins refunded.')
             return redirect('booked-buses', username=request.user.username)
@@ -847,37 +789,15 @@ class StopCreateView(LoginRequiredMixin, UserPassesTestMixin, CreateView):
     template_name = 'bookbus/add_stop.html'
     success_url = reverse_lazy('bookbus-home')
 
-    @staticmethod
-    def haversine_distance(lat1, lon1, lat2, lon2):
-        R = 6371000  # Radius of Earth in meters
-        phi1 = math.radians(lat1)
-        phi2 = math.radians(lat2)
-        delta_phi = math.radians(lat2 - lat1)
-        delta_lambda = math.radians(lon2 - lon1)
-
-        a = math.sin(delta_phi/2)**2 + math.cos(phi1) * math.cos(phi2) * math.sin(delta_lambda/2)**2
-        c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-
-        return R * c 
-
     def form_valid(self, form):
         lat = form.cleaned_data['latitude']
         lng = form.cleaned_data['longitude']
 
-        # Rough bounding box for ~10 meters (very small range)
-        delta = 0.0001  # ~11 meters latitude-wise, works fine for small proximity
-        nearby_stops = Stop.objects.filter(
-            latitude__range=(lat - delta, lat + delta),
-            longitude__range=(lng - delta, lng + delta)
-        )
-
-        for stop in nearby_stops:
-            distance = self.haversine_distance(lat, lng, stop.latitude, stop.longitude)
-            if distance < 10:
-                messages.error(self.request, "A stop already exists within 10 meters.")
-                return self.form_invalid(form)
+        # Indexed grid cell lookup instead of a range scan over the coordinates
+        if stop_exists_near(lat, lng, DUPLICATE_RADIUS_M):
+            messages.error(self.request, f"A stop already exists within {DUPLICATE_RADIUS_M} meters.")
+            return self.form_invalid(form)
 
-        stop = form.save()
         return super().form_valid(form)
     
     def form_invalid(self, form):
@@ -909,103 +829,84 @@ class ExportBookingsExcelView(LoginRequiredMixin, UserPassesTestMixin, View):
         return HttpResponse('Unauthorized', status=401)
     
     def get(self, request, *args, **kwargs):
-        # Get all bookings for buses owned by this admin (including cancelled)
-        bookings = Booking.objects.filter(
-            bus__travels=request.user
-        ).select_related(
-            'bus',
-            'seat',
-            'customer',
-            'start_stop',
-            'end_stop'
-        ).order_by('bus__id', 'travel_date')
-
-        # Create Excel workbook
-        response = HttpResponse(
-            content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
-        response['Content-Disposition'] = f'attachment; filename="all_bookings_{datetime.datetime.now().strftime("%Y%m%d_%H%M%S")}.xlsx"'
-
-        wb = Workbook()
-        wb.remove(wb.active)
-
-        # Define column headers and widths
-        headers = [
-            ("Booking ID", 10),
-            ("Bus ID", 10),
-            ("Status", 12),
-            ("Seat", 10),
-            ("Seat Class", 15),
-            ("From", 25),
-            ("To", 25),
-            ("Travel Date", 15),
-            ("Passenger", 25),
-            ("Email", 30),
-            ("Fare", 10),
-            ("Booked At", 20),
-            ("Cancelled At", 20)
-        ]
-
-        # Group bookings by bus
-        from itertools import groupby
-        buses_data = {}
-        for bus, bus_bookings in groupby(bookings, key=lambda x: x.bus):
-            buses_data[bus] = list(bus_bookings)
-
-        for bus, bus_bookings in buses_data.items():
-            # Create worksheet for each bus
-            ws = wb.create_sheet(title=f"Bus-{bus.id}")
-            
-            # Add bus info
-            ws.append([f"Bus ID: {bus.id}"])
-            ws.append([f"Route: {bus.journey_start.name} to {bus.journey_end.name}"])
-            ws.append([f"Total Bookings: {len(bus_bookings)}"])
-            ws.append([])
-            
-            # Add headers
-            ws.append([h[0] for h in headers])
-            
-            # Style headers
-            bold_font = Font(bold=True)
-            for col_num, header in enumerate(headers, 1):
-                col_letter = get_column_letter(col_num)
-                ws.column_dimensions[col_letter].width = header[1]
-                ws[f"{col_letter}{5}"].font = bold_font
-            
-            # Add booking data with status indication
-            for booking in bus_bookings:
-                row = [
-                    booking.id,
-                    bus.id,
-                    booking.status,
-                    booking.seat.name,
-                    booking.seat.seat_class,
-                    booking.start_stop.name,
-                    booking.end_stop.name,
-                    booking.travel_date.strftime("%Y-%m-%d"),
-                    booking.passenger_name,
-                    booking.passenger_email,
-                    booking.seat.fare,
-                    booking.created_at.strftime("%Y-%m-%d %H:%M"),
-                    booking.cancelled_at.strftime("%Y-%m-%d %H:%M") if booking.cancelled_at else "N/A"
-                ]
-                ws.append(row)
-            
-            # Add summary
-            last_row = ws.max_row
-            if last_row > 5:
-                ws.append([])
-                ws.append(["Confirmed Bookings:", f'=COUNTIF(C6:C{last_row},"Confirmed")'])
-                ws.append(["Cancelled Bookings:", f'=COUNTIF(C6:C{last_row},"Cancelled")'])
-                ws.append(["Total Revenue:", f'=SUMIF(C6:C{last_row},"Confirmed",K6:K{last_row})'])
-                
-                # Style summary
-                for cell in ['A', 'B', 'C']:
-                    ws[f"{cell}{last_row+2}"].font = Font(bold=True)
-                    ws[f"{cell}{last_row+3}"].font = Font(bold=True)
-                    ws[f"{cell}{last_row+4}"].font = Font(bold=True)
+        # All bookings for buses owned by this admin (including cancelled),
+        # streamed from the database into a write-only workbook
+        fileobj = export_bookings_file(request.user)
+        return FileResponse(
+            fileobj,
+            as_attachment=True,
+            filename=f'all_bookings_{datetime.datetime.now().strftime("%Y%m%d_%H%M%S")}.xlsx',
+            content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+        )
 
-        wb.save(response)
-        return response
+
+class ExportJobMixin(LoginRequiredMixin, UserPassesTestMixin):
+    def test_func(self):
+        return self.request.user.groups.filter(name='BusAdmin').exists()
+
+    def handle_no_permission(self):
+        return HttpResponse('Unauthorized', status=401)
+
+    def get_job(self):
+        return get_object_or_404(ExportJob, pk=self.kwargs['pk'], operator=self.request.user)
+
+    @staticmethod
+    def job_status(job):
+        return {
+            'id': job.pk,
+            'status': job.status,
+            'rows': job.rows,
+            'error': job.error,
+            'status_url': reverse('export-job-status', kwargs={'pk': job.pk}),
+            'download_url': reverse('export-job-download', kwargs={'pk': job.pk}) if job.status == 'Done' else None,
+        }
+
+
+class ExportJobCreateView(ExportJobMixin, View):
+    def post(self, request, *args, **kwargs):
+        # Built by run_export_worker; an unchanged export is reused straight away
+        return JsonResponse(self.job_status(request_export(request.user)))
+
+
+class ExportJobStatusView(ExportJobMixin, View):
+    def get(self, request, *args, **kwargs):
+        return JsonResponse(self.job_status(self.get_job()))
+
+
+class ExportJobDownloadView(ExportJobMixin, View):
+    def get(self, request, *args, **kwargs):
+        job = self.get_job()
+        if job.status != 'Done':
+            return HttpResponse('Export not ready', status=409)
+        try:
+            fileobj = open(job.file_path, 'rb')
+        except FileNotFoundError:
+            raise Http404("Export file no longer exists")
+        return FileResponse(
+            fileobj,
+            as_attachment=True,
+            filename=f'all_bookings_{job.created_at.strftime("%Y%m%d_%H%M%S")}.xlsx',
+            content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+        )
+
+
+class MetricsView(LoginRequiredMixin, UserPassesTestMixin, View):
+    """Per-route request metrics of this worker for Prometheus; staff only, or with METRICS_TOKEN"""
+
+    def dispatch(self, request, *args, **kwargs):
+        token = settings.METRICS_TOKEN
+        if token and constant_time_compare(request.headers.get('Authorization', ''), f'Bearer {token}'):
+            return self.get(request, *args, **kwargs)
+        return super().dispatch(request, *args, **kwargs)
+
+    def test_func(self):
+        return self.request.user.is_staff
+
+    def handle_no_permission(self):
+        return HttpResponseForbidden("You don't have permission to access this page")
+
+    def get(self, request, *args, **kwargs):
+        return HttpResponse(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
 
 
 def about(request):
@@ -17,6 +17,6 @@ python manage.py migrate --noinput
 echo "Collecting static files..."
 python manage.py collectstatic --noinput --clear
 
-# Start Gunicorn
+# Start Gunicorn, on the ASGI stack so seat map streams don't each hold a worker
 echo "Starting Gunicorn..."
-exec gunicorn --bind 0.0.0.0:8000 --workers 3 mysite.wsgi:application
\ No newline at end of file
+exec gunicorn --bind 0.0.0.0:8000 --workers 3 --worker-class uvicorn.workers.UvicornWorker mysite.asgi:application
\ No newline at end of file
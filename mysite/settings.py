@@ -1,4 +1,4 @@
- """
+"""
 Django settings for mysite project.
 
 Generated by 'django-admin startproject' using Django 5.1.
@@ -74,6 +74,7 @@ SOCIAL_ACCOUNT_PROVIDERS = {
 }
 
 MIDDLEWARE = [
+    'bookbus.middleware.RequestMetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -88,7 +89,8 @@ ROOT_URLCONF = 'mysite.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # DjangoTemplates, timing each render for /metrics
+        'BACKEND': 'bookbus.utils.metrics.TimedDjangoTemplates',
         'DIRS': [],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -97,6 +99,7 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'bookbus.context_processors.user_groups',
             ],
         },
     },
@@ -108,14 +111,44 @@ WSGI_APPLICATION = 'mysite.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
-DATABASES = {
+if env('SQLITE_PATH', default=''):
+    # A single SQLite file in WAL mode, for running load tests on one machine.
+    # IMMEDIATE transactions take the write lock up front, so concurrent bookings
+    # queue on it (for up to `timeout` seconds) instead of failing to upgrade a read lock.
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': env('SQLITE_PATH'),
+            'OPTIONS': {
+                'init_command': 'PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL',
+                'transaction_mode': 'IMMEDIATE',
+                'timeout': 20,
+            },
+        }
+    }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql_psycopg2',
+            'NAME': env('POSTGRES_DB'),
+            'USER': env('POSTGRES_USER'),
+            'PASSWORD': env('POSTGRES_PASSWORD'),
+            'HOST': env('DB_HOST'),
+            'PORT': env('DB_PORT'),
+        }
+    }
+
+
+# Shared by every worker process on the host, so version counters and
+# invalidations reach all of them without a cache server. Point
+# CACHE_BACKEND at LocMemCache for a single process.
+CACHES = {
     'default': {
-        'ENGINE': 'django.db.backends.postgresql_psycopg2',
-        'NAME': env('POSTGRES_DB'),
-        'USER': env('POSTGRES_USER'),
-        'PASSWORD': env('POSTGRES_PASSWORD'),
-        'HOST': env('DB_HOST'),
-        'PORT': env('DB_PORT'),
+        'BACKEND': env('CACHE_BACKEND', default='django.core.cache.backends.filebased.FileBasedCache'),
+        'LOCATION': env('CACHE_LOCATION', default=os.path.join(BASE_DIR, 'cache')),
+        'OPTIONS': {
+            'MAX_ENTRIES': env.int('CACHE_MAX_ENTRIES', default=20000),
+        },
     }
 }
 
@@ -161,6 +194,50 @@ STATIC_ROOT = BASE_DIR / 'staticfiles'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 MEDIA_URL = '/media/' 
 
+# Finished booking exports and their cached per-bus fragments (not publicly served)
+EXPORT_ROOT = env('EXPORT_ROOT', default=os.path.join(BASE_DIR, 'exports'))
+# Finished exports and unused fragments older than this are deleted by run_export_worker
+EXPORT_RETENTION_HOURS = env.int('EXPORT_RETENTION_HOURS', default=24)
+# A job still Running this long after a worker claimed it is taken for a dead worker's and failed
+EXPORT_JOB_TIMEOUT_MINUTES = env.int('EXPORT_JOB_TIMEOUT_MINUTES', default=30)
+
+# How long seats picked in bus_book stay reserved while the passenger pays
+SEAT_HOLD_MINUTES = env.int('SEAT_HOLD_MINUTES', default=10)
+
+# How long a replayed POST (see bookbus/utils/idempotency.py) is remembered
+IDEMPOTENCY_KEY_TTL_HOURS = env.int('IDEMPOTENCY_KEY_TTL_HOURS', default=24)
+
+# CoinShard rows per operator that booking credits are spread over, so
+# concurrent bookings for one operator do not queue on a single row lock
+# (see bookbus/utils/transaction_utils.py). Must not be lowered once shard
+# rows exist: credits only go to shards below this count, so the rows above
+# it would be left behind. Raising it is safe; missing rows are created on
+# the next credit after a restart
+COIN_SHARDS = env.int('COIN_SHARDS', default=8)
+
+# Most SQL queries a request to each URL name should run; more is logged and
+# flagged with an X-Query-Budget-Exceeded header, and with QUERY_BUDGET_STRICT
+# fails GET and HEAD requests (see bookbus/middleware.py)
+QUERY_BUDGETS = {
+    'bookbus-home': 14,
+    # 4 on a warm cache; re-rendering the route and seat blocks adds 2
+    'bus-detail': 6,
+    'bus-book': 30,
+}
+QUERY_BUDGET_STRICT = env.bool('QUERY_BUDGET_STRICT', default=False)
+
+# Lets a Prometheus scraper read /metrics without a staff session
+METRICS_TOKEN = env('METRICS_TOKEN', default='')
+
+# Seconds nginx may serve the pages an anonymous visitor sees unfiltered
+# (home, bus detail) from its cache (see bookbus/utils/conditional.py)
+SHARED_PAGE_MAX_AGE = env.int('SHARED_PAGE_MAX_AGE', default=30)
+
+# Live seat map streams (see bookbus/utils/seat_events.py): how often each
+# checks for bookings made by other workers, and how long one stays open
+SEAT_EVENTS_POLL_SECONDS = env.int('SEAT_EVENTS_POLL_SECONDS', default=2)
+SEAT_EVENTS_STREAM_SECONDS = env.int('SEAT_EVENTS_STREAM_SECONDS', default=300)
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
 
@@ -179,6 +256,7 @@ DEFAULT_FROM_EMAIL = "noreply@sandboxb3dd9434e64b4a8ab8687225f74ee9eb.mailgun.or
 MAILJET_API_KEY = env('MAILJET_API_KEY')
 MAILJET_API_SECRET = env('MAILJET_API_SECRET')
 MAILJET_SENDER_EMAIL = 'noreply@dvmbookbus.medhanshai.com'
+MAILJET_API_URL = env('MAILJET_API_URL', default='https://api.mailjet.com/v3.1/send')
 
 AUTHENTICATION_BACKEND = (
     "django.contrib.auth.backends.ModelBackend",
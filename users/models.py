@@ -1,4 +1,5 @@
 from django.db import models
+from django.db.models import Sum
 from django.contrib.auth.models import User, Group
 from django.db.models.signals import post_save
 from django.dispatch import receiver
@@ -13,6 +14,29 @@ class Profile(models.Model):
     def __str__(self):
         return f'{self.user.username} Profile'
 
+    @property
+    def balance(self):
+        """Coins on the profile plus operator earnings still spread over coin shards"""
+        shards = CoinShard.objects.filter(user_id=self.user_id).aggregate(total=Sum('coins'))['total']
+        return self.coins + (shards or 0)
+
+
+class CoinShard(models.Model):
+    """
+    One of several counter rows that operator earnings are credited to, so
+    concurrent bookings with the same operator do not all update one row.
+    An operator's balance is their profile coins plus the sum of their shards.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='coin_shards')
+    shard = models.PositiveSmallIntegerField()
+    coins = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('user', 'shard')
+
+    def __str__(self):
+        return f'{self.user.username} shard {self.shard}: {self.coins}'
+
 
 @receiver(post_save, sender=User)
 def create_user_profile(sender, instance, created, **kwargs):
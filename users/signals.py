@@ -7,13 +7,8 @@ from .models import Profile
 @receiver(post_save, sender=User)
 def create_user_profile(sender, instance, created, **kwargs):
     """
-    Create a profile for new users, or update existing ones
+    Create a profile for new users, and for existing ones that lack it.
+    Never saves an existing profile: coins are updated in the database by the
+    ledger, so the cached instance may hold a stale balance.
     """
-    if created:
-        Profile.objects.get_or_create(user=instance)
-    else:
-        # Ensure existing users have a profile
-        try:
-            instance.profile.save()
-        except Profile.DoesNotExist:
-            Profile.objects.create(user=instance)
\ No newline at end of file
+    Profile.objects.get_or_create(user=instance)
\ No newline at end of file
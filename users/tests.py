@@ -1,3 +1,39 @@
+from django.contrib.auth.models import User
 from django.test import TestCase
+from django.urls import reverse
+from bookbus.models import OutboundEmail
+from .models import OTP
 
-# Create your tests here.
+
+class RegistrationTests(TestCase):
+    data = {
+        'username': 'rider', 'email': 'rider@example.com',
+        'password1': 'a long Passw0rd', 'password2': 'a long Passw0rd',
+    }
+
+    async def test_signup_queues_an_otp_and_verifying_it_creates_the_user(self):
+        response = await self.async_client.post(reverse('register'), self.data)
+        self.assertRedirects(response, reverse('verify_email'), fetch_redirect_response=False)
+        otp = await OTP.objects.aget(email='rider@example.com', purpose='registration')
+        email = await OutboundEmail.objects.aget(to_email='rider@example.com')
+        self.assertIn(otp.otp, email.text_body)
+        self.assertFalse(await User.objects.filter(username='rider').aexists())
+
+        response = await self.async_client.post(reverse('resend_otp'))
+        self.assertRedirects(response, reverse('verify_email'), fetch_redirect_response=False)
+        latest = await OTP.objects.filter(email='rider@example.com').alatest('created_at')
+        self.assertEqual(await OutboundEmail.objects.acount(), 2)
+
+        response = await self.async_client.post(reverse('verify_email'), {'otp': latest.otp})
+        self.assertRedirects(response, reverse('login'), fetch_redirect_response=False)
+        user = await User.objects.aget(username='rider')
+        self.assertEqual(user.email, 'rider@example.com')
+
+    async def test_invalid_signup_and_resend_without_one(self):
+        response = await self.async_client.post(reverse('register'), dict(self.data, password2='different'))
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(await OTP.objects.aexists())
+
+        response = await self.async_client.post(reverse('resend_otp'))
+        self.assertRedirects(response, reverse('register'), fetch_redirect_response=False)
+        self.assertFalse(await OutboundEmail.objects.aexists())
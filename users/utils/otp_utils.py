@@ -1,43 +1,32 @@
 import random
-import requests
-from django.conf import settings
 from django.utils import timezone
-from .models import OTP
+from users.models import OTP
+from bookbus.utils.email_utils import aqueue_email
 
 def generate_otp():
     """Generate a 6-digit OTP"""
     return str(random.randint(100000, 999999))
 
-def send_otp_email(email, purpose):
+async def asend_otp_email(email, purpose):
     """
-    Send OTP email without user reference initially
+    Queue an OTP email without user reference initially, from an async view
     Returns the created OTP object
     """
     otp = generate_otp()
-    otp_obj = OTP.objects.create(
+    # Two inserts rather than one transaction, which the async ORM cannot open;
+    # an OTP whose email failed to queue is never sent and is requested again
+    otp_obj = await OTP.objects.acreate(
         email=email,
         otp=otp,
         purpose=purpose,
         user=None  # Will be updated after verification
     )
-    
-    response = requests.post(
-        "https://api.mailjet.com/v3.1/send",
-        auth=(settings.MAILJET_API_KEY, settings.MAILJET_API_SECRET),
-        json={
-            "Messages": [{
-                "From": {"Email": settings.MAILJET_SENDER_EMAIL, "Name": "BookBus"},
-                "To": [{"Email": email}],
-                "Subject": f"Your {purpose.replace('_', ' ').title()} OTP",
-                "TextPart": f"Your OTP for verification is: {otp}",
-            }]
-        }
+    await aqueue_email(
+        to_email=email,
+        subject=f"Your {purpose.replace('_', ' ').title()} OTP",
+        text_body=f"Your OTP for verification is: {otp}",
     )
     
-    if response.status_code != 200:
-        otp_obj.delete()  # Clean up if email fails
-        raise Exception(f"Failed to send OTP: {response.text}")
-    
     return otp_obj
 
 def verify_otp(email, otp_code, purpose):
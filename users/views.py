@@ -1,31 +1,34 @@
 from django.shortcuts import render, redirect
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
-from .forms import UserRegisterForm, UserUpdateForm, ProfileUpdateForm
-from .utils.otp_utils import send_otp_email, verify_otp
+from .forms import UserRegisterForm, UserUpdateForm
+from .utils.otp_utils import asend_otp_email, verify_otp
 from bookbus.utils import transaction_utils
+from bookbus.utils.idempotency import idempotent
 
 from django.contrib.auth import get_user_model
+from asgiref.sync import sync_to_async
 
 
 User = get_user_model()
 
-def register(request):
+async def register(request):
     if request.method == "POST":
         form = UserRegisterForm(request.POST)
-        if form.is_valid():
+        # Validation checks the username against the database
+        if await sync_to_async(form.is_valid)():
             # Store form data in session
-            request.session['registration_data'] = {
+            await request.session.aset('registration_data', {
                 'username': form.cleaned_data['username'],
                 'email': form.cleaned_data['email'],
                 'password': form.cleaned_data['password1'],
                 'first_name': form.cleaned_data.get('first_name', ''),
                 'last_name': form.cleaned_data.get('last_name', ''),
-            }
+            })
             
             # Send OTP (without user reference)
             try:
-                send_otp_email(
+                await asend_otp_email(
                     email=form.cleaned_data['email'],
                     purpose='registration'
                 )
@@ -39,7 +42,8 @@ def register(request):
     else:
         form = UserRegisterForm()
     
-    return render(request, 'users/register.html', {'form': form})
+    # The navbar reads request.user, which is loaded synchronously
+    return await sync_to_async(render)(request, 'users/register.html', {'form': form})
 
 def verify_email(request):
     # Check for registration data
@@ -85,14 +89,14 @@ def verify_email(request):
         'email': registration_data['email']
     })
 
-def resend_otp(request):
-    registration_data = request.session.get('registration_data')
+async def resend_otp(request):
+    registration_data = await request.session.aget('registration_data')
     if not registration_data:
         messages.warning(request, 'No registration in progress.')
         return redirect('register')
     
     try:
-        send_otp_email(
+        await asend_otp_email(
             email=registration_data['email'],
             purpose='registration'
         )
@@ -104,6 +108,7 @@ def resend_otp(request):
 
 
 @login_required
+@idempotent('add_coins')
 def profile(request):
     if request.method == "POST":
         if 'update_profile' in request.POST:
@@ -114,13 +119,13 @@ def profile(request):
                 return redirect("profile")
         
         elif 'add_coins' in request.POST:
-            amount = int(request.POST.get('coin_amount', 0))
             try:
-                create_transaction(
+                amount = int(request.POST.get('coin_amount', 0))
+                transaction_utils.create_transaction(
                     user=request.user,
                     travels=None,
                     amount=amount,
-                    transaction_type='ADD_MONEY',
+                    transaction_type='ADD_COINS',
                 )
                 messages.success(request, f'Successfully added {amount} coins!')
             except Exception as e: